@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import asyncio
+import functools
+import threading
+import traceback
+
+import constant
+import framing
+from peer import Peer
+from server import ErrorReply, RequestHandler, SendFile, open_files, uploads
+
+class AsyncServer:
+    '''
+    Serves the same requests as `Server` from a single asyncio event
+    loop instead of a thread per connection.
+
+    At most `max_connections` clients are served at once, extra ones
+    are turned away. Connections that sit idle for `idle_timeout`
+    seconds are closed by a reaper task.
+    '''
+
+    def __init__(self, cli, port, tracks, local_tracks,
+        max_connections=constant.MAX_CONNECTIONS,
+        idle_timeout=constant.IDLE_TIMEOUT_S
+    ):
+        self.host = '0.0.0.0' # Listen on all interfaces
+        self.port = port
+        self.cli = cli
+        self.tracks = tracks
+        self.local_tracks = local_tracks
+        self.nodes = {}
+
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+
+        self.ready = threading.Event()
+        self.error = None
+
+    def start(self):
+
+        self.cli.log(f'Starting asyncio server on port {self.port}... ')
+
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True
+        thread.start()
+
+        # Surface bind errors the same way the threaded server does
+        self.ready.wait()
+        if (self.error is not None):
+            raise self.error
+
+        self.cli.log(f'Done')
+
+    def run(self):
+
+        # Not asyncio.run, which needs Python 3.7
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.serve())
+
+    async def serve(self):
+
+        try:
+            server = await asyncio.start_server(
+                self.handle_connection, self.host, self.port, reuse_address=True
+            )
+        except OSError as e:
+            self.error = e
+            self.ready.set()
+            return
+
+        self.ready.set()
+
+        reaper = asyncio.ensure_future(self.reap_idle())
+
+        # Serve until the process exits, Server.serve_forever is 3.7+
+        try:
+            await asyncio.get_event_loop().create_future()
+        finally:
+            reaper.cancel()
+            server.close()
+
+    async def reap_idle(self):
+        '''
+        Periodically close connections that haven't sent a request
+        within the idle timeout.
+        '''
+
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+
+            now = loop.time()
+            for connection in list(self.nodes.values()):
+                if (now - connection.last_active > self.idle_timeout):
+                    self.cli.log(f'Closing idle connection to {connection.peer}')
+                    connection.writer.close()
+
+    async def handle_connection(self, reader, writer):
+
+        addr = writer.get_extra_info('peername')[:2]
+
+        if (len(self.nodes) >= self.max_connections):
+            self.cli.log(f'Refusing connection from {addr[0]}:{addr[1]}, too many clients')
+            writer.close()
+            return
+
+        connection = AsyncConnection(self.cli, addr, reader, writer, self.local_tracks)
+        self.nodes[addr] = connection
+
+        try:
+            await connection.run()
+        finally:
+            del self.nodes[addr]
+            writer.close()
+            self.cli.log(f'Connection to {connection.peer} closed')
+
+class AsyncConnection(RequestHandler):
+    '''
+    One client connection on the asyncio server. Each request is
+    answered by its own task, so replies can go out in any order.
+    '''
+
+    def __init__(self, cli, addr, reader, writer, local_tracks):
+
+        self.cli = cli
+        self.reader = reader
+        self.writer = writer
+        self.local_tracks = local_tracks
+        self.peer = Peer(cli, *addr)
+
+        # Only one frame goes onto the stream at a time
+        self.send_lock = asyncio.Lock()
+
+        self.last_active = asyncio.get_event_loop().time()
+
+        self.cli.log(f'Got connection from {self.peer}')
+
+    async def respond(self, req_id, data):
+        '''
+        Handle one request and send back its reply.
+        '''
+
+        loop = asyncio.get_event_loop()
+
+        try:
+            # Hashing pieces or encoding the catalog would hold up every
+            # other connection, pings are cheap enough to answer here
+            if (data == b'ping'):
+                resp = self.handle_request(data)
+            else:
+                resp = await loop.run_in_executor(None, self.handle_request, data)
+
+            if (isinstance(resp, SendFile)):
+                pace = functools.partial(uploads.acquire_async, self.peer.host)
+
+                with open_files.open(resp.path) as entry:
+                    size = await framing.send_file_async(
+                        self.writer, self.send_lock, req_id, entry, resp.offset, resp.length, pace
+                    )
+                self.cli.log(f'Sent {size} bytes to {self.peer}')
+
+            elif (isinstance(resp, ErrorReply)):
+                await framing.write_frame_async(
+                    self.writer, self.send_lock, req_id, resp.message.encode(), framing.ERROR
+                )
+
+            else:
+                if (isinstance(resp, str)):
+                    resp = resp.encode()
+
+                # Replies other than files never wait on the upload limits
+                uploads.control(self.peer.host, len(resp) + framing.HEADER.size)
+
+                await framing.write_frame_async(self.writer, self.send_lock, req_id, resp)
+
+            # A long transfer counts as activity
+            self.last_active = loop.time()
+
+        except ConnectionError:
+            pass
+        except Exception:
+            self.cli.log(traceback.format_exc())
+
+            # Don't leave the client waiting for a reply
+            try:
+                await framing.write_frame_async(
+                    self.writer, self.send_lock, req_id, b'internal error', framing.ERROR
+                )
+            except OSError:
+                pass
+
+    async def run(self):
+
+        loop = asyncio.get_event_loop()
+        tasks = set()
+
+        while True:
+            try:
+                frame = await framing.read_frame_async(self.reader)
+            except OSError:
+                break
+
+            if (frame is None):
+                break
+
+            self.last_active = loop.time()
+
+            req_id, _, data = frame
+
+            task = asyncio.ensure_future(self.respond(req_id, data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        for task in tasks:
+            task.cancel()
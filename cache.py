@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import threading
+
+import constant
+from track import Track
+
+class TrackCache:
+    '''
+    On-disk cache of everything `Track.from_file` computes, so
+    unchanged files skip decoding and hashing on startup.
+
+    Entries are keyed by absolute path and are only valid while the
+    file keeps the size and mtime it had when it was scanned.
+    '''
+
+    def __init__(self, db_path=constant.CACHE_FILE):
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+
+        with self.lock, self.db:
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS tracks (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime INTEGER NOT NULL,
+                    hash TEXT NOT NULL,
+                    duration REAL NOT NULL,
+                    fingerprint BLOB NOT NULL,
+                    ext TEXT,
+                    title TEXT NOT NULL,
+                    artist TEXT NOT NULL
+                )
+            ''')
+
+            # AcoustID results, a NULL title records a lookup with no match
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS metadata (
+                    fingerprint BLOB PRIMARY KEY,
+                    title TEXT,
+                    artist TEXT
+                )
+            ''')
+
+    def get(self, path: str):
+        '''
+        Return the cached Track for `path`, or `None` if there is no
+        entry or the file has changed since it was cached.
+        '''
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size, mtime, hash, duration, fingerprint, ext, title, artist '
+                'FROM tracks WHERE path = ?',
+                (os.path.abspath(path),)
+            ).fetchone()
+
+        if (row is None):
+            return None
+
+        size, mtime, file_hash, duration, fingerprint, extension, title, artist = row
+
+        # Stale entry, the file has been modified
+        if (size != stat.st_size or mtime != stat.st_mtime_ns):
+            return None
+
+        return Track(
+            title, artist, duration, file_hash, fingerprint, extension,
+            path=path, local=True
+        )
+
+    def put(self, path: str, track: Track):
+        '''
+        Store a freshly scanned track, replacing any stale entry.
+        '''
+
+        stat = os.stat(path)
+
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+                    track.hash, track.duration, track.fingerprint, track.extension,
+                    track.title, track.artist
+                )
+            )
+
+    def rename(self, file_hash: str, title: str, artist: str):
+        '''
+        Update the stored title and artist of a track.
+        '''
+
+        with self.lock, self.db:
+            self.db.execute(
+                'UPDATE tracks SET title = ?, artist = ? WHERE hash = ?',
+                (title, artist, file_hash)
+            )
+
+    def get_metadata(self, fingerprint: bytes):
+        '''
+        Return the cached (title, artist) lookup result for a
+        fingerprint, or `None` if it has never been looked up.
+        '''
+
+        with self.lock:
+            return self.db.execute(
+                'SELECT title, artist FROM metadata WHERE fingerprint = ?',
+                (fingerprint,)
+            ).fetchone()
+
+    def put_metadata(self, fingerprint: bytes, title: str, artist: str):
+
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)',
+                (fingerprint, title, artist)
+            )
+
+    def compact(self):
+        '''
+        Drop entries for files that were deleted or changed and
+        reclaim the space. Returns the number of entries removed.
+        '''
+
+        with self.lock:
+            rows = self.db.execute('SELECT path, size, mtime FROM tracks').fetchall()
+
+        stale = []
+        for path, size, mtime in rows:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale.append((path,))
+                continue
+
+            if (size != stat.st_size or mtime != stat.st_mtime_ns):
+                stale.append((path,))
+
+        with self.lock:
+            with self.db:
+                self.db.executemany('DELETE FROM tracks WHERE path = ?', stale)
+
+            self.db.execute('VACUUM')
+
+        return len(stale)
+
+    def close(self):
+
+        with self.lock:
+            self.db.close()
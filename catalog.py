@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import uuid
+
+import constant
+
+class Catalog:
+    '''
+    The tracks a node shares with its peers.
+
+    Every change bumps a version number and is remembered in a short
+    change log, so peers can ask for only what changed since the
+    version they last saw. The id changes each time the node starts,
+    which tells peers their version number no longer applies.
+    '''
+
+    def __init__(self, max_changes=constant.CATALOG_MAX_CHANGES):
+
+        self.id = uuid.uuid4().hex
+        self.version = 0
+        self.tracks = {}
+
+        # (version, hash, added)
+        self.changes = collections.deque(maxlen=max_changes)
+        self.lock = threading.Lock()
+
+    def add(self, track):
+
+        with self.lock:
+            known = track.hash in self.tracks
+            self.tracks[track.hash] = track
+
+            if (not known):
+                self.version += 1
+                self.changes.append((self.version, track.hash, True))
+
+    def update(self, file_hash):
+        '''
+        Record that a track we share changed in place, such as its
+        title and artist being identified, so peers fetch it again.
+        '''
+
+        with self.lock:
+            if (file_hash not in self.tracks):
+                return
+
+            self.version += 1
+            self.changes.append((self.version, file_hash, True))
+
+    def remove(self, file_hash):
+
+        with self.lock:
+            if (self.tracks.pop(file_hash, None) is None):
+                return
+
+            self.version += 1
+            self.changes.append((self.version, file_hash, False))
+
+    def changes_since(self, version):
+        '''
+        Return the current version along with the tracks added and
+        hashes removed since `version`, or `None` if the change log
+        no longer reaches back that far.
+        '''
+
+        with self.lock:
+
+            if (version > self.version):
+                return None
+
+            if (version < self.version and (len(self.changes) == 0 or self.changes[0][0] > version + 1)):
+                return None
+
+            added = {}
+            removed = set()
+            for change_version, file_hash, was_added in self.changes:
+                if (change_version <= version):
+                    continue
+
+                if (was_added):
+                    removed.discard(file_hash)
+                    added[file_hash] = True
+                else:
+                    added.pop(file_hash, None)
+                    removed.add(file_hash)
+
+            # Only send tracks that are still around
+            tracks = [self.tracks[file_hash] for file_hash in added if file_hash in self.tracks]
+
+            return self.version, tracks, list(removed)
+
+    def snapshot(self):
+        '''
+        Return the current version and every track.
+        '''
+
+        with self.lock:
+            return self.version, list(self.tracks.values())
+
+    def get(self, file_hash, default=None):
+
+        return self.tracks.get(file_hash, default)
+
+    def values(self):
+
+        with self.lock:
+            return list(self.tracks.values())
+
+    def __contains__(self, file_hash):
+
+        return file_hash in self.tracks
+
+    def __getitem__(self, file_hash):
+
+        return self.tracks[file_hash]
+
+    def __len__(self):
+
+        return len(self.tracks)
@@ -1,21 +1,30 @@
 import atexit
+import collections
+import collections.abc
 import curses
 import math
 import os
 import sys
+import threading
 import time
 import traceback
 
 import constant
 
+from aioserver import AsyncServer
 from client import Client
 from server import Server
 
 class CursesBox:
+    '''
+    A window with a border and an optional title.
 
-    def __init__(self, h, w, y, x, title=None, scroll=True):
+    Nothing here refreshes the screen. Drawing only marks the window
+    for the next `curses.doupdate`, which the CLI render loop calls
+    at most `constant.FRAME_RATE` times a second.
+    '''
 
-        self.title = title
+    def __init__(self, h, w, y, x, title=None, scroll=True):
 
         self.container_w = w
         self.container_h = h
@@ -24,39 +33,54 @@ class CursesBox:
         self.inner_h = h - 2
 
         self.container = curses.newwin(h, w, y, x)
+        self.set_title(title)
+
+        self.inner = curses.newwin(h - 2, w - 2, y + 1, x + 1)
+        self.inner.scrollok(scroll)
+        self.inner.noutrefresh()
+
+    def set_title(self, title):
+
+        self.title = title
+
+        self.container.erase()
         self.container.box()
 
         if (title is not None):
-            self.container.addstr(0, 1, title, curses.A_BOLD + curses.color_pair(CLI.YELLOW))
+            self.container.addnstr(0, 1, title, self.container_w - 2, curses.A_BOLD + curses.color_pair(CLI.YELLOW))
 
-        self.container.refresh()
-
-        self.inner = curses.newwin(h - 2, w - 2, y + 1, x + 1)
-        self.inner.scrollok(scroll)
-        self.inner.refresh()
+        self.container.noutrefresh()
 
     def print(self, msg='', attrs=curses.A_NORMAL, end='\n'):
-        self.inner.addstr(f'{msg}{end}', attrs)
-        self.inner.refresh()
 
-    def input(self, max_chars=constant.MAX_CHARS):
+        try:
+            self.inner.addstr(f'{msg}{end}', attrs)
+        except curses.error:
+            # Writing the bottom right corner of a window that doesn't scroll
+            pass
 
-        self.inner.addstr('>')
+        self.inner.noutrefresh()
 
-        curses.echo()
-        res = self.inner.getstr(0, 2, max_chars).decode('UTF-8')
-        curses.noecho()
-        self.inner.clear()
+    def draw_rows(self, rows):
+        '''
+        Replace the contents with one (text, attrs) row per line,
+        cut to the width of the window.
+        '''
 
-        return res
+        self.inner.erase()
 
-    def clear(self):
+        for y, (text, attrs) in enumerate(rows[:self.inner_h]):
+            try:
+                self.inner.addnstr(y, 0, text, self.inner_w, attrs)
+            except curses.error:
+                pass
+
+        self.inner.noutrefresh()
 
-        self.inner.clear()
+    def clear(self):
 
-    def refresh(self):
-        self.container.refresh()
-        self.inner.refresh()
+        self.inner.erase()
+        self.inner.noutrefresh()
 
 class CLI:
 
@@ -99,12 +123,31 @@ class CLI:
         panel_h = math.floor(avail_lines * (100 - log_percent) / 100.0)
 
         # Side by side panels
-        self.track_window = CursesBox(panel_h, cols // 2 - 1, 0, 1, 'Available Tracks:')
-        self.peer_window = CursesBox(panel_h, cols // 2, 0, cols // 2 + 1, 'Peers:')
+        self.track_window = CursesBox(panel_h, cols // 2 - 1, 0, 1, 'Available Tracks:', scroll=False)
+        self.peer_window = CursesBox(panel_h, cols // 2, 0, cols // 2 + 1, 'Peers:', scroll=False)
 
         self.log_window = CursesBox(log_h, cols - 1, avail_lines - log_h, 1, 'Status:')
         self.command_window = CursesBox(3, cols - 1, lines - command_h, 1, scroll=False)
 
+        # Keys are polled so the screen keeps updating while we wait
+        self.command_window.inner.keypad(True)
+        self.command_window.inner.timeout(int(1000 / constant.FRAME_RATE))
+        self.command = ''
+
+        # Other threads only queue changes, the main thread draws them
+        self.main_thread = threading.current_thread()
+        self.log_lines = collections.deque(maxlen=constant.LOG_BACKLOG)
+        self.pending_tracks = None
+        self.pending_peers = None
+        self.last_render = 0
+
+        # Only the rows that fit in the window are drawn
+        self.tracks = []
+        self.track_offset = 0
+
+        self.draw_command()
+        curses.doupdate()
+
         atexit.register(self.cleanup)
 
         CLI.__instance = self
@@ -112,18 +155,23 @@ class CLI:
     def run(self, port):
 
         # Start a client object to handle commands from the user
-        self.client = Client(self)
+        self.client = Client(self, port)
         self.client.should_update = False
 
+        self.client.dht.start()
         self.client.add_local_tracks()
+        self.client.watcher.start()
         self.log()
 
         # Start a server object to handle receiving connections/requests
-        self.server = Server(self, port, tracks=self.client.all_tracks, local_tracks=self.client.local_tracks)
+        server_class = AsyncServer if constant.SERVER_MODE == 'asyncio' else Server
+        self.server = server_class(self, port, tracks=self.client.all_tracks, local_tracks=self.client.local_tracks)
         self.server.start()
         self.log()
 
         self.client.restore_peers()
+        self.client.heartbeat.start()
+        self.client.gossip.start()
         self.log()
 
         self.client.should_update = True
@@ -132,40 +180,157 @@ class CLI:
         # Run forever
         while True:
             try:
-                res = self.command_window.input()
-                self.client.handle_commands(res)
+                command = self.read_command()
+                if (command is not None):
+                    self.client.handle_commands(command)
+
+                self.render()
             except Exception:
                 self.log(traceback.format_exc())
 
+    def read_command(self):
+        '''
+        Handle at most one key press, waiting no longer than a frame.
+        Returns the command once Enter is pressed, otherwise `None`.
+        '''
+
+        try:
+            key = self.command_window.inner.get_wch()
+        except curses.error:
+            # No key pressed this frame
+            return None
+
+        page = self.track_window.inner_h
+
+        if (key in ['\n', '\r', curses.KEY_ENTER]):
+            command = self.command
+            self.command = ''
+            self.draw_command()
+            return command
+
+        elif (key in ['\b', '\x7f', curses.KEY_BACKSPACE]):
+            self.command = self.command[:-1]
+
+        elif (key == curses.KEY_UP):
+            self.scroll_tracks(-1)
+        elif (key == curses.KEY_DOWN):
+            self.scroll_tracks(1)
+        elif (key == curses.KEY_PPAGE):
+            self.scroll_tracks(-page)
+        elif (key == curses.KEY_NPAGE):
+            self.scroll_tracks(page)
+        elif (key == curses.KEY_HOME):
+            self.scroll_tracks(-len(self.tracks))
+        elif (key == curses.KEY_END):
+            self.scroll_tracks(len(self.tracks))
+
+        elif (isinstance(key, str) and key.isprintable() and len(self.command) < constant.MAX_CHARS):
+            self.command += key
+
+        self.draw_command()
+        return None
+
+    def draw_command(self):
+
+        window = self.command_window
+
+        # Keep the end of a long command in view
+        visible = window.inner_w - 3
+        window.draw_rows([('> ' + self.command[-visible:], curses.A_NORMAL)])
+        window.inner.move(0, min(2 + len(self.command), window.inner_w - 1))
+
+    def scroll_tracks(self, lines):
+
+        last = max(0, len(self.tracks) - self.track_window.inner_h)
+        self.track_offset = min(max(0, self.track_offset + lines), last)
+        self.draw_tracks()
+
+    def render(self, force=False):
+        '''
+        Draw everything queued since the last frame and update the
+        screen once. Only runs on the main thread, and no more than
+        `constant.FRAME_RATE` times a second unless forced.
+        '''
+
+        if (threading.current_thread() is not self.main_thread):
+            return
+
+        now = time.monotonic()
+        if (not force and now - self.last_render < 1.0 / constant.FRAME_RATE):
+            return
+
+        self.last_render = now
+
+        # Lines that would scroll straight off the window aren't drawn
+        lines = []
+        while len(self.log_lines) > 0:
+            lines.append(self.log_lines.popleft())
+
+        for msg, color in lines[-self.log_window.inner_h:]:
+            self.log_window.print(msg, curses.color_pair(color), end='')
+
+        tracks = self.pending_tracks
+        if (tracks is not None):
+            try:
+                # Sequences read tracks from disk a page at a time, don't copy them
+                self.tracks = tracks if isinstance(tracks, collections.abc.Sequence) else list(tracks)
+                self.pending_tracks = None
+            except RuntimeError:
+                # Changed while we copied it, try again next frame
+                pass
+            else:
+                self.scroll_tracks(0)
+
+        peers = self.pending_peers
+        if (peers is not None):
+            self.pending_peers = None
+            self.peer_window.draw_rows([
+                (str(peer), curses.color_pair(CLI.GREEN if peer.connected else CLI.RED))
+                for peer in peers
+            ])
+
+        # Leave the cursor in the command box
+        self.draw_command()
+
+        curses.doupdate()
+
     def log(self, msg='', color=WHITE, end='\n'):
 
-        self.log_window.print(msg, attrs=curses.color_pair(color), end=end)
+        self.log_lines.append((f'{msg}{end}', color))
+
+        # Startup runs on the main thread before the input loop
+        self.render()
 
     def update_available_tracks(self, track_list):
         '''
-        Update the list of available tracks.
+        Update the list of available tracks. The list is copied and
+        drawn on the next frame.
         '''
 
-        self.track_window.clear()
+        self.pending_tracks = track_list
 
-        for track in track_list:
-            if (track.local):
-                self.track_window.print(track, curses.color_pair(CLI.GREEN))
-            else:
-                self.track_window.print(track)
+    def draw_tracks(self):
+
+        window = self.track_window
+        visible = self.tracks[self.track_offset:self.track_offset + window.inner_h]
+
+        window.draw_rows([
+            (str(track), curses.color_pair(CLI.GREEN) if track.local else curses.A_NORMAL)
+            for track in visible
+        ])
+
+        if (len(self.tracks) > window.inner_h):
+            last = self.track_offset + len(visible)
+            window.set_title(f'Available Tracks ({self.track_offset + 1}-{last} of {len(self.tracks)}):')
+        else:
+            window.set_title('Available Tracks:')
 
     def update_connected_peers(self, peer_list):
         '''
-        Update the list of peers.
+        Update the list of peers, drawn on the next frame.
         '''
 
-        self.peer_window.clear()
-
-        for peer in peer_list:
-            if (peer.connected):
-                self.peer_window.print(peer, curses.color_pair(CLI.GREEN))
-            else:
-                self.peer_window.print(peer, curses.color_pair(CLI.RED))
+        self.pending_peers = list(peer_list)
 
     def cleanup(self):
 
@@ -184,10 +349,12 @@ if (__name__ == '__main__'):
 
     # Check if port number is specified
     if (len(sys.argv) < 2):
-        print('usage: ./cli.py port [folder]')
+        print('usage: ./cli.py PORT [CONTENT_PATH ...]')
         sys.exit()
 
+    # Downloads go in the first content folder
     if (len(sys.argv) >= 3):
+        constant.CONTENT_PATHS = sys.argv[2:]
         constant.FILE_PREFIX = sys.argv[2]
 
     cli = CLI.get_instance()
@@ -4,25 +4,64 @@ import atexit
 import os
 import socket
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError, as_completed
 
 import constant
-from peer import Peer
-from track import Track
+import scanner
+from cache import TrackCache
+from catalog import Catalog
+from dht import DHT
+from gossip import Gossip, address
+from heartbeat import Heartbeat
+from jobs import JobManager
+from metadata import AcoustIDBackend, MetadataResolver
+from peer import Peer, downloads
+from ratelimit import format_rate, parse_rate
+from search import SearchIndex
+from server import uploads
+from similarity import FingerprintIndex, decode_fingerprint
+from swarm import SwarmDownload
+from track import Track, intern
+from trackstore import open_track_store
+from verify import Verifier
+from watcher import Watcher
 
 class Client:
 
-    def __init__(self, cli):
+    def __init__(self, cli, port):
         self.connections = {}
         self.cli = cli
 
-        self.all_tracks = {}
-        self.all_tracks_sh = {} # Short hash
-        self.local_tracks = {}
+        # Peers we connected to because the DHT or gossip pointed us
+        # at them, never saved and dropped once they go away
+        self.transient = set()
+        self.port = port # Where our server listens, told to peers
+
+        self.all_tracks = open_track_store()
+        self.search = SearchIndex(self.all_tracks) # By words, duration and hash prefix
+        self.local_tracks = Catalog()
+        self.similarity = FingerprintIndex(self.all_tracks) # By how they sound
 
         self.should_update = True
 
+        self.cache = TrackCache()
+
+        backend = None if constant.ACOUSTID_OFFLINE else AcoustIDBackend()
+        self.resolver = MetadataResolver(cli, backend, self.resolve_metadata, cache=self.cache)
+
+        self.heartbeat = Heartbeat(self)
+        self.gossip = Gossip(self)
+        self.dht = DHT(cli, port) # Who has which track, beyond our peers
+        self.verifier = Verifier(cli, self.finish_download)
+        self.jobs = JobManager(cli)
+        self.watcher = Watcher(self)
+
+        # Files being downloaded or verified, the watcher leaves them alone
+        self.downloading = set()
+
         # Make sure the connection list gets stored to disk
-        atexit.register(lambda: Peer.dump_to_disk(self.connections.values()))
+        atexit.register(lambda: Peer.dump_to_disk([peer for peer in self.connections.values() if peer not in self.transient]))
 
     def add_tracks(self, track_list):
         '''
@@ -31,34 +70,75 @@ class Client:
 
         for track in track_list:
 
-            short_hash = track.short_hash()
+            file_hash = track.hash
+            known = self.all_tracks.get(file_hash)
+
+            if (known is None or track.local):
+                # Remember every peer that has the track
+                if (known is not None):
+                    track.peers |= known.peers
 
-            # Watch for hash collisions but don't chain for now
-            if (short_hash in self.all_tracks_sh):
-                if (self.all_tracks_sh[short_hash].hash != track.hash):
-                    self.cli.log('HASH COLLISION!!!')
+                self.all_tracks[file_hash] = track
+                self.search.add(track)
 
-            # Don't overwrite the local track info that we have
-            if (
-                track.local
-                or
-                track.hash not in self.all_tracks
-                or
-                not self.all_tracks[track.hash].local
-            ):
-                self.all_tracks[track.hash] = track
-                self.all_tracks_sh[short_hash] = track
+            else:
+                # Another listing of a track we know, keep the one copy
+                known.peers |= track.peers
+
+                # Don't overwrite the local track info that we have
+                if (not known.local and (known.title, known.artist) != (track.title, track.artist)):
+                    known.title = track.title
+                    known.artist = track.artist
+                    self.search.add(known)
+
+                self.all_tracks[file_hash] = known
 
             if (track.local):
-                self.local_tracks[track.hash] = track
+                self.local_tracks.add(track)
+                self.dht.publish(file_hash)
+
+            if (file_hash not in self.similarity):
+                self.similarity.add(file_hash, decode_fingerprint(track.fingerprint))
 
         self.update_tracks()
 
-    def add_local_tracks(self):
+    def remove_tracks(self, peer, hashes):
+        '''
+        Remove tracks that `peer` no longer has.
+        '''
+
+        for file_hash in hashes:
+
+            track = self.all_tracks.get(file_hash)
+            if (track is None):
+                continue
+
+            track.peers.discard(peer)
+
+            # Keep the entry while anyone else still has it
+            if (track.local or len(track.peers) > 0):
+                if (track.peer == peer):
+                    track.peer = next(iter(track.peers), None)
+
+                self.all_tracks[file_hash] = track
+                continue
+
+            del self.all_tracks[file_hash]
+            self.search.remove(file_hash)
+            self.similarity.remove(file_hash)
+
+        if (len(hashes) > 0):
+            self.update_tracks()
+
+    def add_local_tracks(self, workers=constant.SCAN_WORKERS):
         '''
-        Scan the content folder and add local tracks.
+        Scan the content folders and add local tracks.
 
-        This only scans the top level folder. No subdirectories.
+        Every folder in `constant.CONTENT_PATHS` is searched however
+        deep, skipping files that match the exclude globs or don't
+        look like audio. Files that aren't cached are fingerprinted
+        on a pool of `workers` processes and added as soon as each
+        one is done. Later changes are picked up by the watcher.
         '''
 
         # Create a bogus track to fix the issue
@@ -66,35 +146,385 @@ class Client:
         # This trigger the delayed import of CLI
         t = Track('', '', 0, '', b'', '')
 
-        self.cli.log(f"Checking directory '{constant.FILE_PREFIX}' for media... ")
+        for root in constant.CONTENT_PATHS:
+            self.cli.log(f"Checking directory '{root}' for media... ")
+
+        self.index_files(scanner.walk(constant.CONTENT_PATHS), workers)
+
+        self.cli.log('Done')
+
+    def index_files(self, paths, workers=constant.SCAN_WORKERS):
+        '''
+        Add the given files as local tracks, fingerprinting the ones
+        that aren't cached.
+        '''
 
-        # Only check 1 level deep
         tracks = []
-        files = os.listdir(constant.FILE_PREFIX)
-        for file in files:
-            if (os.path.isfile(os.path.join(constant.FILE_PREFIX, file))):
-                self.cli.log(f"Processing '{file}'...")
-                tracks.append(Track.from_file(file))
+        uncached = []
+        skipped = 0
+        for path in paths:
+            if (not os.path.isfile(path) or not scanner.is_wanted(path)):
+                continue
+
+            # Skip decoding and hashing for files we've already seen
+            track = self.cache.get(path)
+            if (track is not None):
+                tracks.append(track)
+
+            # Don't start a decoder for cover art and the like
+            elif (scanner.is_audio(path)):
+                uncached.append(path)
+
+            else:
+                skipped += 1
+
+        if (skipped > 0):
+            self.cli.log(f'Skipped {skipped} files that are not audio')
 
         self.add_tracks(tracks)
 
-        self.cli.log('Done')
+        for track in tracks:
+            self.resolver.submit(track)
+
+        if (len(uncached) > 0):
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+
+                futures = {}
+                for path in uncached:
+                    self.cli.log(f"Processing '{path}'...")
+                    future = pool.submit(Track.from_file, path)
+                    futures[future] = path
+
+                for future in as_completed(futures):
+                    path = futures[future]
+
+                    try:
+                        track = future.result()
+                    except Exception as e:
+                        self.cli.log(f"Failed to process '{path}': {e}")
+                        continue
+
+                    self.cache.put(path, track)
+                    self.add_tracks([track])
+                    self.resolver.submit(track)
+
+    def update_local_files(self, paths):
+        '''
+        Called by the watcher with files in the content folders that
+        were added, changed or deleted since they were last indexed.
+        '''
+
+        local = {track.path: track for track in self.local_tracks.values()}
+
+        changed = []
+        for path in paths:
+
+            # Downloads are added once they've been verified
+            if (path in self.downloading):
+                continue
+
+            exists = os.path.isfile(path)
+
+            track = local.get(path)
+            if (track is not None):
+                cached = self.cache.get(path) if exists else None
+                if (cached is not None and cached.hash == track.hash):
+                    continue
+
+                self.cli.log(f"'{path}' was {'changed' if exists else 'deleted'}")
+                self.remove_local_track(track)
+
+            if (exists):
+                changed.append(path)
+
+        if (len(changed) > 0):
+            self.index_files(changed)
+
+        self.update_tracks()
+
+    def remove_local_track(self, track):
+        '''
+        Stop sharing a track whose file is gone. Peers see it removed
+        the next time they fetch our track list.
+        '''
+
+        self.local_tracks.remove(track.hash)
+        self.dht.unpublish(track.hash)
+
+        track.local = False
+        track.path = None
+
+        # Keep the entry while a peer still has it
+        if (len(track.peers) > 0):
+            self.all_tracks[track.hash] = track
+            return
+
+        self.all_tracks.pop(track.hash, None)
+        self.search.remove(track.hash)
+        self.similarity.remove(track.hash)
+
+    def download_track(self, track, job=None):
+        '''
+        Download a track from the peers that have it. With more than
+        one connected peer the pieces are fetched from all of them.
+        Progress and cancellation go through `job` when the download
+        runs in the background.
+        '''
+
+        if (track.local):
+            self.cli.log(f'Track {track.short_hash()} is already local')
+            return False
+
+        self.locate(track.hash, track)
+
+        peers = [peer for peer in track.peers if peer.is_connected()]
+
+        if (len(peers) == 0):
+            self.cli.log('Download failed: no connected peer has the track')
+            return False
+
+        trusted = [peer for peer in peers if peer.is_trusted()]
+        if (len(trusted) == 0):
+            self.cli.log('Download failed: every peer with the track has sent bad tracks before')
+            return False
+
+        path = os.path.join(constant.FILE_PREFIX, f'{track.hash}.{track.extension}')
+        self.downloading.add(path)
+
+        try:
+            if (len(trusted) == 1):
+                success = trusted[0].request_track(track, job)
+            else:
+                success = SwarmDownload(self.cli, track, trusted, job).run()
+        except:
+            self.downloading.discard(path)
+            raise
+
+        # Only shared once it's known to be the song it claims to be
+        if (success):
+            self.verifier.submit(track, trusted)
+        else:
+            self.downloading.discard(path)
+
+        return success
+
+    def locate(self, file_hash, track=None):
+        '''
+        Look up who has a track in the DHT and connect to them. Peers
+        found are added to `track` if it's given. Returns the peers.
+        '''
+
+        holders = self.dht.lookup(file_hash)
+
+        connected = {address(peer): peer for peer in list(self.connections.values())}
+
+        found = []
+        for host, port in holders:
+            peer = connected.get((host, port))
 
-    def do_track_list_update(self):
+            if (peer is None):
+                peer = Peer(self.cli, host, port)
+                if (not peer.connect()):
+                    continue
+
+                self.transient.add(peer)
+                self.connections[peer] = peer
+
+            elif (not peer.is_connected() and not peer.connect()):
+                continue
+
+            found.append(peer)
+            if (track is not None):
+                track.peers.add(peer)
+                self.all_tracks[file_hash] = track
+
+        if (len(holders) > 0):
+            self.cli.log(f'{len(found)} of {len(holders)} peers with {file_hash[:constant.HASH_LEN]} are reachable')
+            self.update_peers()
+
+        return found
+
+    def fetch_track(self, file_hash, job=None):
+        '''
+        Download a track we haven't seen in any track list, given its
+        full hash. Its details come from the track lists of the peers
+        the DHT says have it.
+        '''
+
+        peers = self.locate(file_hash)
+        if (len(peers) == 0):
+            self.cli.log(f'Nobody has {file_hash[:constant.HASH_LEN]}')
+            return False
+
+        for peer in peers:
+            self.sync_peer(peer)
+
+        track = self.all_tracks.get(file_hash)
+        if (track is None):
+            self.cli.log(f"Peers don't list {file_hash[:constant.HASH_LEN]} anymore")
+            return False
+
+        return self.download_track(track, job)
+
+    def finish_download(self, track, peers, ok):
+        '''
+        Called by the verifier once a downloaded track has been checked.
+        '''
+
+        if (ok):
+            for peer in peers:
+                peer.reward()
+
+            # Share the new track with our peers
+            self.cache.put(track.path, track)
+            self.local_tracks.add(track)
+            self.dht.publish(track.hash)
+
+        elif (ok is None):
+            # Kept for us in the unverified folder, which is never shared
+            self.cli.log(f"Track {track.short_hash()} is kept in '{constant.UNVERIFIED_FOLDER}' but not shared")
+
+        else:
+            for peer in peers:
+                peer.penalize()
+
+            # The file is in quarantine, so it can be fetched again from someone else
+            track.local = False
+            track.path = None
+
+        self.all_tracks[track.hash] = track
+
+        self.downloading.discard(os.path.join(constant.FILE_PREFIX, f'{track.hash}.{track.extension}'))
+
+        self.update()
+
+    def find_track(self, prefix):
+        '''
+        Look up a track by any prefix of its hash. Logs why and returns
+        `None` if no track or more than one track matches.
+        '''
+
+        matches = self.search.hash_prefix(prefix)
+
+        if (len(matches) == 0):
+            self.cli.log(f'No track {prefix}')
+            return None
+
+        if (len(matches) > 1):
+            self.cli.log(f'{prefix} matches more than one track, type more of the hash:')
+            for track in self.search.hash_prefix(prefix, limit=constant.SEARCH_LIMIT):
+                self.cli.log(f'  [{self.search.unique_prefix(track.hash)}] {track.title} -- {track.artist}')
+            return None
+
+        return matches[0]
+
+    def search_tracks(self, query):
+        '''
+        Log the tracks that best match a search query.
+        '''
+
+        start = time.perf_counter()
+        results = self.search.search(query)
+        elapsed = time.perf_counter() - start
+
+        self.cli.log(f"{len(results)} results for '{query}' ({elapsed * 1000:.2f} ms)")
+
+        for track in results:
+            minutes, seconds = divmod(int(track.duration), 60)
+            color = self.cli.GREEN if track.local else self.cli.WHITE
+            self.cli.log(f'  [{self.search.unique_prefix(track.hash)}] {track.title} -- {track.artist} ({minutes}:{seconds:02d})', color)
+
+        return results
+
+    def find_similar(self, track):
+        '''
+        Log the known tracks that sound like `track`, such as the same
+        recording in another format or at another bitrate.
+        '''
+
+        matches = self.similarity.similar_to(track.hash)
+
+        # A track may have left the network since
+        matches = [match for match in matches if match[0] in self.all_tracks]
+
+        if (len(matches) == 0):
+            self.cli.log(f'No tracks sound like {track.short_hash()}')
+            return []
+
+        self.cli.log(f'Tracks that sound like {track.short_hash()}:')
+        for file_hash, score in matches:
+            self.cli.log(f'  {self.all_tracks[file_hash]} ({score:.0%} match)')
+
+        return matches
+
+    def resolve_metadata(self, track, title, artist):
+        '''
+        Called by the metadata resolver when a track is identified.
+        '''
+
+        changed = (track.title, track.artist) != (title, artist)
+
+        track.title = intern(title)
+        track.artist = intern(artist)
+
+        # Peers that already have our list only see it in the next delta
+        if (changed and track.local):
+            self.local_tracks.update(track.hash)
+
+        self.all_tracks[track.hash] = track
+        self.search.add(track)
+
+        self.cache.rename(track.hash, title, artist)
+        self.update_tracks()
+
+    def do_track_list_update(self, deadline=constant.TRACK_LIST_DEADLINE_S, job=None):
         '''
         Query all peers for an updated track list.
+
+        Every connected peer is asked at once and results are added
+        as they arrive. Peers that haven't answered within `deadline`
+        seconds are skipped. A cancelled `job` stops taking results.
         '''
 
-        for peer in self.connections.values():
+        peers = [peer for peer in self.connections.values() if peer.is_connected()]
+        if (len(peers) == 0):
+            return
+
+        pool = ThreadPoolExecutor(max_workers=len(peers))
+        futures = {pool.submit(peer.request_track_list): peer for peer in peers}
 
-            if (peer.is_connected()):
-                tracks = peer.request_track_list()
+        if (job is not None):
+            job.set_total(len(peers), in_bytes=False)
+
+        try:
+            for future in as_completed(futures, timeout=deadline):
+                peer = futures[future]
 
-                if (tracks is None):
+                if (job is not None):
+                    if (job.cancelled()):
+                        break
+                    job.advance(1)
+
+                try:
+                    changes = future.result()
+                except Exception as e:
+                    self.cli.log(f'Track list from {peer} failed: {e}')
+                    continue
+
+                if (changes is None):
                     continue
 
+                tracks, removed = changes
+                self.remove_tracks(peer, removed)
                 self.add_tracks(tracks)
 
+        except TimeoutError:
+            late = [str(futures[future]) for future in futures if not future.done()]
+            self.cli.log(f"No track list before the deadline from {', '.join(late)}")
+
+        # Don't wait on stragglers, their sockets time out on their own
+        pool.shutdown(wait=False)
+
         self.update_tracks()
 
     def restore_peers(self):
@@ -119,22 +549,24 @@ class Client:
 
         if (method == 'remove' and peer not in self.connections):
             self.cli.log(f'Invalid command: not connected to {peer}')
+            return
 
         # The peer coming in could be a temporary peer to attempt look up the real Peer
         # The real Peer will actually have the TCP connection if one is open
         # Otherwise it will indicate that it isn't connected
         peer = self.connections.get(peer, peer)
 
-        # Make sure the connection is actually alive
-        peer.ping()
-
-        # peer.is_connected() is now REAL result of whether peer is actually connected
+        # Liveness is kept up to date by the heartbeat, no need to ping here
 
         if (method == 'remove'):
             peer.disconnect()
             del self.connections[peer]
+            self.transient.discard(peer)
 
         elif (method == 'add'):
+            # Added by hand, so it's kept from now on
+            self.transient.discard(peer)
+
             if (peer.is_connected()):
                 self.cli.log(f'Peer {peer} is already connected')
             else:
@@ -143,14 +575,117 @@ class Client:
                 self.connections[peer] = peer
 
                 if (success):
+                    self.sync_peer(peer)
+
+        self.update_peers()
+
+    def forget_peer(self, peer):
+        '''
+        Drop a transient peer that went away, along with its tracks.
+        '''
 
-                    # Get the new tracks
-                    tracks = peer.request_track_list()
-                    if (tracks is not None):
-                        self.add_tracks(tracks)
+        self.transient.discard(peer)
+        self.connections.pop(peer, None)
+        self.remove_tracks(peer, set(peer.track_hashes))
+
+        self.update()
+
+    def add_peer(self, host, port):
+        '''
+        Connect to a peer heard of through gossip, unless we already
+        know it or know as many peers as we keep. Anyone can gossip an
+        address, so it's only kept if it connects, and only until it
+        goes away.
+        '''
+
+        peer = Peer(self.cli, host, port)
+
+        if (address(peer) in set(address(known) for known in list(self.connections))):
+            return
+
+        if (len(self.connections) >= constant.MAX_PEERS):
+            return
+
+        if (not peer.connect()):
+            return
+
+        self.transient.add(peer)
+        self.connections[peer] = peer
+        self.sync_peer(peer)
 
         self.update_peers()
 
+    def sync_peer(self, peer):
+        '''
+        Swap known peers with a peer and fetch the changes to its
+        track list.
+        '''
+
+        self.gossip.state.learn_peers(peer.request_peers(self.port))
+
+        # Join the DHT through whoever we know while our table is small
+        if (len(self.dht.table) < constant.DHT_K):
+            self.dht.workers.submit(self.dht.bootstrap, peer.host, peer.port)
+
+        changes = peer.request_track_list()
+        if (changes is not None):
+            tracks, removed = changes
+            self.remove_tracks(peer, removed)
+            self.add_tracks(tracks)
+
+            self.gossip.synced(peer)
+
+    def bandwidth(self, args):
+        '''
+        Show or change the bandwidth limits.
+        '''
+
+        usage = [
+            'Usage:',
+            '  bw',
+            '  bw up|down [peer] RATE|off',
+            '  bw weight HOST N'
+        ]
+
+        schedulers = {'up': uploads, 'down': downloads}
+
+        if (len(args) == 0):
+            for name, scheduler in schedulers.items():
+                self.cli.log(f'{name}: {format_rate(scheduler.rate)}, {format_rate(scheduler.peer_rate)} per peer')
+
+                for host, weight, rate, total in scheduler.stats():
+                    self.cli.log(f'  {host:15s} weight {weight:<4g} {format_rate(rate):>12s}  {total >> 20} MB total')
+            return
+
+        try:
+            if (args[0] in schedulers and len(args) == (3 if args[1:2] == ['peer'] else 2)):
+                rate = parse_rate(args[-1])
+
+                if (len(args) == 2):
+                    schedulers[args[0]].set_rates(rate=rate)
+                    self.cli.log(f'{args[0]}: {format_rate(rate)}')
+                else:
+                    schedulers[args[0]].set_rates(peer_rate=rate)
+                    self.cli.log(f'{args[0]}: {format_rate(rate)} per peer')
+                return
+
+            if (args[0] == 'weight' and len(args) == 3):
+                weight = float(args[2])
+                if (weight <= 0):
+                    raise ValueError('weights must be positive')
+
+                for scheduler in schedulers.values():
+                    scheduler.set_weight(args[1], weight)
+                self.cli.log(f'{args[1]} now has weight {weight:g}')
+                return
+
+        except ValueError as e:
+            self.cli.log(f'Invalid value: {e}')
+            return
+
+        for line in usage:
+            self.cli.log(line)
+
     def update(self):
         self.update_tracks()
         self.update_peers()
@@ -172,7 +707,18 @@ class Client:
             self.cli.log('  peer remove HOST:PORT')
 
             self.cli.log('  track list')
-            self.cli.log('  track get SHORT_HASH')
+            self.cli.log('  track search QUERY')
+            self.cli.log('  track get HASH_PREFIX')
+            self.cli.log('  track similar HASH_PREFIX')
+
+            self.cli.log('  jobs')
+            self.cli.log('  cancel ID')
+
+            self.cli.log('  cache compact')
+
+            self.cli.log('  bw')
+            self.cli.log('  bw up|down [peer] RATE|off')
+            self.cli.log('  bw weight HOST N')
             return
 
         elif (command == 'exit' or command == 'quit'):
@@ -196,27 +742,78 @@ class Client:
                 self.peer_manipulate(peer, tokens[1])
 
         elif (tokens[0] == 'track'):
-            if (len(tokens) < 2 or tokens[1] not in ['list', 'get'] or (tokens[1] == 'get' and len(tokens) < 3)):
+            if (len(tokens) < 2 or tokens[1] not in ['list', 'search', 'get', 'similar'] or (tokens[1] != 'list' and len(tokens) < 3)):
                 self.cli.log('Usage:')
                 self.cli.log('  track list')
-                self.cli.log('  track get SHORT_HASH')
+                self.cli.log('  track search QUERY')
+                self.cli.log('  track get HASH_PREFIX')
+                self.cli.log('  track similar HASH_PREFIX')
 
             elif (tokens[1] == 'list'):
 
-                self.do_track_list_update()
+                self.jobs.submit('track list', self.do_track_list_update)
+
+            elif (tokens[1] == 'search'):
+
+                self.search_tracks(' '.join(tokens[2:]))
 
             elif (tokens[1] == 'get'):
 
-                short_hash = tokens[2]
+                file_hash = tokens[2].lower()
+
+                # A full hash can be found through the DHT even if no peer listed it
+                if (len(file_hash) == 64 and file_hash not in self.all_tracks and all(c in '0123456789abcdef' for c in file_hash)):
+                    job = self.jobs.submit(f'find {file_hash[:constant.HASH_LEN]}', self.fetch_track, file_hash, key=file_hash)
+                    if (job is None):
+                        self.cli.log(f'Track {file_hash[:constant.HASH_LEN]} is already downloading')
+                    return
 
-                if (len(short_hash) != constant.HASH_LEN):
-                    self.cli.log(f'SHORT_HASH should be the {constant.HASH_LEN} character prefix to the left of the track')
+                track = self.find_track(tokens[2])
+                if (track is None):
                     return
 
-                track = self.all_tracks_sh[short_hash]
-                track.download(self.cli)
+                # Two downloads of one track would share a part file
+                job = self.jobs.submit(f'get {track}', self.download_track, track, key=track.hash)
+                if (job is None):
+                    self.cli.log(f'Track {track.short_hash()} is already downloading')
+
+            elif (tokens[1] == 'similar'):
+
+                track = self.find_track(tokens[2])
+                if (track is None):
+                    return
+
+                self.find_similar(track)
+
+        elif (tokens[0] == 'jobs'):
+
+            jobs = self.jobs.values()
+            if (len(jobs) == 0):
+                self.cli.log('No jobs')
+
+            for job in jobs:
+                self.cli.log(f'  {job}')
+
+        elif (tokens[0] == 'cancel'):
+            if (len(tokens) < 2 or not tokens[1].isdigit()):
+                self.cli.log('usage: cancel ID')
+
+            elif (self.jobs.cancel(int(tokens[1]))):
+                self.cli.log(f'Cancelling job {tokens[1]}')
+
+            else:
+                self.cli.log(f'No running job {tokens[1]}')
+
+        elif (tokens[0] == 'cache'):
+            if (len(tokens) < 2 or tokens[1] != 'compact'):
+                self.cli.log('usage: cache compact')
+
+            else:
+                removed = self.cache.compact()
+                self.cli.log(f'Removed {removed} stale cache entries')
 
-                self.update_tracks()
+        elif (tokens[0] == 'bw'):
+            self.bandwidth(tokens[1:])
 
         else:
             self.cli.log('Invalid command. Type "help" for available commands')
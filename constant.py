@@ -10,4 +10,73 @@ API_KEY = secrets["API_KEY"]
 FILE_PREFIX = 'content'
 MAX_CHARS = 100
 HASH_LEN = 4
-MAX_SOCK_READ = 8012
+STREAM_CHUNK = 65536
+MAX_FRAME = 64 * 1024 * 1024 # Bigger frames from a peer drop the connection
+CACHE_FILE = 'cache.db'
+SCAN_WORKERS = None # One process per core
+ACOUSTID_URL = 'https://api.acoustid.org/v2/lookup'
+ACOUSTID_OFFLINE = False
+ACOUSTID_RATE = 3 # Requests per second
+ACOUSTID_BATCH = 10
+ACOUSTID_RETRY_S = 60
+TRACK_LIST_DEADLINE_S = 6
+CATALOG_MAX_CHANGES = 4096
+SERVER_MODE = 'threaded' # Or 'asyncio'
+MAX_CONNECTIONS = 512
+IDLE_TIMEOUT_S = 600
+PIECE_SIZE = 1024 * 1024
+MAX_BAD_PIECES = 3 # Per peer, per download
+PEER_POOL_SIZE = 4
+CONNECT_TIMEOUT_S = 3
+HEARTBEAT_S = 10
+RECONNECT_MIN_S = 2
+RECONNECT_MAX_S = 300
+SERVER_WORKERS = 32
+CONTROL_WORKERS = 8 # Answer requests other than files, never rate limited
+SIMILARITY_THRESHOLD = 0.8 # Fraction of matching fingerprint bits
+INDEX_SUBWORDS = 120 # About 15 seconds of audio
+INDEX_MAX_POSTINGS = 1000
+INDEX_MIN_VOTES = 0.1
+VERIFY_WORKERS = 2
+VERIFY_DURATION_S = 2 # Allowed difference from the advertised duration
+QUARANTINE_FOLDER = 'quarantine'
+UNVERIFIED_FOLDER = 'unverified' # Downloads that couldn't be checked, never shared
+VERIFY_PENALTY = 10
+MIN_REPUTATION = -20 # Peers below this aren't downloaded from
+JOB_WORKERS = 4 # Commands that can run at once
+JOB_HISTORY = 50 # Finished jobs kept for the jobs command
+FRAME_RATE = 20 # Screen updates per second
+LOG_BACKLOG = 1000 # Status lines queued between frames
+WATCH_DEBOUNCE_S = 2 # Quiet time before a changed file is indexed
+WATCH_POLL_S = 5 # When inotify isn't available
+CONTENT_PATHS = [FILE_PREFIX] # Scanned recursively, downloads go to FILE_PREFIX
+INCLUDE_GLOBS = [] # Index only matching files, e.g. ['*.mp3', '*.flac']
+EXCLUDE_GLOBS = ['.*'] # Matched against file and folder names and full paths
+SEARCH_LIMIT = 20
+SEARCH_MAX_EXPANSIONS = 50 # Words a query word can be a prefix of
+SEARCH_DURATION_S = 2 # Slack when searching by m:ss
+GOSSIP_S = 5
+GOSSIP_FANOUT = 3
+GOSSIP_TTL = 6 # Hops a digest travels
+GOSSIP_REFRESH = 4 # Rounds between full digest exchanges with one peer
+GOSSIP_MIN_PEERS = 4 # Connect to peers we've heard of below this
+MAX_PEERS = 32
+GOSSIP_PEERS_SENT = 20 # Addresses handed out per peer exchange
+DHT_K = 8 # Nodes a key is stored on, and bucket size
+DHT_ALPHA = 3 # Queries in flight during a lookup
+DHT_TIMEOUT_S = 1
+DHT_VALUE_TTL_S = 3600
+DHT_REPUBLISH_S = 1200
+DHT_MAX_VALUES = 50 # Holders kept and returned for one key
+DHT_MAX_KEYS = 100000 # Keys stored for other nodes
+TRACK_STORE = 'memory' # 'sqlite' keeps peers' tracks on disk, for huge networks
+TRACK_STORE_FILE = 'tracks.db'
+FILE_CACHE_BYTES = 512 * 1024 * 1024 # Total size of files kept open for serving
+FILE_CACHE_FILES = 64
+BW_UP = 0 # Bytes per second we upload, 0 is unlimited
+BW_DOWN = 0
+BW_PEER_UP = 0 # Per host
+BW_PEER_DOWN = 0
+BW_BURST_S = 0.25 # Traffic a limit lets through at once
+BW_POLL_S = 0.05
+BW_HALF_LIFE_S = 2 # Of the rates the bw command shows
@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import constant
+
+ID_BITS = 256
+
+def distance(a, b):
+
+    return a ^ b
+
+class Contact:
+    '''
+    Another DHT node: its id and the address it listens on.
+    '''
+
+    def __init__(self, node_id, host, port):
+
+        self.id = node_id
+        self.host = host
+        self.port = int(port)
+
+    def to_tuple(self):
+
+        return (self.host, self.port)
+
+    def to_json(self):
+
+        return [f'{self.id:064x}', self.host, self.port]
+
+    @staticmethod
+    def from_json(data):
+
+        node_id, host, port = data
+        return Contact(int(node_id, 16), host, port)
+
+    def __eq__(self, other):
+
+        return self.id == other.id
+
+    def __hash__(self):
+
+        return hash(self.id)
+
+    def __str__(self):
+
+        return f'{self.host}:{self.port}'
+
+class RoutingTable:
+    '''
+    One bucket of at most `k` contacts for each bit of distance from
+    our id, least recently seen first.
+
+    Nodes that answer stay in their bucket, so a full bucket keeps
+    its long-lived contacts and newcomers are only let in once
+    someone times out.
+    '''
+
+    def __init__(self, node_id, k=constant.DHT_K):
+
+        self.id = node_id
+        self.k = k
+        self.buckets = [[] for _ in range(ID_BITS)]
+        self.lock = threading.Lock()
+
+    def bucket(self, node_id):
+
+        return self.buckets[distance(self.id, node_id).bit_length() - 1]
+
+    def update(self, contact):
+        '''
+        Note that we heard from a contact.
+        '''
+
+        if (contact.id == self.id):
+            return
+
+        with self.lock:
+            bucket = self.bucket(contact.id)
+
+            if (contact in bucket):
+                bucket.remove(contact)
+                bucket.append(contact)
+
+            elif (len(bucket) < self.k):
+                bucket.append(contact)
+
+    def remove(self, contact):
+
+        with self.lock:
+            bucket = self.bucket(contact.id)
+            if (contact in bucket):
+                bucket.remove(contact)
+
+    def closest(self, key, count=None):
+        '''
+        The `count` contacts closest to `key`.
+        '''
+
+        with self.lock:
+            contacts = [contact for bucket in self.buckets for contact in bucket]
+
+        contacts.sort(key=lambda contact: distance(contact.id, key))
+
+        return contacts[:self.k if count is None else count]
+
+    def __len__(self):
+
+        return sum(len(bucket) for bucket in self.buckets)
+
+class DHT:
+    '''
+    Kademlia distributed hash table mapping track hashes to the
+    peers that have them.
+
+    Each node gets a random 256-bit id and track hashes are used as
+    keys directly. A key is stored on the `k` nodes whose ids are
+    closest to it by XOR distance. Lookups ask the closest nodes we
+    know for ones closer still, `alpha` at a time, which takes
+    O(log n) rounds of queries on a network of n nodes.
+
+    Messages are JSON over UDP on the same port number as the track
+    server, and the value stored for a key is the address the
+    publishing node was heard from.
+    '''
+
+    def __init__(self, cli, port, node_id=None,
+        k=constant.DHT_K,
+        alpha=constant.DHT_ALPHA,
+        timeout=constant.DHT_TIMEOUT_S
+    ):
+
+        self.cli = cli
+        self.port = port
+        self.id = int.from_bytes(os.urandom(ID_BITS // 8), 'big') if node_id is None else node_id
+        self.k = k
+        self.alpha = alpha
+        self.timeout = timeout
+
+        self.table = RoutingTable(self.id, k)
+
+        # Key -> {(host, port): expiry time}, both oldest first
+        self.values = {}
+        self.values_lock = threading.Lock()
+
+        # Keys we publish and keep republishing
+        self.published = set()
+
+        # Transaction id -> [event, reply]
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.next_tx = 0
+
+        # Stores and joins, which wait on queries of their own
+        self.workers = ThreadPoolExecutor(max_workers=4 * alpha)
+
+        # Single queries to one contact. They never wait on anything
+        # in a pool, so sharing one with the work above would let a
+        # burst of stores take every thread and wait forever on
+        # queries queued behind them
+        self.queries = ThreadPoolExecutor(max_workers=4 * alpha)
+
+    def start(self):
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('0.0.0.0', self.port))
+
+        for target in [self.receive, self.republish]:
+            thread = threading.Thread(target=target, args=())
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+
+        self.sock.close()
+        self.workers.shutdown(wait=False)
+        self.queries.shutdown(wait=False)
+
+    def receive(self):
+
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(65536)
+            except OSError:
+                # Socket closed
+                break
+
+            try:
+                self.handle(json.loads(data), addr)
+            except (ValueError, KeyError, TypeError):
+                # Not one of ours, or mangled on the way
+                continue
+            except Exception:
+                self.cli.log(traceback.format_exc())
+
+    def handle(self, msg, addr):
+
+        contact = Contact(int(msg['id'], 16), addr[0], addr[1])
+        self.table.update(contact)
+
+        if (msg['y'] == 'r'):
+            with self.pending_lock:
+                waiting = self.pending.pop(msg['t'], None)
+
+            if (waiting is not None):
+                waiting[1] = msg
+                waiting[0].set()
+
+            return
+
+        query = msg['q']
+        reply = {'y': 'r', 't': msg['t'], 'id': f'{self.id:064x}'}
+
+        if (query == 'find_node'):
+            reply['nodes'] = [node.to_json() for node in self.table.closest(int(msg['target'], 16)) if node != contact]
+
+        elif (query == 'find_value'):
+            key = int(msg['key'], 16)
+
+            values = self.get(key)
+            if (len(values) > 0):
+                reply['values'] = values[:constant.DHT_MAX_VALUES]
+            else:
+                reply['nodes'] = [node.to_json() for node in self.table.closest(key) if node != contact]
+
+        elif (query == 'store'):
+            self.put(int(msg['key'], 16), addr)
+
+        elif (query != 'ping'):
+            return
+
+        self.send(reply, addr)
+
+    def send(self, msg, addr):
+
+        try:
+            self.sock.sendto(json.dumps(msg).encode(), addr)
+        except OSError:
+            pass
+
+    def rpc(self, addr, query, **args):
+        '''
+        Send a query and wait for the reply. Returns `None` on timeout.
+        '''
+
+        with self.pending_lock:
+            self.next_tx += 1
+            tx = self.next_tx
+            waiting = [threading.Event(), None]
+            self.pending[tx] = waiting
+
+        self.send({'y': 'q', 't': tx, 'q': query, 'id': f'{self.id:064x}', **args}, addr)
+
+        if (not waiting[0].wait(self.timeout)):
+            with self.pending_lock:
+                self.pending.pop(tx, None)
+            return None
+
+        return waiting[1]
+
+    def put(self, key, addr):
+        '''
+        Record a holder of `key`. Anyone can send stores, so there are
+        only so many keys and holders per key, and the ones stored or
+        refreshed longest ago make way for new ones.
+        '''
+
+        addr = tuple(addr)
+
+        with self.values_lock:
+            # Moved to the end, which is the newest
+            holders = self.values.pop(key, {})
+            self.values[key] = holders
+
+            holders.pop(addr, None)
+            holders[addr] = time.monotonic() + constant.DHT_VALUE_TTL_S
+
+            while len(holders) > constant.DHT_MAX_VALUES:
+                del holders[next(iter(holders))]
+
+            while len(self.values) > constant.DHT_MAX_KEYS:
+                del self.values[next(iter(self.values))]
+
+    def get(self, key):
+
+        now = time.monotonic()
+
+        with self.values_lock:
+            holders = self.values.get(key, {})
+            for addr in [addr for addr, expiry in holders.items() if expiry < now]:
+                del holders[addr]
+
+            if (len(holders) == 0):
+                self.values.pop(key, None)
+
+            return [list(addr) for addr in holders]
+
+    def query(self, contact, query, **args):
+        '''
+        `rpc` to a contact, forgetting it if it doesn't answer.
+        '''
+
+        reply = self.rpc(contact.to_tuple(), query, **args)
+        if (reply is None):
+            self.table.remove(contact)
+
+        return reply
+
+    def iterate(self, key, find_value=False):
+        '''
+        Walk towards `key`. Returns (values, closest contacts, rounds),
+        stopping early with the values found if `find_value` is set.
+        '''
+
+        nearest = {contact: None for contact in self.table.closest(key)}
+        queried = set()
+        responded = []
+        rounds = 0
+
+        while True:
+            shortlist = sorted(nearest, key=lambda contact: distance(contact.id, key))[:self.k]
+            batch = [contact for contact in shortlist if contact not in queried][:self.alpha]
+
+            if (len(batch) == 0):
+                break
+
+            rounds += 1
+            queried |= set(batch)
+
+            query = 'find_value' if find_value else 'find_node'
+            field = 'key' if find_value else 'target'
+
+            replies = self.queries.map(lambda contact: self.query(contact, query, **{field: f'{key:064x}'}), batch)
+
+            values = set()
+            for contact, reply in zip(batch, replies):
+                if (reply is None):
+                    nearest.pop(contact, None)
+                    continue
+
+                responded.append(contact)
+
+                for host, port in reply.get('values', []):
+                    values.add((host or contact.host, port))
+
+                for data in reply.get('nodes', []):
+                    node = Contact.from_json(data)
+                    if (node.id != self.id):
+                        nearest.setdefault(node, None)
+                        self.table.update(node)
+
+            if (len(values) > 0):
+                return sorted(values), responded, rounds
+
+        responded.sort(key=lambda contact: distance(contact.id, key))
+
+        return [], responded[:self.k], rounds
+
+    def bootstrap(self, host, port):
+        '''
+        Join through a known node and fill the routing table with
+        nodes near our own id.
+        '''
+
+        alone = len(self.table) == 0
+
+        if (self.rpc((host, port), 'ping') is None):
+            return False
+
+        self.iterate(self.id)
+
+        # Anything published so far only reached ourselves
+        if (alone):
+            for key in list(self.published):
+                self.store(key)
+
+        return True
+
+    def store(self, key):
+
+        _, closest, _ = self.iterate(key)
+
+        # Keep it ourselves too if we're one of the closest nodes. No
+        # host means whoever asks fills in the address they asked
+        if (len(closest) < self.k or distance(self.id, key) < distance(closest[-1].id, key)):
+            self.put(key, ('', self.port))
+
+        for contact in closest:
+            self.queries.submit(self.query, contact, 'store', key=f'{key:064x}')
+
+    def publish(self, file_hash):
+        '''
+        Announce that we have a track. Returns straight away.
+        '''
+
+        key = int(file_hash, 16)
+
+        self.published.add(key)
+        self.workers.submit(self.store, key)
+
+    def unpublish(self, file_hash):
+        '''
+        Stop announcing a track. Copies elsewhere expire on their own.
+        '''
+
+        self.published.discard(int(file_hash, 16))
+
+    def lookup(self, file_hash):
+        '''
+        Addresses of the peers that have a track.
+        '''
+
+        values, _, _ = self.iterate(int(file_hash, 16), find_value=True)
+        return values
+
+    def republish(self):
+
+        while True:
+            time.sleep(constant.DHT_REPUBLISH_S)
+
+            try:
+                for key in list(self.published):
+                    self.store(key)
+            except Exception:
+                self.cli.log(traceback.format_exc())
+
+if (__name__ == '__main__'):
+
+    import math
+    import random
+    import statistics
+
+    class QuietCLI:
+        def log(self, message, color=1):
+            pass
+
+    random.seed(0)
+
+    for n_nodes in [20, 100, 300]:
+        base = 27000 + n_nodes
+
+        nodes = [DHT(QuietCLI(), base + i) for i in range(n_nodes)]
+        for node in nodes:
+            node.start()
+
+        start = time.perf_counter()
+        for i, node in enumerate(nodes[1:], 1):
+            node.bootstrap('127.0.0.1', base + random.randrange(i))
+        joined = time.perf_counter() - start
+
+        keys = [os.urandom(32).hex() for _ in range(100)]
+        owners = {}
+        for key in keys:
+            owner = random.choice(nodes)
+            owners[key] = owner.port
+            owner.store(int(key, 16))
+
+        # Let the stores land
+        time.sleep(0.5)
+
+        rounds = []
+        found = 0
+        start = time.perf_counter()
+        for key in keys:
+            values, _, hops = random.choice(nodes).iterate(int(key, 16), find_value=True)
+            rounds.append(hops)
+            if (any(port == owners[key] for _, port in values)):
+                found += 1
+        elapsed = time.perf_counter() - start
+
+        table = statistics.mean(len(node.table) for node in nodes)
+        print(
+            f'{n_nodes:4d} nodes: joined in {joined:.1f} s, {table:.0f} contacts each, '
+            f'found {found}/{len(keys)} keys, median {statistics.median(rounds)} rounds, '
+            f'worst {max(rounds)} (log2 n = {math.log2(n_nodes):.1f}), '
+            f'{elapsed / len(keys) * 1000:.1f} ms per lookup'
+        )
+
+        for node in nodes:
+            node.stop()
+
+    # A burst of publishes, like an album arriving at once, mustn't
+    # leave lookups on the same node waiting behind them
+    base = 28000
+    nodes = [DHT(QuietCLI(), base + i) for i in range(20)]
+    for node in nodes:
+        node.start()
+
+    for i, node in enumerate(nodes[1:], 1):
+        node.bootstrap('127.0.0.1', base + random.randrange(i))
+
+    burst = [os.urandom(32).hex() for _ in range(4 * nodes[0].alpha)]
+    for key in burst:
+        nodes[0].publish(key)
+
+    result = []
+    lookup = threading.Thread(target=lambda: result.append(nodes[0].lookup(burst[-1])))
+    lookup.daemon = True
+
+    start = time.perf_counter()
+    lookup.start()
+    lookup.join(timeout=5 * constant.DHT_TIMEOUT_S * math.log2(len(nodes)))
+
+    assert len(result) == 1, f'lookup hung after publishing {len(burst)} keys'
+    print(f'Lookup after publishing {len(burst)} keys at once took {(time.perf_counter() - start) * 1000:.0f} ms')
+
+    for node in nodes:
+        node.stop()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+import collections
+import contextlib
+import mmap
+import os
+import threading
+
+import constant
+
+class CachedFile:
+    '''
+    An open file being served, and a memory map of it made the first
+    time one is asked for.
+    '''
+
+    def __init__(self, path, stat):
+
+        self.path = path
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.fd = os.open(path, os.O_RDONLY)
+        self.mapping = None
+
+        # Replies using the file right now, it isn't closed under them
+        self.users = 0
+
+    def view(self):
+        '''
+        The file's contents as a memoryview, without reading them.
+        '''
+
+        if (self.mapping is None):
+            # Empty files can't be mapped
+            self.mapping = mmap.mmap(self.fd, self.size, prot=mmap.PROT_READ) if self.size > 0 else b''
+
+        return memoryview(self.mapping)
+
+    def close(self):
+
+        if (isinstance(self.mapping, mmap.mmap)):
+            try:
+                self.mapping.close()
+            except BufferError:
+                # A write still holds a view, the mapping goes away with it
+                pass
+
+        os.close(self.fd)
+
+class FileCache:
+    '''
+    Files we serve, kept open between requests.
+
+    Pieces of a popular track get asked for over and over by every
+    peer in a swarm. Keeping the file open saves an open, fstat and
+    close per request, and its memory map lets the asyncio server
+    hand out slices without a read each. Files are dropped least
+    recently used first once the ones kept open add up to more than
+    `max_bytes`, which bounds the address space the maps take.
+    '''
+
+    def __init__(self, max_bytes=constant.FILE_CACHE_BYTES, max_files=constant.FILE_CACHE_FILES):
+
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+
+        # Path -> CachedFile, least recently used first
+        self.files = collections.OrderedDict()
+        self.total = 0
+
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def open(self, path):
+        '''
+        Use a file, opening it unless it's cached. Raises `OSError` if
+        it can't be opened.
+        '''
+
+        entry = self.acquire(path)
+
+        try:
+            yield entry
+        finally:
+            self.release(entry)
+
+    def acquire(self, path):
+
+        # A file that changed since it was opened is opened again
+        stat = os.stat(path)
+
+        with self.lock:
+            entry = self.files.get(path)
+
+            if (entry is not None and (entry.size, entry.mtime) == (stat.st_size, stat.st_mtime_ns)):
+                self.files.move_to_end(path)
+                entry.users += 1
+                return entry
+
+            if (entry is not None):
+                self.forget(entry)
+
+        entry = CachedFile(path, stat)
+        entry.users += 1
+
+        with self.lock:
+            # Too big to keep, it's closed once this reply is done
+            if (entry.size > self.max_bytes or path in self.files):
+                return entry
+
+            self.files[path] = entry
+            self.total += entry.size
+
+            self.evict()
+
+        return entry
+
+    def release(self, entry):
+
+        with self.lock:
+            entry.users -= 1
+
+            if (entry.users == 0 and self.files.get(entry.path) is not entry):
+                entry.close()
+
+    def forget(self, entry):
+        '''
+        Stop caching a file, closing it once nothing uses it.
+        '''
+
+        del self.files[entry.path]
+        self.total -= entry.size
+
+        if (entry.users == 0):
+            entry.close()
+
+    def evict(self):
+
+        for entry in list(self.files.values()):
+            if (self.total <= self.max_bytes and len(self.files) <= self.max_files):
+                break
+
+            self.forget(entry)
+
+    def clear(self):
+
+        with self.lock:
+            for entry in list(self.files.values()):
+                self.forget(entry)
+
+    def __len__(self):
+
+        return len(self.files)
+
+if (__name__ == '__main__'):
+
+    import base64
+    import hashlib
+    import resource
+    import socket
+    import tempfile
+    import time
+
+    import framing
+    from track import hash_file, hash_pieces
+
+    def thread_cpu():
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+
+    def drain(sock):
+        buffer = bytearray(1 << 20)
+        while sock.recv_into(buffer) > 0:
+            pass
+
+    def measure(name, serve, total_bytes):
+        '''
+        CPU the serving thread spends per megabyte sent, with a reader
+        on another thread emptying the socket.
+        '''
+
+        a, b = socket.socketpair()
+        reader = threading.Thread(target=drain, args=(b,))
+        reader.start()
+
+        start = time.perf_counter()
+        cpu = thread_cpu()
+        serve(a)
+        cpu = thread_cpu() - cpu
+        elapsed = time.perf_counter() - start
+
+        a.close()
+        reader.join()
+        b.close()
+
+        mb = total_bytes / (1 << 20)
+        print(f'  {name:36s} {cpu / mb * 1e6:7.0f} us CPU/MB, {mb / elapsed:7.0f} MB/s')
+
+    with tempfile.NamedTemporaryFile() as f:
+        size = 8 << 20
+        f.write(os.urandom(size))
+        f.flush()
+        path = f.name
+
+        lock = threading.Lock()
+        cache = FileCache()
+
+        for piece in [size, constant.PIECE_SIZE]:
+            requests = 40 if piece == size else 40 * size // piece
+            total = requests * piece
+            offsets = [(i * piece) % size for i in range(requests)]
+
+            print(f'{requests} requests of {piece >> 10} KB')
+
+            def read_base64(sock):
+                # How tracks used to be served
+                for offset in offsets:
+                    with open(path, 'rb') as f:
+                        f.seek(offset)
+                        sock.sendall(base64.b64encode(f.read(piece)))
+
+            def read_copy(sock):
+                for offset in offsets:
+                    with open(path, 'rb') as f:
+                        f.seek(offset)
+                        framing.send_frame(sock, 1, f.read(piece))
+
+            def reopen_sendfile(sock):
+                # How ranges were framed before: open the file for every
+                # request and socket.sendfile every chunk
+                for offset in offsets:
+                    with open(path, 'rb') as f:
+                        position = offset
+                        while position < offset + piece:
+                            n = min(constant.STREAM_CHUNK, offset + piece - position)
+                            with lock:
+                                sock.sendall(framing.HEADER.pack(1, 0, n))
+                                sock.sendfile(f, position, n)
+                            position += n
+
+            def cached_sendfile(sock):
+                for offset in offsets:
+                    with cache.open(path) as entry:
+                        framing.send_file(sock, lock, 1, entry, offset, piece)
+
+            def cached_mmap(sock):
+                # What the asyncio server writes from
+                for offset in offsets:
+                    with cache.open(path) as entry:
+                        view = entry.view()
+                        position = offset
+                        while position < offset + piece:
+                            n = min(constant.STREAM_CHUNK, offset + piece - position)
+                            with lock:
+                                sock.sendall(framing.HEADER.pack(1, 0, n))
+                                sock.sendall(view[position:position + n])
+                            position += n
+
+            measure('read + base64 per request', read_base64, total)
+            measure('read + send per request', read_copy, total)
+            measure('open + socket.sendfile per chunk', reopen_sendfile, total)
+            measure('cached file + os.sendfile', cached_sendfile, total)
+            measure('cached mmap slices', cached_mmap, total)
+
+        def hash_file_chunks(path):
+            # The old 64 KB read loop
+            hasher = hashlib.sha256()
+            with open(path, 'rb') as f:
+                segment = f.read(65536)
+                while len(segment) > 0:
+                    hasher.update(segment)
+                    segment = f.read(65536)
+            return hasher.hexdigest()
+
+        print('Hashing')
+        for name, function in [
+            ('64 KB reads', hash_file_chunks),
+            ('readinto a reused buffer', hash_file),
+            ('pieces', lambda path: hash_pieces(path, constant.PIECE_SIZE))
+        ]:
+            cpu = thread_cpu()
+            for _ in range(10):
+                function(path)
+            cpu = thread_cpu() - cpu
+            print(f'  {name:36s} {cpu / (10 * size / (1 << 20)) * 1e6:7.0f} us CPU/MB')
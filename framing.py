@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import select
+import socket
+import struct
+
+import constant
+
+# Request id, flags and payload length sent ahead of every frame
+HEADER = struct.Struct('!IBQ')
+
+# More frames with the same request id follow this one
+MORE = 1
+
+# The payload is an error message instead of a reply
+ERROR = 2
+
+def recv_exact(sock, size):
+    '''
+    Read exactly `size` bytes from the socket. Returns `None` if
+    the connection closes before they arrive.
+    '''
+
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if (n == 0):
+            return None
+        received += n
+
+    return buffer
+
+def send_frame(sock, req_id, data, flags=0):
+    '''
+    Send `data` as a single frame tagged with `req_id`.
+    '''
+
+    header = HEADER.pack(req_id, flags, len(data))
+
+    # Small frames go out in one write so the header doesn't sit
+    # in its own packet waiting on Nagle
+    if (len(data) <= constant.STREAM_CHUNK):
+        sock.sendall(header + data)
+    else:
+        sock.sendall(header)
+        sock.sendall(data)
+
+def recv_frame(sock):
+    '''
+    Read a single frame. The payload is read straight into a buffer
+    of the declared size. Returns a tuple of (request id, flags,
+    payload), or `None` if the connection closes part way through.
+    Raises `ConnectionError` for frames over `constant.MAX_FRAME`.
+    '''
+
+    header = recv_exact(sock, HEADER.size)
+    if (header is None):
+        return None
+
+    req_id, flags, size = HEADER.unpack(header)
+    check_size(size)
+
+    payload = recv_exact(sock, size)
+    if (payload is None):
+        return None
+
+    return req_id, flags, payload
+
+def check_size(size):
+    '''
+    Refuse a frame before allocating for it. The size comes straight
+    from the peer, so anything could be claimed.
+    '''
+
+    if (size > constant.MAX_FRAME):
+        raise ConnectionError(f'frame of {size} bytes is over the limit')
+
+def sendfile_all(sock, fd, offset, count):
+    '''
+    Have the kernel copy `count` bytes of a file onto the socket.
+    Unlike `socket.sendfile` this never seeks, so several threads can
+    send from one open file at once.
+    '''
+
+    while count > 0:
+        try:
+            sent = os.sendfile(sock.fileno(), fd, offset, count)
+        except BlockingIOError:
+            # Sockets with a timeout are non-blocking underneath
+            select.select([], [sock], [], sock.gettimeout())
+            continue
+
+        if (sent == 0):
+            # The frame header promised more, the stream can't be trusted now
+            sock.shutdown(socket.SHUT_RDWR)
+            raise ConnectionError('file ended before the range did')
+
+        offset += sent
+        count -= sent
+
+def send_file(sock, lock, req_id, entry, offset=0, length=None, pace=None):
+    '''
+    Stream a file, or `length` bytes of it starting at `offset`, as
+    a run of frames tagged with `req_id`. `entry` is a `CachedFile`
+    from the server's file cache. Each chunk is handed to the kernel
+    with `sendfile` so the file is never held in memory. `lock` is
+    only held for one chunk at a time, so other replies on the same
+    socket can go out in between. `pace`, if given, is called with
+    the size of each chunk before it goes and may wait to slow the
+    transfer down. Returns the number of bytes sent.
+    '''
+
+    size = file_range(entry.size, offset, length)
+
+    position = offset
+    end = offset + size
+
+    while True:
+        n = min(constant.STREAM_CHUNK, end - position)
+        flags = MORE if position + n < end else 0
+
+        if (pace is not None):
+            pace(n + HEADER.size)
+
+        with lock:
+            sock.sendall(HEADER.pack(req_id, flags, n))
+            if (n > 0):
+                sendfile_all(sock, entry.fd, position, n)
+
+        position += n
+
+        if (flags == 0):
+            break
+
+    return size
+
+def file_range(file_size, offset, length):
+    '''
+    Clamp a requested range to the end of a file and return the
+    number of bytes it covers.
+    '''
+
+    remaining = max(0, file_size - offset)
+
+    if (length is None):
+        return remaining
+
+    return min(length, remaining)
+
+async def read_frame_async(reader):
+    '''
+    Read a single frame from an asyncio stream. Returns `None` if
+    the connection closes part way through.
+    '''
+
+    try:
+        header = await reader.readexactly(HEADER.size)
+        req_id, flags, size = HEADER.unpack(header)
+        check_size(size)
+        return req_id, flags, await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        return None
+
+async def write_frame_async(writer, lock, req_id, data, flags=0):
+    '''
+    Send `data` as a single frame on an asyncio stream.
+    '''
+
+    async with lock:
+        writer.write(HEADER.pack(req_id, flags, len(data)))
+        writer.write(data)
+        await writer.drain()
+
+async def send_file_async(writer, lock, req_id, entry, offset=0, length=None, pace=None):
+    '''
+    Stream a file, or part of one, as a run of frames on an asyncio
+    stream. Chunks are slices of the file's memory map, so nothing is
+    read or copied before the transport sends it. `pace` is awaited
+    with each chunk's size, like in `send_file`.
+
+    This doesn't use `loop.sendfile`, which pauses reading on the
+    transport and would hold up every other request on the
+    connection until the whole file is sent.
+    '''
+
+    size = file_range(entry.size, offset, length)
+    view = entry.view()
+
+    position = offset
+    end = offset + size
+
+    while True:
+        n = min(constant.STREAM_CHUNK, end - position)
+        flags = MORE if position + n < end else 0
+
+        if (pace is not None):
+            await pace(n + HEADER.size)
+
+        # Touching a map past the end of a file that shrank kills the
+        # process, so check before every chunk
+        if (os.fstat(entry.fd).st_size < position + n):
+            writer.close()
+            raise ConnectionError('file shrank while it was being sent')
+
+        async with lock:
+            writer.write(HEADER.pack(req_id, flags, n))
+            if (n > 0):
+                writer.write(view[position:position + n])
+            await writer.drain()
+
+        position += n
+
+        if (flags == 0):
+            break
+
+    return size
+
+if (__name__ == '__main__'):
+
+    import threading
+    import time
+
+    # Frame read throughput should stay flat as the payload grows
+    for size_mb in [1, 2, 4, 8, 16, 32, 64]:
+
+        payload = bytes(size_mb * 1024 * 1024)
+        a, b = socket.socketpair()
+
+        sender = threading.Thread(target=send_frame, args=(a, 1, payload))
+
+        start = time.perf_counter()
+        sender.start()
+        _, _, frame = recv_frame(b)
+        elapsed = time.perf_counter() - start
+        sender.join()
+
+        assert len(frame) == len(payload)
+        print(f'{size_mb:3d} MB: {elapsed * 1000:8.2f} ms ({size_mb / elapsed:8.1f} MB/s)')
+
+        a.close()
+        b.close()
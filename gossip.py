@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+import functools
+import random
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import constant
+
+class GossipState:
+    '''
+    Which catalogs exist in the mesh and which of them we're behind
+    on, without any networking.
+
+    A digest is an (origin, catalog id, version, ttl) tuple, where the
+    origin is the (host, port) a node listens on. Every node pushes
+    digests it hasn't seen before to `fanout` random neighbours, one
+    hop less each time, so news of a changed catalog spreads through
+    the mesh in a few rounds. Nodes then fetch track lists only from
+    the origins they're behind on instead of polling everyone.
+
+    The caller moves messages around: `round` says what to send and
+    to whom, and `receive` takes what arrived.
+    '''
+
+    def __init__(self,
+        fanout=constant.GOSSIP_FANOUT,
+        ttl=constant.GOSSIP_TTL,
+        refresh=constant.GOSSIP_REFRESH,
+        rng=None
+    ):
+
+        self.fanout = fanout
+        self.ttl = ttl
+        self.refresh = refresh
+        self.rng = random.Random() if rng is None else rng
+
+        # Our own catalog, as (id, version)
+        self.local = None
+        self.rounds = 0
+
+        # Every listening address we've heard of
+        self.peers = set()
+
+        # Origin -> newest (catalog id, version) heard of, and the
+        # one we last fetched
+        self.digests = {}
+        self.synced = {}
+
+        # Digests waiting to be passed on, and origins we're behind on
+        self.outbox = []
+        self.stale = set()
+
+        self.lock = threading.Lock()
+
+    def set_local(self, catalog_id, version):
+        '''
+        Announce our own catalog if it changed. The origin of our own
+        digests is `None`, receivers fill in the address they got
+        them from.
+        '''
+
+        with self.lock:
+            if (self.local == (catalog_id, version)):
+                return
+
+            self.local = (catalog_id, version)
+            self.outbox.append((None, catalog_id, version, self.ttl))
+
+    def learn_peers(self, addrs):
+        '''
+        Remember listening addresses. Returns the ones that are new.
+        '''
+
+        with self.lock:
+            new = set(addrs) - self.peers
+            self.peers |= new
+
+        return new
+
+    def newer(self, origin, catalog_id, version):
+
+        known = self.digests.get(origin)
+        return known is None or known[0] != catalog_id or known[1] < version
+
+    def receive(self, sender, digests):
+        '''
+        Take digests that arrived from `sender`. Returns how many of
+        them were news to us.
+        '''
+
+        fresh = 0
+
+        with self.lock:
+            for origin, catalog_id, version, ttl in digests:
+
+                if (origin is None):
+                    origin = sender
+
+                # Our own catalog coming back around
+                if (self.local is not None and catalog_id == self.local[0]):
+                    continue
+
+                self.peers.add(origin)
+
+                if (not self.newer(origin, catalog_id, version)):
+                    continue
+
+                fresh += 1
+                self.digests[origin] = (catalog_id, version)
+
+                if (ttl > 1):
+                    self.outbox.append((origin, catalog_id, version, ttl - 1))
+
+                if (self.synced.get(origin) != (catalog_id, version)):
+                    self.stale.add(origin)
+
+        return fresh
+
+    def mark_synced(self, origin, catalog_id, version):
+
+        with self.lock:
+            self.synced[origin] = (catalog_id, version)
+            self.stale.discard(origin)
+
+            if (self.newer(origin, catalog_id, version)):
+                self.digests[origin] = (catalog_id, version)
+
+    def take_stale(self):
+        '''
+        Origins whose catalog changed since we last fetched it.
+        '''
+
+        with self.lock:
+            stale = self.stale
+            self.stale = set()
+
+        return stale
+
+    def round(self, neighbours):
+        '''
+        Work out one round of gossip. Returns a list of (neighbour,
+        digests) messages to send.
+        '''
+
+        neighbours = list(neighbours)
+        if (len(neighbours) == 0):
+            return []
+
+        messages = []
+
+        with self.lock:
+            self.rounds += 1
+
+            digests = self.outbox
+            self.outbox = []
+
+            # Every so often send everything we know to one neighbour,
+            # which catches nodes that joined late or that the pushes missed
+            if (self.rounds % self.refresh == 0):
+                table = [(origin, catalog_id, version, self.ttl) for origin, (catalog_id, version) in self.digests.items()]
+                if (self.local is not None):
+                    table.append((None, self.local[0], self.local[1], self.ttl))
+
+                messages.append((self.rng.choice(neighbours), table))
+
+        if (len(digests) > 0):
+            for target in self.rng.sample(neighbours, min(self.fanout, len(neighbours))):
+                messages.append((target, digests))
+
+        return messages
+
+@functools.lru_cache(maxsize=256)
+def resolve(host):
+
+    try:
+        return socket.gethostbyname(host)
+    except OSError:
+        return host
+
+def address(peer):
+    '''
+    The (IP, port) a peer listens on, as other nodes would see it.
+    '''
+
+    return (resolve(peer.host), peer.port)
+
+class Gossip:
+    '''
+    Runs gossip rounds against connected peers.
+
+    Each round pushes digests to a few random peers, fetches track
+    lists from peers whose catalog changed, and connects to more of
+    the peers we've heard of while we have fewer than
+    `constant.GOSSIP_MIN_PEERS`.
+    '''
+
+    def __init__(self, client, interval=constant.GOSSIP_S):
+
+        self.client = client
+        self.cli = client.cli
+        self.interval = interval
+        self.state = GossipState()
+
+    def start(self):
+
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+
+        while True:
+            time.sleep(self.interval)
+
+            try:
+                self.step()
+            except Exception:
+                self.cli.log(traceback.format_exc())
+
+    def connected(self):
+        '''
+        Connected peers by listening address.
+        '''
+
+        return {address(peer): peer for peer in list(self.client.connections.values()) if peer.is_connected()}
+
+    def step(self):
+
+        catalog = self.client.local_tracks
+        self.state.set_local(catalog.id, catalog.version)
+
+        peers = self.connected()
+
+        messages = self.state.round(peers.keys())
+        if (len(messages) > 0):
+            with ThreadPoolExecutor(max_workers=len(messages)) as pool:
+                for target, digests in messages:
+                    pool.submit(self.send, peers[target], digests)
+
+        for origin in self.state.take_stale():
+            peer = peers.get(origin)
+
+            if (peer is not None):
+                self.client.sync_peer(peer)
+
+            # Only reach out to nodes we don't know while there's room,
+            # counting the ones we can't reach too
+            elif (len(self.client.connections) < constant.MAX_PEERS):
+                self.cli.log(f'{origin[0]}:{origin[1]} has new tracks, connecting')
+                self.client.add_peer(*origin)
+                peers = self.connected()
+
+        if (len(peers) < constant.GOSSIP_MIN_PEERS):
+            known = set(address(peer) for peer in list(self.client.connections))
+
+            candidates = list(self.state.peers - known)
+            self.state.rng.shuffle(candidates)
+
+            for host, port in candidates[:constant.GOSSIP_MIN_PEERS - len(peers)]:
+                self.client.add_peer(host, port)
+
+    def send(self, peer, digests):
+
+        peer.request({
+            'action': 'gossip',
+            'port': self.client.port,
+            'digests': [list(digest) for digest in digests]
+        }, timeout=2)
+
+    def receive(self, host, port, digests):
+        '''
+        Take digests another node pushed to us. Called by the server.
+        '''
+
+        digests = [
+            (None if origin is None else tuple(origin), catalog_id, version, ttl)
+            for origin, catalog_id, version, ttl in digests
+        ]
+
+        return self.state.receive((host, port), digests)
+
+    def synced(self, peer):
+        '''
+        Note that we just fetched the peer's track list.
+        '''
+
+        if (peer.catalog_id is not None):
+            self.state.mark_synced(address(peer), peer.catalog_id, peer.catalog_version)
+
+    def sample_peers(self, exclude=None, limit=constant.GOSSIP_PEERS_SENT):
+        '''
+        Some of the addresses we know, to hand to a peer that asked.
+        '''
+
+        with self.state.lock:
+            addrs = set(self.state.peers)
+
+        addrs |= set(self.connected())
+        addrs.discard(exclude)
+
+        return self.state.rng.sample(list(addrs), min(limit, len(addrs)))
+
+if (__name__ == '__main__'):
+
+    import statistics
+
+    def simulate(n_nodes, degree, fanout, ttl, seed):
+        '''
+        Rounds and messages until every node has heard that node 0's
+        catalog changed, on a random mesh where each node knows
+        `degree` others.
+        '''
+
+        rng = random.Random(seed)
+
+        neighbours = {i: set() for i in range(n_nodes)}
+        for i in range(n_nodes):
+            for j in rng.sample(range(n_nodes), degree + 1):
+                if (j != i and len(neighbours[i]) < degree):
+                    neighbours[i].add(j)
+                    neighbours[j].add(i)
+
+        nodes = [GossipState(fanout, ttl, refresh=4, rng=random.Random(seed * 1000 + i)) for i in range(n_nodes)]
+        for i, node in enumerate(nodes):
+            node.set_local(f'catalog-{i}', 1)
+
+        # Let everyone's first announcement settle, then change node 0
+        def run_round():
+            messages = 0
+            inboxes = [[] for _ in nodes]
+            for i, node in enumerate(nodes):
+                for target, digests in node.round(neighbours[i]):
+                    inboxes[target].append((i, digests))
+                    messages += 1
+
+            for i, inbox in enumerate(inboxes):
+                for sender, digests in inbox:
+                    nodes[i].receive(sender, digests)
+
+            return messages
+
+        for _ in range(3 * ttl):
+            run_round()
+
+        nodes[0].set_local('catalog-0', 2)
+
+        rounds = 0
+        messages = 0
+        while rounds < 100:
+            rounds += 1
+            messages += run_round()
+
+            informed = sum(1 for node in nodes[1:] if node.digests.get(0) == ('catalog-0', 2))
+            if (informed == n_nodes - 1):
+                break
+
+        return rounds, messages
+
+    # Polling every peer's track list each round finds the change in
+    # one round but costs n * (n - 1) requests every round, changed or not
+    print('nodes  rounds  worst  messages  polling, one round')
+    for n_nodes in [10, 30, 100, 300, 1000]:
+        results = [simulate(n_nodes, degree=8, fanout=constant.GOSSIP_FANOUT, ttl=constant.GOSSIP_TTL, seed=seed) for seed in range(5)]
+
+        rounds = statistics.mean(result[0] for result in results)
+        worst = max(result[0] for result in results)
+        messages = statistics.mean(result[1] for result in results)
+
+        print(f'{n_nodes:5d}  {rounds:6.1f}  {worst:5d}  {messages:8.0f}  {n_nodes * (n_nodes - 1):17d}')
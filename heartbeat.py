@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import constant
+
+class Heartbeat:
+    '''
+    Pings every peer on an interval so the Peers window stays
+    accurate, and reconnects dead peers with jittered exponential
+    backoff.
+    '''
+
+    def __init__(self, client, interval=constant.HEARTBEAT_S):
+
+        self.client = client
+        self.cli = client.cli
+        self.interval = interval
+
+        # Peer -> (failed attempts, time of next attempt)
+        self.backoff = {}
+
+    def start(self):
+
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+
+        while True:
+            time.sleep(self.interval)
+
+            try:
+                self.beat()
+            except Exception:
+                self.cli.log(traceback.format_exc())
+
+    def beat(self):
+        '''
+        Check every peer at once.
+        '''
+
+        peers = list(self.client.connections.values())
+        if (len(peers) == 0):
+            return
+
+        with ThreadPoolExecutor(max_workers=len(peers)) as pool:
+            changed = any(pool.map(self.check, peers))
+
+        if (changed):
+            self.client.update_peers()
+
+    def check(self, peer):
+        '''
+        Ping a live peer or retry a dead one when its backoff is up.
+        Returns whether the peer's status changed.
+        '''
+
+        if (peer.is_connected()):
+            if (peer.ping()):
+                return False
+
+            if (peer in self.client.transient):
+                self.client.forget_peer(peer)
+            else:
+                self.schedule_retry(peer)
+            return True
+
+        # Only found for a download, not worth retrying
+        if (peer in self.client.transient):
+            self.client.forget_peer(peer)
+            return True
+
+        failures, next_attempt = self.backoff.get(peer, (0, 0))
+        if (time.monotonic() < next_attempt):
+            return False
+
+        if (not peer.connect()):
+            self.schedule_retry(peer)
+            return False
+
+        self.backoff.pop(peer, None)
+        self.client.sync_peer(peer)
+
+        return True
+
+    def schedule_retry(self, peer):
+
+        failures, _ = self.backoff.get(peer, (0, 0))
+
+        delay = min(constant.RECONNECT_MAX_S, constant.RECONNECT_MIN_S * 2 ** failures)
+
+        # Spread retries out so peers don't reconnect in lockstep
+        delay *= random.uniform(0.5, 1.5)
+
+        self.backoff[peer] = (failures + 1, time.monotonic() + delay)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import collections
+import itertools
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import constant
+
+class Job:
+    '''
+    A command running in the background.
+
+    Long running work reports its progress with `advance` and checks
+    `cancelled` between steps so it can stop early.
+    '''
+
+    def __init__(self, job_id, description, key=None):
+
+        self.id = job_id
+        self.description = description
+        self.key = key
+
+        self.status = 'queued'
+        self.error = None
+
+        self.done = 0
+        self.total = None
+        self.in_bytes = True
+        self.resumed = 0
+        self.started = None
+        self.finished = None
+
+        self.cancel_event = threading.Event()
+
+        # Swarm downloads advance from several threads at once
+        self.lock = threading.Lock()
+
+    def cancel(self):
+
+        self.cancel_event.set()
+
+    def cancelled(self):
+
+        return self.cancel_event.is_set()
+
+    def active(self):
+
+        return self.status in ['queued', 'running']
+
+    def set_total(self, total, done=0, in_bytes=True):
+        '''
+        Set how much work there is, and how much of it was already
+        done before this job started, such as a resumed download.
+        '''
+
+        self.total = total
+        self.done = done
+        self.resumed = done
+        self.in_bytes = in_bytes
+
+    def advance(self, n):
+
+        with self.lock:
+            self.done += n
+
+    def rate(self):
+        '''
+        Average progress per second since the job started.
+        '''
+
+        if (self.started is None):
+            return 0
+
+        end = self.finished or time.monotonic()
+        return (self.done - self.resumed) / max(end - self.started, 1e-6)
+
+    def eta(self):
+        '''
+        Seconds until the job is done at its current rate, or `None`
+        if that can't be told.
+        '''
+
+        rate = self.rate()
+        if (self.total is None or rate == 0):
+            return None
+
+        return max(0, self.total - self.done) / rate
+
+    def __str__(self):
+
+        line = f'[{self.id}] {self.status:9s} {self.description}'
+
+        if (self.total and self.in_bytes):
+            line += f' {self.done / self.total:4.0%} {self.rate() / 1e6:.1f} MB/s'
+
+            eta = self.eta()
+            if (self.status == 'running' and eta is not None):
+                line += f' ETA {int(eta) // 60}:{int(eta) % 60:02d}'
+
+        elif (self.total):
+            line += f' {self.done}/{self.total}'
+
+        if (self.error is not None):
+            line += f' ({self.error})'
+
+        return line
+
+class JobManager:
+    '''
+    Runs commands on a pool of threads so the command loop never
+    waits on the network or disk. Finished jobs are kept around for
+    a while so `jobs` can show how they went.
+    '''
+
+    def __init__(self, cli, workers=constant.JOB_WORKERS, history=constant.JOB_HISTORY):
+
+        self.cli = cli
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.ids = itertools.count(1)
+
+        self.jobs = collections.OrderedDict()
+        self.history = history
+        self.lock = threading.Lock()
+
+    def submit(self, description, function, *args, key=None):
+        '''
+        Run `function(*args, job=job)` in the background. Returns the
+        job, or `None` if one with the same `key` is still active.
+        '''
+
+        with self.lock:
+            if (key is not None and self.find(key) is not None):
+                return None
+
+            job = Job(next(self.ids), description, key)
+            self.jobs[job.id] = job
+            self.prune()
+
+        self.cli.log(f'Started job {job.id}: {description}')
+        self.pool.submit(self.run, job, function, args)
+
+        return job
+
+    def run(self, job, function, args):
+
+        if (job.cancelled()):
+            job.status = 'cancelled'
+            return
+
+        job.status = 'running'
+        job.started = time.monotonic()
+
+        try:
+            result = function(*args, job=job)
+        except Exception as e:
+            self.cli.log(traceback.format_exc())
+            job.status = 'failed'
+            job.error = str(e)
+        else:
+            if (job.cancelled()):
+                job.status = 'cancelled'
+            elif (result is False):
+                job.status = 'failed'
+            else:
+                job.status = 'done'
+
+        job.finished = time.monotonic()
+        self.cli.log(f'Job {job.id} {job.status}: {job.description}')
+
+    def find(self, key):
+        '''
+        The active job with the given key, if any.
+        '''
+
+        for job in self.jobs.values():
+            if (job.key == key and job.active()):
+                return job
+
+        return None
+
+    def cancel(self, job_id):
+        '''
+        Ask a job to stop. Returns `False` if there is no such job
+        or it already ended.
+        '''
+
+        job = self.jobs.get(job_id)
+        if (job is None or not job.active()):
+            return False
+
+        job.cancel()
+        return True
+
+    def prune(self):
+
+        # Forget the oldest finished jobs once there are too many
+        finished = [job_id for job_id, job in self.jobs.items() if not job.active()]
+        for job_id in finished[:max(0, len(self.jobs) - self.history)]:
+            del self.jobs[job_id]
+
+    def values(self):
+
+        with self.lock:
+            return list(self.jobs.values())
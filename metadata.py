@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import json
+import queue
+import threading
+import traceback
+import urllib.parse
+import urllib.request
+
+import acoustid as aid
+
+import constant
+from ratelimit import TokenBucket
+
+def clean_names(names):
+    '''
+    A lookup result as (title, artist), where a result without a title
+    is a miss of (None, None) and one without an artist is by 'Unknown',
+    like the placeholder tracks start with.
+    '''
+
+    title, artist = names if names is not None else (None, None)
+
+    if (not title):
+        return None, None
+
+    return title, artist or 'Unknown'
+
+class AcoustIDBackend:
+    '''
+    Looks up fingerprints with the AcoustID web service. A whole
+    batch is resolved with a single request.
+    '''
+
+    def __init__(self, api_key=constant.API_KEY, timeout=10):
+
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def lookup(self, batch):
+        '''
+        Resolve a list of (duration, fingerprint) pairs. Returns a
+        (title, artist) tuple for each pair, or `None` where there is
+        no match. Raises `OSError` if the service can't be reached.
+        '''
+
+        params = {
+            'client': self.api_key,
+            'format': 'json',
+            'meta': 'recordings'
+        }
+
+        for i, (duration, fingerprint) in enumerate(batch):
+            if (isinstance(fingerprint, bytes)):
+                fingerprint = fingerprint.decode()
+
+            params[f'duration.{i}'] = int(duration)
+            params[f'fingerprint.{i}'] = fingerprint
+
+        data = urllib.parse.urlencode(params).encode()
+
+        try:
+            with urllib.request.urlopen(constant.ACOUSTID_URL, data, timeout=self.timeout) as resp:
+                json_resp = json.load(resp)
+        except ValueError:
+            raise OSError('AcoustID sent an invalid response')
+
+        if (json_resp.get('status') != 'ok'):
+            raise OSError(f"AcoustID lookup failed: {json_resp.get('error')}")
+
+        results = [None] * len(batch)
+        for entry in json_resp['fingerprints']:
+
+            matches = aid.parse_lookup_result({'status': 'ok', 'results': entry['results']})
+
+            try:
+                # Ignore score and recording_id
+                _, _, title, artist = next(matches)
+            except StopIteration:
+                continue
+
+            results[int(entry['index'])] = (title, artist)
+
+        return results
+
+class StaticBackend:
+    '''
+    Resolves fingerprints from a fixed dictionary instead of the
+    network. Useful for testing.
+    '''
+
+    def __init__(self, table):
+
+        self.table = table
+
+    def lookup(self, batch):
+
+        return [self.table.get(fingerprint) for _, fingerprint in batch]
+
+class MetadataResolver:
+    '''
+    Background queue that fills in track titles and artists.
+
+    Tracks keep their placeholder names until a lookup succeeds.
+    Lookups are batched, rate limited, and cached by fingerprint. If
+    `backend` is `None` the resolver is offline and only answers from
+    the cache.
+    '''
+
+    def __init__(self, cli, backend, on_resolved, cache=None,
+        rate=constant.ACOUSTID_RATE,
+        batch_size=constant.ACOUSTID_BATCH
+    ):
+
+        self.cli = cli
+        self.backend = backend
+        self.on_resolved = on_resolved
+        self.cache = cache
+        self.batch_size = batch_size
+
+        # No bursting, AcoustID enforces the rate per second
+        self.bucket = TokenBucket(rate, capacity=1)
+        self.queue = queue.Queue()
+
+        if (self.backend is not None):
+            thread = threading.Thread(target=self.run, args=())
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, track):
+        '''
+        Queue a track for lookup. Cached results are applied right away.
+        '''
+
+        if (not track.fingerprint):
+            return
+
+        if (self.cache is not None):
+            cached = self.cache.get_metadata(track.fingerprint)
+            if (cached is not None):
+                self.resolved(track, cached)
+                return
+
+        if (self.backend is not None):
+            self.queue.put(track)
+
+    def resolved(self, track, names):
+
+        # Results cached by older versions may lack an artist
+        title, artist = clean_names(names)
+
+        # Cached miss
+        if (title is None):
+            return
+
+        if ((title, artist) != (track.title, track.artist)):
+            self.on_resolved(track, title, artist)
+
+    def next_batch(self):
+        '''
+        Wait for the rate limit, then take as many queued tracks as
+        fit in one request.
+        '''
+
+        batch = [self.queue.get()]
+        self.bucket.acquire()
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def retry_later(self, batch):
+
+        def requeue():
+            for track in batch:
+                self.queue.put(track)
+
+        timer = threading.Timer(constant.ACOUSTID_RETRY_S, requeue)
+        timer.daemon = True
+        timer.start()
+
+    def run(self):
+
+        while True:
+            batch = self.next_batch()
+
+            # Only look up each fingerprint once per batch
+            by_fingerprint = {}
+            for track in batch:
+                by_fingerprint.setdefault(track.fingerprint, []).append(track)
+
+            fingerprints = list(by_fingerprint.keys())
+            lookups = [(by_fingerprint[fp][0].duration, fp) for fp in fingerprints]
+
+            try:
+                results = self.backend.lookup(lookups)
+            except OSError as e:
+                self.cli.log(f'Metadata lookup failed, retrying later: {e}')
+                self.retry_later(batch)
+                continue
+            except Exception:
+                self.cli.log(traceback.format_exc())
+                continue
+
+            for fingerprint, names in zip(fingerprints, results):
+
+                # One bad result mustn't stop the resolver for good
+                try:
+                    names = clean_names(names)
+
+                    if (self.cache is not None):
+                        self.cache.put_metadata(fingerprint, *names)
+
+                    for track in by_fingerprint[fingerprint]:
+                        self.resolved(track, names)
+
+                except Exception:
+                    self.cli.log(traceback.format_exc())
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import threading
+
+from track import hash_file
+
+class PartFile:
+    '''
+    A download in progress.
+
+    Data is written into `<path>.part` and the byte ranges that have
+    been written are recorded in a `<path>.part.json` sidecar, so an
+    interrupted download can pick up where it left off. The part
+    file only replaces `path` once its hash has been checked.
+    '''
+
+    def __init__(self, path, file_hash, size):
+
+        self.path = path
+        self.part_path = path + '.part'
+        self.sidecar_path = path + '.part.json'
+        self.hash = file_hash
+        self.size = size
+
+        self.lock = threading.Lock()
+
+        # Sorted, non-overlapping [start, end) ranges already on disk
+        self.ranges = self.load_ranges()
+
+        self.fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        os.ftruncate(self.fd, size)
+
+    def load_ranges(self):
+        '''
+        Read the finished ranges from the sidecar. Anything left over
+        from a different file is ignored.
+        '''
+
+        if (not os.path.exists(self.part_path)):
+            return []
+
+        try:
+            with open(self.sidecar_path, 'r') as f:
+                json_dict = json.load(f)
+        except (OSError, ValueError):
+            return []
+
+        if (json_dict.get('hash') != self.hash or json_dict.get('size') != self.size):
+            return []
+
+        return [tuple(r) for r in json_dict['ranges']]
+
+    def save_ranges(self):
+
+        json_dict = {
+            'hash': self.hash,
+            'size': self.size,
+            'ranges': self.ranges
+        }
+
+        # Write then rename so a crash never leaves half a sidecar
+        tmp_path = self.sidecar_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(json_dict, f)
+
+        os.replace(tmp_path, self.sidecar_path)
+
+    def write(self, offset, data):
+        '''
+        Write a block of the file and record it as finished.
+        '''
+
+        os.pwrite(self.fd, data, offset)
+
+        with self.lock:
+            self.ranges = add_range(self.ranges, offset, offset + len(data))
+            self.save_ranges()
+
+    def has(self, offset, length):
+        '''
+        Check whether the given range has already been written.
+        '''
+
+        with self.lock:
+            for start, end in self.ranges:
+                if (start <= offset and offset + length <= end):
+                    return True
+
+        return False
+
+    def missing(self, chunk_size):
+        '''
+        List the (offset, length) blocks still to be downloaded, each
+        at most `chunk_size` bytes.
+        '''
+
+        blocks = []
+        position = 0
+
+        with self.lock:
+            gaps = []
+            for start, end in self.ranges:
+                if (start > position):
+                    gaps.append((position, start))
+                position = max(position, end)
+
+            if (position < self.size):
+                gaps.append((position, self.size))
+
+        for start, end in gaps:
+            for offset in range(start, end, chunk_size):
+                blocks.append((offset, min(chunk_size, end - offset)))
+
+        return blocks
+
+    def downloaded(self):
+
+        with self.lock:
+            return sum(end - start for start, end in self.ranges)
+
+    def close(self):
+
+        if (self.fd is not None):
+            os.close(self.fd)
+            self.fd = None
+
+    def finish(self):
+        '''
+        Check the hash of the finished file and move it into place.
+        A file that doesn't match is thrown away. Returns whether the
+        hash matched.
+        '''
+
+        self.close()
+
+        if (hash_file(self.part_path) != self.hash):
+            self.discard()
+            return False
+
+        os.replace(self.part_path, self.path)
+
+        # Empty files finish without a piece ever being recorded
+        if (os.path.exists(self.sidecar_path)):
+            os.remove(self.sidecar_path)
+
+        return True
+
+    def discard(self):
+
+        self.close()
+
+        for path in [self.part_path, self.sidecar_path]:
+            if (os.path.exists(path)):
+                os.remove(path)
+
+def add_range(ranges, start, end):
+    '''
+    Add [start, end) to a sorted list of ranges, merging any that
+    overlap or touch.
+    '''
+
+    merged = []
+
+    for r_start, r_end in ranges:
+        if (r_end < start or r_start > end):
+            merged.append((r_start, r_end))
+        else:
+            start = min(start, r_start)
+            end = max(end, r_end)
+
+    merged.append((start, end))
+    merged.sort()
+
+    return merged
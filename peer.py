@@ -1,13 +1,220 @@
 #!/usr/bin/env python3
 
-import base64
 import json
 import os.path
 import socket
+import threading
 from typing import List
 
 import constant
-from track import Track, hash_file
+import framing
+from partfile import PartFile
+from ratelimit import BandwidthScheduler
+from track import Track
+from tracklist import decode_track_list, is_track_list
+
+# Shares our download rate between the peers we download from
+downloads = BandwidthScheduler(constant.BW_DOWN, constant.BW_PEER_DOWN)
+
+class Reply:
+    '''
+    The reply to one request, filled in by the connection's reader
+    thread as frames arrive.
+    '''
+
+    def __init__(self, req_id):
+
+        self.id = req_id
+        self.event = threading.Event()
+        self.chunks = []
+        self.data = None
+        self.error = None
+
+        # Bytes arrived so far
+        self.received = 0
+
+    def feed(self, flags, payload):
+        '''
+        Add a frame. Returns whether the reply is complete.
+        '''
+
+        if (flags & framing.ERROR):
+            self.error = payload.decode()
+            self.event.set()
+            return True
+
+        self.chunks.append(payload)
+        self.received += len(payload)
+
+        if (flags & framing.MORE):
+            return False
+
+        # A reply in a single frame is kept as is
+        if (len(self.chunks) == 1):
+            self.data = self.chunks[0]
+        else:
+            self.data = b''.join(self.chunks)
+
+        self.chunks = []
+        self.event.set()
+
+        return True
+
+    def fail(self):
+
+        self.event.set()
+
+class Connection:
+    '''
+    One TCP connection to a peer.
+
+    Every request is tagged with an id, so several can be in flight
+    at once and their replies can arrive in any order. A reader
+    thread hands each reply to the request waiting on it.
+    '''
+
+    def __init__(self, peer):
+
+        self.peer = peer
+        self.cli = peer.cli
+
+        # Set once the connection can't be used any more
+        self.broken = False
+
+        self.sock = socket.create_connection(peer.to_tuple(), timeout=constant.CONNECT_TIMEOUT_S)
+        self.sock.settimeout(None)
+
+        self.next_id = 1
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True
+        thread.start()
+
+    def send(self, data, is_str=True, is_json=False):
+        '''
+        Send a request. Returns a `Reply` to wait on, or `None` if
+        sending failed.
+        '''
+
+        if (is_json):
+            data = json.dumps(data)
+
+        if (is_str or is_json):
+            data = data.encode()
+
+        with self.lock:
+            reply = Reply(self.next_id)
+            self.pending[reply.id] = reply
+            self.next_id += 1
+
+        try:
+            with self.send_lock:
+                framing.send_frame(self.sock, reply.id, data)
+            self.cli.log(f'Sent {len(data)} bytes to {self.peer}')
+        except:
+            self.cli.log('Failed to send data')
+            self.close()
+            return None
+
+        return reply
+
+    def recv(self, reply, timeout=5, to_str=True, to_json=False):
+        '''
+        Wait for a reply. Returns `None` if the peer sent back an error,
+        or if `timeout` passes without any of the reply arriving.
+        '''
+
+        # A reply held back by the sender's upload limit is slow, but
+        # it isn't timed out while chunks keep coming
+        received = 0
+        while (not reply.event.wait(timeout) and reply.received > received):
+            received = reply.received
+
+        if (not reply.event.is_set()):
+            self.cli.log('Request timed out')
+
+            # Drop whatever arrives for it later
+            with self.lock:
+                self.pending.pop(reply.id, None)
+
+            return None
+
+        if (reply.error is not None):
+            self.cli.log(f'{self.peer} refused request: {reply.error}')
+            return None
+
+        resp = reply.data
+        if (resp is None):
+            return None
+
+        if (to_str or to_json):
+            resp = resp.decode()
+
+        if (to_json):
+            resp = json.loads(resp)
+
+        return resp
+
+    def load(self):
+        '''
+        Number of requests waiting on a reply.
+        '''
+
+        return len(self.pending)
+
+    def run(self):
+        '''
+        Route incoming frames to the requests waiting on them.
+        '''
+
+        while True:
+            try:
+                frame = framing.recv_frame(self.sock)
+            except OSError:
+                frame = None
+
+            if (frame is None):
+                break
+
+            req_id, flags, payload = frame
+
+            with self.lock:
+                reply = self.pending.get(req_id)
+
+            # Reply to a request that already timed out
+            if (reply is None):
+                continue
+
+            if (reply.feed(flags, payload)):
+                with self.lock:
+                    self.pending.pop(req_id, None)
+
+        if (not self.broken):
+            self.cli.log(f'Connection to {self.peer} closed')
+
+        self.close()
+
+    def close(self):
+
+        self.broken = True
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        self.sock.close()
+
+        # Wake up everyone still waiting
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending = {}
+
+        for reply in pending:
+            reply.fail()
 
 class Peer:
 
@@ -39,40 +246,116 @@ class Peer:
 
         peers = []
         for peer_info in json_dict['peers']:
-            peers.append(Peer(cli, peer_info['host'], peer_info['port']))
+            peers.append(Peer(cli, peer_info['host'], peer_info['port'], reputation=peer_info.get('reputation', 0)))
 
         return peers
 
-    def __init__(self, cli, host, port, connected=False):
+    def __init__(self, cli, host, port, connected=False, reputation=0):
 
         self.host = host
         self.port = int(port)
         self.connected = connected
-        self.tcp_conn = None
         self.cli = cli
 
-    def connect(self):
+        # Lowered when the peer sends tracks that fail verification
+        self.reputation = reputation
 
-        # Initialize a TCP client socket using SOCK_STREAM
-        if (self.tcp_conn is None):
-            self.tcp_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Open connections, up to PEER_POOL_SIZE at once
+        self.pool = []
+        self.pool_opening = 0
+        self.pool_lock = threading.Lock()
 
-        try:
-            # Establish connection to TCP server and exchange data
-            self.tcp_conn.connect(self.to_tuple())
-            self.connected = True
-            self.cli.log(f'Connected to {self}')
-        except ConnectionRefusedError:
+        # Last catalog seen from this peer, for incremental track lists
+        self.catalog_id = None
+        self.catalog_version = 0
+        self.track_hashes = set()
+
+    def connect(self):
+
+        # Establish a first connection and keep it in the pool
+        conn = self.acquire()
+        if (conn is None):
             self.connected = False
             self.cli.log(f'Connection to {self} failed')
             return False
 
+        self.connected = True
+        self.cli.log(f'Connected to {self}')
+
         return True
 
     def is_connected(self):
 
         return self.connected
 
+    def is_trusted(self):
+
+        return self.reputation >= constant.MIN_REPUTATION
+
+    def penalize(self, amount=constant.VERIFY_PENALTY):
+
+        self.reputation -= amount
+        self.cli.log(f'Reputation of {self} is now {self.reputation}')
+
+    def reward(self):
+
+        # Good behaviour slowly earns back lost reputation
+        self.reputation = min(0, self.reputation + 1)
+
+    def acquire(self):
+        '''
+        Pick the least busy connection in the pool. A new connection
+        is opened while every existing one is busy and the pool has
+        room. Returns `None` if the peer can't be reached.
+        '''
+
+        with self.pool_lock:
+            self.pool = [conn for conn in self.pool if not conn.broken]
+
+            best = min(self.pool, key=lambda conn: conn.load(), default=None)
+
+            open_count = len(self.pool) + self.pool_opening
+            if (best is not None and (best.load() == 0 or open_count >= constant.PEER_POOL_SIZE)):
+                return best
+
+            self.pool_opening += 1
+
+        try:
+            conn = Connection(self)
+        except OSError:
+            conn = best
+        else:
+            with self.pool_lock:
+                self.pool.append(conn)
+        finally:
+            with self.pool_lock:
+                self.pool_opening -= 1
+
+        return conn
+
+    def request(self, data, timeout=5, to_str=True, to_json=False, is_json=True):
+        '''
+        Send a request and wait for the reply. Requests share the
+        pooled connections, so a slow reply doesn't hold up others.
+        Returns `None` if the request fails.
+        '''
+
+        # A pooled connection may have been closed by the other end,
+        # in which case try once more on a fresh one
+        for attempt in range(2):
+
+            conn = self.acquire()
+            if (conn is None):
+                return None
+
+            reply = conn.send(data, is_json=is_json)
+            if (reply is not None):
+                resp = conn.recv(reply, timeout=timeout, to_str=to_str, to_json=to_json)
+                if (resp is not None or not conn.broken):
+                    return resp
+
+        return None
+
     def ping(self):
         '''
         Check if the peer is alive.
@@ -81,8 +364,7 @@ class Peer:
         if (not self.connected):
             return False
 
-        self.send('ping')
-        resp = self.recv(timeout=1)
+        resp = self.request('ping', timeout=1, is_json=False)
 
         self.connected = (resp == 'pong')
 
@@ -92,149 +374,172 @@ class Peer:
 
         return self.connected
 
-    def request_track_list(self):
+    def request_peers(self, port):
         '''
-        Fetch the list of available tracks.
+        Swap addresses with the peer: it learns that we listen on
+        `port` and sends back some of the peers it knows. Returns a
+        list of (host, port) tuples.
+        '''
+
+        resp = self.request({'action': 'get_peers', 'port': port}, timeout=2, to_json=True)
+        if (resp is None):
+            return []
+
+        return [(host, int(port)) for host, port in resp['peers']]
+
+    def request_track_list(self, full=False):
+        '''
+        Fetch the changes to the peer's track list since the last
+        request. Returns a tuple of (new tracks, removed hashes).
+
+        The whole list is fetched the first time, when `full` is
+        set, or when the peer can no longer send a delta.
         '''
 
         self.cli.log(f'Requesting track list for {self}...')
 
-        self.send({'action': 'get_track_list'}, is_json=True)
-        json_dict = self.recv(to_json=True)
+        req = {'action': 'get_track_list', 'format': 'binary'}
+        if (not full and self.catalog_id is not None):
+            req['catalog'] = self.catalog_id
+            req['since'] = self.catalog_version
 
-        if (json_dict is None):
+        resp = self.request(req, to_str=False)
+
+        if (resp is None):
             self.cli.log('Request failed')
             return None
 
-        tracks = []
-        for track_dict in json_dict['tracks']:
+        # Never held back, but it counts against the download limits
+        downloads.control(self.host, len(resp))
+
+        # Older peers ignore the format and answer in JSON
+        try:
+            if (is_track_list(resp)):
+                json_dict = decode_track_list(resp, self)
+                tracks = json_dict['tracks']
+            else:
+                json_dict = json.loads(resp)
+                tracks = [Track.from_dict(track_dict, self) for track_dict in json_dict['tracks']]
+        except ValueError as e:
+            self.cli.log(f'Bad track list from {self}: {e}')
+            return None
+
+        new_hashes = set(track.hash for track in tracks)
 
-            track = Track.from_dict(track_dict, self)
-            self.cli.log(f"Found track '{track.title}'")
+        if (json_dict['full']):
+            removed = self.track_hashes - new_hashes
+            self.track_hashes = new_hashes
+        else:
+            removed = set(json_dict['removed'])
+            self.track_hashes -= removed
+            self.track_hashes |= new_hashes
 
-            tracks.append(track)
+        self.catalog_id = json_dict['catalog']
+        self.catalog_version = json_dict['version']
 
-        return tracks
+        kind = 'full' if json_dict['full'] else 'delta'
+        self.cli.log(f'Got {kind} track list from {self}: {len(tracks)} added, {len(removed)} removed')
 
-    def request_track(self, track):
+        return tracks, removed
 
-        self.cli.log(f"Requesting '{track}'...")
+    def request_track(self, track, job=None):
+        '''
+        Download a track from this peer one range at a time. Progress
+        is kept in a part file, so a dropped connection or a cancelled
+        `job` can resume from where it stopped.
+        '''
 
-        self.send({'action': 'get_track', 'hash': track.hash}, is_json=True)
-        json_dict = self.recv(to_json=True)
+        self.cli.log(f"Requesting '{track}'...")
 
-        if (json_dict is None):
-            self.cli.log('Request failed')
+        info = self.request_pieces(track)
+        if (info is None):
             return False
 
-        b64_data = json_dict['fileData']
-
         file_name = f'{track.hash}.{track.extension}'
         file_path = os.path.join(constant.FILE_PREFIX, file_name)
-        file_data = base64.b64decode(b64_data)
 
-        with open(file_path, 'wb') as f:
-            f.write(file_data)
+        part = PartFile(file_path, track.hash, info['size'])
 
-        self.cli.log(f'Wrote {file_name}')
+        done = part.downloaded()
+        if (done > 0):
+            self.cli.log(f"Resuming download at {done} of {info['size']} bytes")
 
-        final_hash = hash_file(file_path)
+        if (job is not None):
+            job.set_total(info['size'], done)
 
-        if (track.hash != final_hash):
-            self.cli.log('Track hashes did not match! File may have been corrupted')
-        else:
-            self.cli.log('File hashes match')
+        try:
+            for offset, length in part.missing(constant.PIECE_SIZE):
 
-        # Mark the file as local
-        track.local = True
-        track.path = file_name
+                if (job is not None and job.cancelled()):
+                    self.cli.log('Download cancelled, it can be resumed later')
+                    return False
 
-        self.cli.log('Download successful')
+                data = self.request_range(track, offset, length)
 
-        return True
+                if (data is None or len(data) != length):
+                    self.cli.log('Request failed, the download can be resumed later')
+                    return False
 
-    def send(self, data, is_str=True, is_json=False):
-        '''
-        Send data.
-        '''
+                part.write(offset, data)
 
-        if (is_json):
-            data = json.dumps(data)
+                if (job is not None):
+                    job.advance(length)
+        finally:
+            part.close()
 
-        if (is_str or is_json):
-            data = data.encode()
+        self.cli.log(f'Wrote {file_name}')
 
-        try:
-            self.tcp_conn.sendall(data)
-            self.tcp_conn.sendall('\r\n\r\n'.encode())
-            self.cli.log(f'Sent {len(data)} bytes to {self}')
-        except:
-            self.cli.log('Failed to send data')
+        if (not part.finish()):
+            self.cli.log('Track hashes did not match! File may have been corrupted')
             return False
 
-        return True
-
-    def read_into_buffer(self):
-        '''
-        Read bytes into a buffer until seeing \r\n\r\n.
-        '''
-
-        buffer = bytes()
+        self.cli.log('File hashes match')
 
-        while True:
-            try:
-                received = self.tcp_conn.recv(constant.MAX_SOCK_READ)
-                buffer += received
-            except socket.timeout:
-                self.cli.log('Request timed out')
-                return None
+        # Mark the file as local
+        track.local = True
+        track.path = file_path
 
-            if (received is None or len(received) == 0):
-                self.cli.log(f'Connection to {self} closed')
-                self.disconnect()
-                return None
+        self.cli.log('Download successful')
 
-            try:
-                last_four = buffer[-4:]
-                last_four = last_four.decode()
+        return True
 
-                if (last_four == '\r\n\r\n'):
-                    buffer = buffer[:-4]
-                    break
+    def request_pieces(self, track):
+        '''
+        Fetch the size of a track and the SHA-256 hash of each of
+        its pieces.
+        '''
 
-            except Exception as e:
-                self.cli.log(e)
+        json_dict = self.request({'action': 'get_pieces', 'hash': track.hash}, to_json=True)
 
-        self.cli.log(f'Buffered {len(buffer)} bytes')
+        if (json_dict is None):
+            self.cli.log('Request failed')
 
-        return buffer
+        return json_dict
 
-    def recv(self, timeout=5, to_str=True, to_json=False):
+    def request_range(self, track, offset, length):
         '''
-        Read from the socket. Returns `None` if response does
-        not arrive before `timeout`.
+        Fetch `length` bytes of a track starting at `offset`, once the
+        download limits let it.
         '''
 
-        self.tcp_conn.settimeout(timeout)
+        downloads.acquire(self.host, length)
 
-        resp = self.read_into_buffer()
-        if (resp is None):
-            return None
-
-        if (to_str or to_json):
-            resp = resp.decode()
-
-        if (to_json):
-            resp = json.loads(resp)
-
-        return resp
+        return self.request({
+            'action': 'get_track_range',
+            'hash': track.hash,
+            'offset': offset,
+            'length': length
+        }, to_str=False)
 
     def disconnect(self):
 
-        if (self.tcp_conn):
-            self.tcp_conn.close()
+        with self.pool_lock:
+            pool = self.pool
+            self.pool = []
+
+        for conn in pool:
+            conn.close()
 
-        self.tcp_conn = None
         self.connected = False
 
         self.cli.log(f'Disconnected from {self}')
@@ -263,7 +568,8 @@ class Peer:
 
         return {
             'host': self.host,
-            'port': self.port
+            'port': self.port,
+            'reputation': self.reputation
         }
 
 if (__name__ == '__main__'):
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+import asyncio
+import math
+import threading
+import time
+
+import constant
+
+class TokenBucket:
+    '''
+    Token bucket rate limiter. Tokens refill continuously at `rate`
+    per second and at most `capacity` can be saved up for a burst.
+    '''
+
+    def __init__(self, rate: float, capacity: float = None):
+
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def try_acquire(self, n: float = 1) -> float:
+        '''
+        Take `n` tokens if they are available. Returns 0 on success,
+        otherwise the number of seconds until they will be.
+        '''
+
+        with self.lock:
+            self.refill()
+
+            if (self.tokens >= n):
+                self.tokens -= n
+                return 0
+
+            return (n - self.tokens) / self.rate
+
+    def acquire(self, n: float = 1):
+        '''
+        Block until `n` tokens have been taken.
+        '''
+
+        while True:
+            wait = self.try_acquire(n)
+            if (wait == 0):
+                return
+
+            time.sleep(wait)
+
+    def delay(self, n: float) -> float:
+        '''
+        Seconds until a chunk of `n` tokens may go. A chunk bigger
+        than the bucket only has to wait for a full bucket.
+        '''
+
+        with self.lock:
+            self.refill()
+            return max(0, (min(n, self.capacity) - self.tokens) / self.rate)
+
+    def spend(self, n: float):
+        '''
+        Take `n` tokens without waiting. The bucket may go into debt,
+        which later chunks wait off.
+        '''
+
+        with self.lock:
+            self.refill()
+            self.tokens -= n
+
+def byte_bucket(rate):
+    '''
+    Bucket for a byte rate, or `None` for 0, which is unlimited. A
+    fraction of a second of traffic can burst, but never less than
+    one chunk.
+    '''
+
+    if (rate <= 0):
+        return None
+
+    return TokenBucket(rate, max(rate * constant.BW_BURST_S, constant.STREAM_CHUNK))
+
+class Flow:
+    '''
+    Transfers to or from one host.
+    '''
+
+    def __init__(self, host, weight, rate):
+
+        self.host = host
+        self.weight = weight
+        self.bucket = byte_bucket(rate)
+
+        # Virtual time the last chunk queued for this host finishes at
+        self.finish = 0
+
+        # Bytes counted so far, and recently with older bytes decayed
+        self.total = 0
+        self.recent = 0
+        self.recent_time = time.monotonic()
+
+    def count(self, n):
+
+        self.decay()
+        self.recent += n
+        self.total += n
+
+    def decay(self):
+
+        now = time.monotonic()
+        self.recent *= 0.5 ** ((now - self.recent_time) / constant.BW_HALF_LIFE_S)
+        self.recent_time = now
+
+    def rate(self):
+        '''
+        Recent bytes per second.
+        '''
+
+        self.decay()
+        return self.recent * math.log(2) / constant.BW_HALF_LIFE_S
+
+class Ticket:
+    '''
+    A chunk waiting for its turn.
+    '''
+
+    def __init__(self, flow, n, start, seq):
+
+        self.flow = flow
+        self.n = n
+        self.start = start
+        self.finish = start + n / flow.weight
+        self.seq = seq
+
+    def __lt__(self, other):
+
+        return (self.finish, self.seq) < (other.finish, other.seq)
+
+class BandwidthScheduler:
+    '''
+    Shares a global byte rate, and a rate for each host, between the
+    transfers going one way.
+
+    Transfers ask for each chunk before it goes. While a limit makes
+    them wait, chunks go in weighted fair queuing order: a chunk
+    finishes, in virtual time, its size over its host's weight after
+    the host's previous chunk, and the earliest finish whose host is
+    under its own limit goes next. A host with weight 2 gets twice
+    the share of one with weight 1, and a greedy downloader can't
+    crowd out the rest.
+
+    Control traffic doesn't queue. `control` counts it against the
+    limits without waiting, so pings and track lists go first and
+    bulk transfers make up for them afterwards.
+
+    A rate of 0 is unlimited.
+    '''
+
+    def __init__(self, rate=0, peer_rate=0):
+
+        self.rate = rate
+        self.peer_rate = peer_rate
+        self.bucket = byte_bucket(rate)
+
+        # Host -> Flow, and weights set for hosts
+        self.flows = {}
+        self.weights = {}
+
+        self.queue = []
+        self.seq = 0
+        self.virtual_time = 0
+
+        self.condition = threading.Condition()
+
+    def set_rates(self, rate=None, peer_rate=None):
+        '''
+        Change the limits, transfers already running included.
+        '''
+
+        with self.condition:
+            if (rate is not None):
+                self.rate = rate
+                self.bucket = byte_bucket(rate)
+
+            if (peer_rate is not None):
+                self.peer_rate = peer_rate
+                for flow in self.flows.values():
+                    flow.bucket = byte_bucket(peer_rate)
+
+            self.condition.notify_all()
+
+    def set_weight(self, host, weight):
+
+        with self.condition:
+            self.weights[host] = weight
+            if (host in self.flows):
+                self.flows[host].weight = weight
+
+    def limited(self):
+
+        return self.bucket is not None or self.peer_rate > 0
+
+    def flow(self, host):
+
+        flow = self.flows.get(host)
+        if (flow is None):
+            flow = Flow(host, self.weights.get(host, 1), self.peer_rate)
+            self.flows[host] = flow
+
+        return flow
+
+    def control(self, host, n):
+        '''
+        Count `n` bytes of control traffic. Never waits.
+        '''
+
+        with self.condition:
+            flow = self.flow(host)
+
+            for bucket in [self.bucket, flow.bucket]:
+                if (bucket is not None):
+                    bucket.spend(n)
+
+            flow.count(n)
+
+    def enqueue(self, host, n):
+
+        with self.condition:
+            flow = self.flow(host)
+
+            self.seq += 1
+            ticket = Ticket(flow, n, max(self.virtual_time, flow.finish), self.seq)
+            flow.finish = ticket.finish
+
+            self.queue.append(ticket)
+
+            return ticket
+
+    def grant(self, ticket):
+        '''
+        Let a queued chunk go if it's its turn. Returns 0 once it has,
+        otherwise how long to wait before asking again. Call with the
+        condition held.
+        '''
+
+        for queued in sorted(self.queue):
+
+            # Hosts over their own limit don't hold up the others
+            if (queued.flow.bucket is not None and queued.flow.bucket.delay(queued.n) > 0):
+                continue
+
+            if (queued is not ticket):
+                break
+
+            if (self.bucket is not None):
+                wait = self.bucket.delay(ticket.n)
+                if (wait > 0):
+                    return wait
+
+                self.bucket.spend(ticket.n)
+
+            if (ticket.flow.bucket is not None):
+                ticket.flow.bucket.spend(ticket.n)
+
+            self.queue.remove(ticket)
+            self.virtual_time = max(self.virtual_time, ticket.start)
+            ticket.flow.count(ticket.n)
+
+            # The next chunk in line may be able to go now
+            self.condition.notify_all()
+
+            return 0
+
+        return constant.BW_POLL_S
+
+    def acquire(self, host, n):
+        '''
+        Wait for the turn of an `n` byte chunk to or from `host`.
+        '''
+
+        if (not self.limited()):
+            with self.condition:
+                self.flow(host).count(n)
+            return
+
+        ticket = self.enqueue(host, n)
+
+        with self.condition:
+            while True:
+                wait = self.grant(ticket)
+                if (wait == 0):
+                    return
+
+                self.condition.wait(min(wait, constant.BW_POLL_S))
+
+    async def acquire_async(self, host, n):
+        '''
+        `acquire` for the asyncio server, which mustn't block.
+        '''
+
+        if (not self.limited()):
+            with self.condition:
+                self.flow(host).count(n)
+            return
+
+        ticket = self.enqueue(host, n)
+
+        try:
+            while True:
+                with self.condition:
+                    wait = self.grant(ticket)
+
+                if (wait == 0):
+                    return
+
+                await asyncio.sleep(min(wait, constant.BW_POLL_S))
+
+        except asyncio.CancelledError:
+            # Don't leave the chunk holding up the queue
+            with self.condition:
+                if (ticket in self.queue):
+                    self.queue.remove(ticket)
+                    self.condition.notify_all()
+            raise
+
+    def stats(self):
+        '''
+        (host, weight, recent bytes per second, total bytes) for each
+        host, busiest first.
+        '''
+
+        with self.condition:
+            stats = [(flow.host, flow.weight, flow.rate(), flow.total) for flow in self.flows.values()]
+
+        return sorted(stats, key=lambda stat: stat[2], reverse=True)
+
+def parse_rate(text):
+    '''
+    A byte rate like '500K' or '2M' per second. 'off' and '0' are
+    unlimited. Raises `ValueError` for anything else.
+    '''
+
+    text = text.strip().upper()
+
+    for suffix in ['/S', 'B']:
+        if (text.endswith(suffix)):
+            text = text[:-len(suffix)]
+
+    if (text in ['OFF', 'NONE']):
+        return 0
+
+    scale = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}.get(text[-1:], 1)
+    if (scale > 1):
+        text = text[:-1]
+
+    rate = float(text) * scale
+    if (not math.isfinite(rate)):
+        raise ValueError(f'{text} isn\'t a rate')
+
+    if (rate < 0):
+        raise ValueError('rates can\'t be negative')
+
+    return int(rate)
+
+def format_rate(rate):
+
+    if (rate <= 0):
+        return 'unlimited'
+
+    for unit, scale in [('MB/s', 1 << 20), ('KB/s', 1 << 10)]:
+        if (rate >= scale):
+            return f'{rate / scale:.1f} {unit}'
+
+    return f'{rate:.0f} B/s'
+
+if (__name__ == '__main__'):
+
+    # Hosts pushing chunks as fast as the scheduler lets them, like
+    # concurrent uploads on the server's worker threads
+    def transfer(scheduler, host, until, sent):
+        while time.monotonic() < until:
+            scheduler.acquire(host, constant.STREAM_CHUNK)
+            sent[host] += constant.STREAM_CHUNK
+
+    def run(name, scheduler, hosts, seconds=3):
+        '''
+        `hosts` maps each host to the number of transfers it has going.
+        '''
+
+        sent = {host: 0 for host in hosts}
+        until = time.monotonic() + seconds
+
+        threads = [
+            threading.Thread(target=transfer, args=(scheduler, host, until, sent))
+            for host, count in hosts.items() for _ in range(count)
+        ]
+
+        # Control traffic sent in the middle of it all
+        def pings():
+            while time.monotonic() < until:
+                start = time.perf_counter()
+                scheduler.control('pinger', 64)
+                latencies.append(time.perf_counter() - start)
+                time.sleep(0.1)
+
+        latencies = []
+        threads.append(threading.Thread(target=pings))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        print(name)
+        total = sum(sent.values())
+        for host in hosts:
+            flow = scheduler.flows[host]
+            print(f'  {host:8s} weight {flow.weight}: {format_rate(sent[host] / seconds):>12s} ({sent[host] / total:5.1%})')
+        print(f'  total            {format_rate(total / seconds):>12s}')
+        print(f'  control traffic waited at most {max(latencies) * 1e6:.0f} us')
+
+    scheduler = BandwidthScheduler(rate=4 << 20)
+    run('4 MB/s shared by three hosts', scheduler, {'a': 2, 'b': 2, 'c': 2})
+
+    scheduler = BandwidthScheduler(rate=4 << 20)
+    scheduler.set_weight('c', 2)
+    run('Host c with weight 2', scheduler, {'a': 2, 'b': 2, 'c': 2})
+
+    scheduler = BandwidthScheduler(rate=4 << 20)
+    run('Greedy host with five transfers against one', scheduler, {'greedy': 5, 'modest': 1})
+
+    scheduler = BandwidthScheduler(rate=4 << 20, peer_rate=512 << 10)
+    run('512 KB/s per host', scheduler, {'a': 2, 'b': 2, 'c': 2})
+
+    # Lowered while the transfers run
+    scheduler = BandwidthScheduler(rate=4 << 20)
+    threading.Timer(1.5, scheduler.set_rates, kwargs={'rate': 1 << 20}).start()
+    run('4 MB/s lowered to 1 MB/s half way', scheduler, {'a': 2, 'b': 2})
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import fnmatch
+import os
+
+import filetype
+
+import constant
+
+# Trusted when the first bytes don't match anything filetype knows,
+# e.g. MP3s without an ID3 tag that start mid-frame
+AUDIO_EXTENSIONS = {'.aac', '.aiff', '.ape', '.flac', '.m4a', '.mp3', '.ogg', '.opus', '.wav', '.wma'}
+
+def relative_path(path, roots=None):
+    '''
+    Where `path` is below the content root it's in, or just its name
+    if it isn't in any of `roots`. How a root was written, such as
+    './music', never takes part in matching.
+    '''
+
+    roots = constant.CONTENT_PATHS if roots is None else roots
+    path = os.path.abspath(path)
+
+    for root in roots:
+        relative = os.path.relpath(path, os.path.abspath(root))
+        if (relative != os.curdir and relative != os.pardir and not relative.startswith(os.pardir + os.sep)):
+            return relative
+
+    return os.path.basename(path)
+
+def set_aside(path):
+    '''
+    Whether `path` is in the quarantine or unverified folder, which
+    are never indexed even if a content folder contains them.
+    '''
+
+    path = os.path.abspath(path)
+
+    for folder in [constant.QUARANTINE_FOLDER, constant.UNVERIFIED_FOLDER]:
+        folder = os.path.abspath(folder)
+        if (path == folder or path.startswith(folder + os.sep)):
+            return True
+
+    return False
+
+def matches(path, patterns, roots=None):
+    '''
+    Whether the file name of `path`, or the path below its content
+    root, matches any of the glob patterns.
+    '''
+
+    relative = relative_path(path, roots)
+    name = os.path.basename(relative)
+
+    for pattern in patterns:
+        if (fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative, pattern)):
+            return True
+
+    return False
+
+def excluded(path, patterns, roots=None):
+    '''
+    Whether the path below its content root, or any file or folder
+    name on the way down to it, matches any of the glob patterns.
+    Set aside files are always excluded.
+    '''
+
+    if (set_aside(path)):
+        return True
+
+    relative = relative_path(path, roots)
+    parts = relative.split(os.sep)
+
+    for pattern in patterns:
+        if (fnmatch.fnmatch(relative, pattern) or any(fnmatch.fnmatch(part, pattern) for part in parts)):
+            return True
+
+    return False
+
+def is_wanted(path, include=None, exclude=None, roots=None):
+    '''
+    Whether a file should be indexed at all, going only by its path.
+    '''
+
+    include = constant.INCLUDE_GLOBS if include is None else include
+    exclude = constant.EXCLUDE_GLOBS if exclude is None else exclude
+
+    # Unfinished downloads
+    if (path.endswith('.part') or path.endswith('.part.json')):
+        return False
+
+    if (excluded(path, exclude, roots)):
+        return False
+
+    return len(include) == 0 or matches(path, include, roots)
+
+def is_audio(path):
+    '''
+    Cheap check of a file's first bytes, so cover art, playlists and
+    the like never reach the decoder.
+    '''
+
+    try:
+        kind = filetype.guess(path)
+    except OSError:
+        return False
+
+    if (kind is None):
+        return os.path.splitext(path)[1].lower() in AUDIO_EXTENSIONS
+
+    # Audio tracks inside video containers decode just as well
+    return kind.mime.split('/')[0] in ['audio', 'video']
+
+def walk(roots, include=None, exclude=None):
+    '''
+    Yield the path of every wanted file under each root, however deep.
+    Directories matching an exclude glob are skipped entirely. Globs
+    are matched below the content root a file is in, or below the
+    root it was found under if that's not in a content root.
+    '''
+
+    exclude = constant.EXCLUDE_GLOBS if exclude is None else exclude
+
+    # Content roots first, a folder walked on its own is inside one
+    match_roots = list(constant.CONTENT_PATHS) + list(roots)
+
+    stack = list(reversed(roots))
+    while len(stack) > 0:
+        folder = stack.pop()
+
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            continue
+
+        subfolders = []
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            try:
+                if (entry.is_dir()):
+                    if (not excluded(entry.path, exclude, match_roots)):
+                        subfolders.append(entry.path)
+
+                elif (entry.is_file() and is_wanted(entry.path, include, exclude, match_roots)):
+                    yield entry.path
+
+            except OSError:
+                # Deleted while we looked
+                continue
+
+        stack.extend(reversed(subfolders))
+
+if (__name__ == '__main__'):
+
+    import shutil
+    import tempfile
+    import time
+
+    # 50k files in artist/album folders, a third of them cover art
+    root = tempfile.mkdtemp()
+
+    mp3 = b'ID3\x03\x00\x00\x00\x00\x00\x00' + bytes(300)
+    jpeg = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00' + bytes(300)
+
+    n_files = 0
+    for artist in range(500):
+        for album in range(10):
+            folder = os.path.join(root, f'Artist {artist}', f'Album {album}')
+            os.makedirs(folder)
+
+            for song in range(7):
+                with open(os.path.join(folder, f'{song:02d} Song.mp3'), 'wb') as f:
+                    f.write(mp3)
+
+            for name in ['cover.jpg', 'folder.jpg', 'back.jpg']:
+                with open(os.path.join(folder, name), 'wb') as f:
+                    f.write(jpeg)
+
+            n_files += 10
+
+    try:
+        start = time.perf_counter()
+        paths = list(walk([root], include=[], exclude=['.*']))
+        walked = time.perf_counter() - start
+
+        start = time.perf_counter()
+        audio = [path for path in paths if is_audio(path)]
+        filtered = time.perf_counter() - start
+
+        print(f'{n_files} files, walked in {walked:.2f} s')
+        print(f'{len(audio)} would be decoded, {len(paths) - len(audio)} skipped by magic bytes in {filtered:.2f} s')
+    finally:
+        shutil.rmtree(root)
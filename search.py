@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+import bisect
+import heapq
+import re
+import sys
+import threading
+
+import constant
+
+TOKEN = re.compile(r'\w+')
+
+# Durations typed as m:ss
+DURATION = re.compile(r'^(\d+):([0-5]\d)$')
+
+def tokenize(text):
+
+    return TOKEN.findall(text.lower())
+
+def common_prefix(a, b):
+
+    n = 0
+    for x, y in zip(a, b):
+        if (x != y):
+            break
+        n += 1
+
+    return n
+
+class SearchIndex:
+    '''
+    In-memory index for finding tracks by title, artist, duration
+    or hash.
+
+    Words map to the tracks they appear in, each known by the 32-byte
+    digest the track already holds rather than a hex string. Query
+    words also match longer words they are a prefix of, found with a
+    binary search over the sorted vocabulary. Digests are kept in a
+    sorted list too, in the same order as their hex, which answers
+    hash prefix lookups the way a trie would without a node object
+    per character.
+
+    The sorted lists are rebuilt lazily on the first lookup after a
+    change, so adding a whole track list costs one sort.
+
+    Results are looked up in `tracks`, normally the client's track
+    store, so the index doesn't hold on to tracks itself. Without one
+    it keeps its own dictionary.
+    '''
+
+    def __init__(self, tracks=None):
+
+        self.own_tracks = tracks is None
+        self.tracks = {} if tracks is None else tracks
+
+        # Word -> digests, and digest -> its words and length in
+        # seconds for removal
+        self.postings = {}
+        self.words = {}
+
+        # Whole seconds -> digests
+        self.durations = {}
+
+        self.sorted_words = []
+        self.sorted_hashes = []
+        self.dirty = False
+
+        self.lock = threading.Lock()
+
+    def add(self, track):
+        '''
+        Index a track, or re-index it after its title or artist changed.
+        '''
+
+        digest = track.digest
+
+        # One copy of each word, shared by every track it's in
+        words = tuple(sys.intern(word) for word in set(tokenize(track.title)) | set(tokenize(track.artist)))
+        seconds = int(track.duration)
+
+        with self.lock:
+            self.unindex(digest)
+
+            if (self.own_tracks):
+                self.tracks[digest] = track
+
+            self.words[digest] = (words, seconds)
+
+            for word in words:
+                self.postings.setdefault(word, set()).add(digest)
+
+            self.durations.setdefault(seconds, set()).add(digest)
+
+            self.dirty = True
+
+    def remove(self, file_hash):
+
+        with self.lock:
+            self.unindex(bytes.fromhex(file_hash))
+            self.dirty = True
+
+    def unindex(self, digest):
+
+        if (digest not in self.words):
+            return
+
+        if (self.own_tracks):
+            del self.tracks[digest]
+
+        words, seconds = self.words.pop(digest)
+
+        for word in words:
+            digests = self.postings[word]
+            digests.discard(digest)
+            if (len(digests) == 0):
+                del self.postings[word]
+
+        digests = self.durations[seconds]
+        digests.discard(digest)
+        if (len(digests) == 0):
+            del self.durations[seconds]
+
+    def refresh(self):
+
+        if (self.dirty):
+            self.sorted_words = sorted(self.postings)
+            self.sorted_hashes = sorted(self.words)
+            self.dirty = False
+
+    def prefixed(self, items, prefix, limit=None):
+        '''
+        Items of a sorted list that start with `prefix`.
+        '''
+
+        found = []
+
+        index = bisect.bisect_left(items, prefix)
+        while index < len(items) and items[index].startswith(prefix):
+            if (limit is not None and len(found) >= limit):
+                break
+
+            found.append(items[index])
+            index += 1
+
+        return found
+
+    def prefixed_digests(self, prefix, limit=None):
+        '''
+        Indexed digests whose hex starts with `prefix`.
+        '''
+
+        # The smallest digest the prefix allows, an odd digit padded out
+        try:
+            start = bytes.fromhex(prefix + '0' * (len(prefix) % 2))
+        except ValueError:
+            return []
+
+        found = []
+
+        index = bisect.bisect_left(self.sorted_hashes, start)
+        while index < len(self.sorted_hashes) and self.sorted_hashes[index].hex().startswith(prefix):
+            if (limit is not None and len(found) >= limit):
+                break
+
+            found.append(self.sorted_hashes[index])
+            index += 1
+
+        return found
+
+    def hash_prefix(self, prefix, limit=2):
+        '''
+        Tracks whose hash starts with `prefix`, at most `limit` of
+        them. Asking for two tells whether a prefix is ambiguous.
+        '''
+
+        with self.lock:
+            self.refresh()
+            digests = self.prefixed_digests(prefix.lower(), limit)
+            return self.lookup(digests)
+
+    def unique_prefix(self, file_hash, min_length=constant.HASH_LEN):
+        '''
+        The shortest prefix of `file_hash`, at least `min_length`
+        long, that no other indexed hash starts with.
+        '''
+
+        with self.lock:
+            self.refresh()
+
+            digest = bytes.fromhex(file_hash)
+            index = bisect.bisect_left(self.sorted_hashes, digest)
+
+            length = min_length
+            for neighbour in self.sorted_hashes[max(0, index - 1):index + 2]:
+                if (neighbour != digest):
+                    length = max(length, common_prefix(neighbour.hex(), file_hash) + 1)
+
+            return file_hash[:length]
+
+    def term_matches(self, term):
+        '''
+        Digests matching one query term, with a score for each. Whole
+        words count more than prefixes of longer words.
+        '''
+
+        scores = {}
+
+        match = DURATION.match(term)
+        if (match is not None):
+            seconds = int(match.group(1)) * 60 + int(match.group(2))
+            for near in range(seconds - constant.SEARCH_DURATION_S, seconds + constant.SEARCH_DURATION_S + 1):
+                for digest in self.durations.get(near, ()):
+                    scores[digest] = 2
+
+        for digest in self.postings.get(term, ()):
+            scores[digest] = 3
+
+        words = self.prefixed(self.sorted_words, term, constant.SEARCH_MAX_EXPANSIONS)
+        for word in words:
+            if (word == term):
+                continue
+            for digest in self.postings[word]:
+                scores.setdefault(digest, 1)
+
+        # Hash prefixes, as shown at the start of each track
+        if (len(term) >= 2 and all(c in '0123456789abcdef' for c in term)):
+            for digest in self.prefixed_digests(term, constant.SEARCH_LIMIT):
+                scores[digest] = 4
+
+        return scores
+
+    def search(self, query, limit=constant.SEARCH_LIMIT):
+        '''
+        Tracks matching every word of `query`, best first.
+        '''
+
+        terms = []
+        for part in query.lower().split():
+            if (DURATION.match(part)):
+                terms.append(part)
+            else:
+                terms += tokenize(part)
+
+        if (len(terms) == 0):
+            return []
+
+        with self.lock:
+            self.refresh()
+
+            matches = [self.term_matches(term) for term in set(terms)]
+
+            # Start from the rarest term so the intersection stays small
+            matches.sort(key=len)
+
+            candidates = matches[0]
+            for scores in matches[1:]:
+                candidates = {
+                    digest: score + scores[digest]
+                    for digest, score in candidates.items()
+                    if digest in scores
+                }
+
+            best = heapq.nlargest(limit, candidates.items(), key=lambda item: item[1])
+
+            return self.lookup([digest for digest, _ in best])
+
+    def lookup(self, digests):
+
+        if (self.own_tracks):
+            tracks = [self.tracks.get(digest) for digest in digests]
+        else:
+            tracks = [self.tracks.get(digest.hex()) for digest in digests]
+
+        return [track for track in tracks if track is not None]
+
+    def __len__(self):
+
+        return len(self.words)
+
+if (__name__ == '__main__'):
+
+    import os
+    import random
+    import statistics
+    import time
+
+    from track import Track
+
+    random.seed(0)
+
+    vocabulary = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(random.randint(3, 9))) for _ in range(20000)]
+    artists = [' '.join(random.sample(vocabulary, 2)).title() for _ in range(5000)]
+
+    index = SearchIndex()
+
+    tracks = []
+    for i in range(100000):
+        title = ' '.join(random.sample(vocabulary, random.randint(1, 5))).title()
+        track = Track(title, random.choice(artists), random.randint(90, 420), os.urandom(32).hex(), b'', 'mp3')
+        tracks.append(track)
+
+    start = time.perf_counter()
+    for track in tracks:
+        index.add(track)
+    index.refresh()
+    print(f'Indexed {len(tracks)} tracks in {time.perf_counter() - start:.2f} s')
+
+    def time_queries(function, queries):
+        times = []
+        for query in queries:
+            start = time.perf_counter()
+            function(query)
+            times.append((time.perf_counter() - start) * 1e6)
+        return statistics.median(times), max(times)
+
+    samples = random.sample(tracks, 1000)
+
+    queries = {
+        'one word': [random.choice(tokenize(track.title)) for track in samples],
+        'title and artist': [f'{tokenize(track.title)[0]} {tokenize(track.artist)[0]}' for track in samples],
+        'word prefix': [random.choice(tokenize(track.title))[:3] for track in samples],
+        'hash prefix': [track.hash[:6] for track in samples]
+    }
+
+    for name, batch in queries.items():
+        median, worst = time_queries(index.search, batch)
+        print(f'{name:16s} median {median:7.1f} us, worst {worst:8.1f} us')
+
+    median, worst = time_queries(lambda prefix: index.hash_prefix(prefix), [track.hash[:5] for track in samples])
+    print(f'{"track get":16s} median {median:7.1f} us, worst {worst:8.1f} us')
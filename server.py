@@ -1,15 +1,216 @@
 #!/usr/bin/env python3
 
-import base64
+import functools
 import json
 import os.path
 import socket
 import sys
 import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import constant
+import framing
+from filecache import FileCache
 from peer import Peer
+from ratelimit import BandwidthScheduler
+from track import hash_pieces
+from tracklist import encode_track_list
+
+class SendFile:
+    '''
+    Reply that streams a file, or a range of it, instead of sending
+    a message.
+    '''
+
+    def __init__(self, path, offset=0, length=None):
+
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+class ErrorReply:
+    '''
+    Reply telling the client its request can't be served.
+    '''
+
+    def __init__(self, message):
+
+        self.message = message
+
+# Files being served stay open between requests
+open_files = FileCache()
+
+# Shares our upload rate between the peers downloading from us
+uploads = BandwidthScheduler(constant.BW_UP, constant.BW_PEER_UP)
+
+@functools.lru_cache(maxsize=64)
+def cached_piece_hashes(path, size, mtime, piece_size):
+    '''
+    Piece hashes for a file, reused until the file changes.
+    '''
+
+    return hash_pieces(path, piece_size)
+
+def valid_range(offset, length, size):
+    '''
+    Whether `offset` and `length` are whole numbers picking out bytes
+    within a file of `size` bytes.
+    '''
+
+    for value in [offset, length]:
+        if (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+            return False
+
+    return offset + length <= size
+
+class RequestHandler:
+    '''
+    Request handling shared by the threaded and asyncio servers.
+
+    Subclasses provide `cli`, `peer` and `local_tracks` and take
+    care of reading requests and sending the replies.
+    '''
+
+    def handle_request(self, data):
+        '''
+        Work out the reply to a request. Returns a string or bytes
+        message, a `SendFile`, or an `ErrorReply`.
+        '''
+
+        try:
+            data = data.decode()
+
+            if (data == 'ping'):
+                return 'pong'
+
+            return self.handle_json_req(data)
+
+        except Exception:
+            self.cli.log(traceback.format_exc())
+            return ErrorReply('internal error')
+
+    def local_track(self, track_hash):
+        '''
+        Look up a track we can serve, or `None` if we don't have it.
+        '''
+
+        # Ignore requests for tracks we don't know
+        if (track_hash not in self.local_tracks):
+            return None
+
+        track = self.local_tracks[track_hash]
+
+        # Ignore requests for tracks we don't have
+        if (not track.local):
+            return None
+
+        return track
+
+    def handle_json_req(self, data):
+
+        try:
+            json_req = json.loads(data)
+            action = json_req['action']
+        except:
+            self.cli.log('JSON parse failed')
+            return ErrorReply('malformed request')
+
+        if (action == 'get_track_list'):
+
+            catalog = self.local_tracks
+
+            # Send only what changed if the client's copy is from this catalog
+            changes = None
+            if (json_req.get('catalog') == catalog.id and 'since' in json_req):
+                changes = catalog.changes_since(json_req['since'])
+
+            if (changes is None):
+                version, tracks = catalog.snapshot()
+                removed = []
+            else:
+                version, tracks, removed = changes
+
+            # Peers that understand it get the compact binary list
+            if (json_req.get('format') == 'binary'):
+                return encode_track_list(catalog.id, version, changes is None, tracks, removed)
+
+            json_resp = {
+                'action': 'put_track_list',
+                'catalog': catalog.id,
+                'version': version,
+                'full': changes is None,
+                'tracks': [track.to_dict() for track in tracks],
+                'removed': removed
+            }
+
+        elif (action in ['get_track', 'get_track_range', 'get_pieces']):
+
+            track = self.local_track(json_req['hash'])
+            if (track is None):
+                return ErrorReply(f"unknown track {json_req['hash']}")
+
+            path = track.path
+
+            # Deleted since the watcher last looked
+            if (not os.path.isfile(path)):
+                return ErrorReply(f"track {json_req['hash']} is no longer available")
+
+            if (action == 'get_track'):
+
+                # The file is streamed straight onto the socket,
+                # there is no JSON reply
+                return SendFile(path)
+
+            elif (action == 'get_track_range'):
+
+                offset = json_req.get('offset')
+                length = json_req.get('length')
+
+                # Checked here, a bad range can't be reported once the
+                # first frame header is out
+                if (not valid_range(offset, length, os.path.getsize(path))):
+                    return ErrorReply('bad range')
+
+                return SendFile(path, offset, length)
+
+            stat = os.stat(path)
+            pieces = cached_piece_hashes(path, stat.st_size, stat.st_mtime_ns, constant.PIECE_SIZE)
+
+            json_resp = {
+                'action': 'put_pieces',
+                'size': stat.st_size,
+                'piece_size': constant.PIECE_SIZE,
+                'pieces': pieces
+            }
+
+        # Gossip only records what it heard, the gossip thread acts on it
+        elif (action == 'get_peers'):
+
+            gossip = self.cli.client.gossip
+            requester = (self.peer.host, int(json_req['port']))
+
+            gossip.state.learn_peers([requester])
+
+            json_resp = {
+                'action': 'put_peers',
+                'peers': [list(addr) for addr in gossip.sample_peers(exclude=requester)]
+            }
+
+        elif (action == 'gossip'):
+
+            fresh = self.cli.client.gossip.receive(self.peer.host, int(json_req['port']), json_req['digests'])
+
+            json_resp = {
+                'action': 'ack',
+                'fresh': fresh
+            }
+
+        else:
+            self.cli.log(f"Unknown action '{action}' from {self.peer}")
+            return ErrorReply(f"unknown action '{action}'")
+
+        return json.dumps(json_resp)
 
 class Server:
     def __init__(self, cli, port, tracks, local_tracks):
@@ -20,6 +221,13 @@ class Server:
         self.local_tracks = local_tracks
         self.nodes = {}
 
+        # Files for every connection are sent from here, where they
+        # may wait on the upload limits
+        self.workers = ThreadPoolExecutor(max_workers=constant.SERVER_WORKERS)
+
+        # Everything else is answered here, so it never queues behind them
+        self.control = ThreadPoolExecutor(max_workers=constant.CONTROL_WORKERS)
+
     def start(self):
 
         # Create and init socket object
@@ -35,139 +243,140 @@ class Server:
         self.cli.log(f'Done')
 
     def run(self):
+
+        self.sock.listen()
+
         while True:
             # Establish connection with client.
-            self.sock.listen()
             conn, addr = self.sock.accept()
             self.nodes[addr] = conn
-            thread = ClientThread(self.cli, addr, conn, self.tracks, self.local_tracks)
+            thread = ClientThread(self.cli, addr, conn, self.tracks, self.local_tracks, self.nodes, self.workers, self.control)
             thread.start()
 
-class ClientThread(threading.Thread):
-    def __init__(self, cli, addr, conn, tracks, local_tracks):
+class ClientThread(RequestHandler, threading.Thread):
+    '''
+    Reads requests from one client. Each request is handled on the
+    server's control pool, and files are sent from its worker pool.
+    Replies are tagged with the request id, so they can go out in any
+    order.
+    '''
+
+    def __init__(self, cli, addr, conn, tracks, local_tracks, nodes, workers, control):
         threading.Thread.__init__(self)
         self.cli = cli
+        self.addr = addr
         self.conn = conn
         self.tracks = tracks
         self.local_tracks = local_tracks
+        self.nodes = nodes
+        self.workers = workers
+        self.control = control
         self.peer = Peer(cli, *addr)
 
+        # Only one frame goes onto the socket at a time
+        self.send_lock = threading.Lock()
+
         self.cli.log(f'Got connection from {self.peer}')
 
-    def read_file(self, path):
+    def send_file(self, req_id, resp):
         '''
-        Read the entire file into memory and encode to
-        base64.
+        Stream a file to the client in binary chunks, each waiting for
+        its turn under the upload limits.
         '''
 
-        with open(os.path.join(constant.FILE_PREFIX, path), 'rb') as f:
-            data = f.read()
+        pace = functools.partial(uploads.acquire, self.peer.host)
 
-        return base64.b64encode(data).decode()
-
-    def read_message(self):
-        '''
-        Read a full message from a client.
-        '''
+        with open_files.open(resp.path) as entry:
+            size = framing.send_file(self.conn, self.send_lock, req_id, entry, resp.offset, resp.length, pace)
+        self.cli.log(f'Sent {size} bytes to {self.peer}')
 
-        buffer = bytes()
+    def send_message(self, req_id, data, flags=0):
 
-        while True:
-            try:
-                received = self.conn.recv(constant.MAX_SOCK_READ)
-                buffer += received
-            except socket.timeout:
-                self.cli.log('Request timed out')
-                return None
+        if (isinstance(data, str)):
+            data = data.encode()
 
-            if (received is None or len(received) == 0):
-                self.conn.close()
-                self.cli.log(f'Connection to {self.peer} closed')
-                return None
+        # Replies other than files never wait on the upload limits
+        uploads.control(self.peer.host, len(data) + framing.HEADER.size)
 
-            try:
-                last_four = buffer[-4:]
-                last_four = last_four.decode()
+        with self.send_lock:
+            framing.send_frame(self.conn, req_id, data, flags)
 
-                if (last_four == '\r\n\r\n'):
-                    buffer = buffer[:-4]
-                    break
+    def read_message(self):
+        '''
+        Read a full message from a client.
+        '''
 
-            except Exception as e:
-                self.cli.log(e)
+        return framing.recv_frame(self.conn)
 
-        return buffer
+    def close(self):
 
-    def run(self):
+        self.conn.close()
+        self.nodes.pop(self.addr, None)
+        self.cli.log(f'Connection to {self.peer} closed')
 
-        while True:
-            try:
+    def respond(self, req_id, data):
+        '''
+        Handle one request. Files are handed to the worker pool to be
+        sent, every other reply goes straight back.
+        '''
 
-                data = self.read_message()
-                if (data is None):
-                    break
+        resp = self.handle_request(data)
 
-                data = data.decode()
-                # self.cli.log(data)
+        if (isinstance(resp, SendFile)):
+            self.workers.submit(self.reply, req_id, resp)
+        else:
+            self.reply(req_id, resp)
 
-                str_resp = None
+    def reply(self, req_id, resp):
+        '''
+        Send back the reply to a request.
+        '''
 
-                if (data == 'ping'):
-                    str_resp = 'pong'
+        try:
+            if (isinstance(resp, SendFile)):
+                self.send_file(req_id, resp)
 
-                else:
-                    str_resp = self.handle_json_req(data)
-                    if (str_resp is None):
-                        continue
+            elif (isinstance(resp, ErrorReply)):
+                self.send_message(req_id, resp.message, framing.ERROR)
 
-                # self.cli.log(str_resp)
+            else:
+                self.send_message(req_id, resp)
 
-                self.conn.sendall(str_resp.encode())
-                self.conn.sendall('\r\n\r\n'.encode())
+        except ConnectionError:
+            # The client went away, the reader notices and cleans up
+            pass
+        except Exception:
+            self.cli.log(traceback.format_exc())
 
-            except socket.timeout:
-                self.conn.close()
-                self.cli.log(f'Connection to {self.peer} closed')
-                break
-            except Exception:
-                self.cli.log(traceback.format_exc())
-                continue
+            # Don't leave the client waiting for a reply
+            try:
+                self.send_message(req_id, 'internal error', framing.ERROR)
+            except OSError:
+                pass
 
-    def handle_json_req(self, data):
+    def run(self):
 
         try:
-            json_req = json.loads(data)
-            action = json_req['action']
-        except:
-            self.cli.log('JSON parse failed')
-            return None
+            self.read_requests()
+        finally:
+            self.close()
 
-        if (action == 'get_track_list'):
-
-            json_resp = {
-                'action': 'put_track_list',
-                'tracks': [track.to_dict() for track in self.local_tracks.values()]
-            }
-
-        elif (action == 'get_track'):
-
-            track_hash = json_req['hash']
-
-            # Ignore requests for tracks we don't know
-            if (track_hash not in self.local_tracks):
-                return None
+    def read_requests(self):
 
-            track = self.local_tracks[track_hash]
+        while True:
+            try:
+                frame = self.read_message()
+            except OSError:
+                break
 
-            # Ignore requests for tracks we don't have
-            if (not track.local):
-                return None
+            if (frame is None):
+                break
 
-            file_data = self.read_file(track.path)
+            req_id, _, data = frame
 
-            json_resp = {
-                'action': 'put_track',
-                'fileData': file_data
-            }
+            # Answered right away, it's the cheapest request there is
+            if (data == b'ping'):
+                self.respond(req_id, data)
+                continue
 
-        return json.dumps(json_resp)
+            self.control.submit(self.respond, req_id, data)
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+import array
+import threading
+
+import numpy as np
+
+import constant
+
+# Number of set bits in every possible byte
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def decode_fingerprint(fingerprint):
+    '''
+    Turn a compressed chromaprint fingerprint into an array of its
+    raw 32-bit subwords. Returns `None` if it can't be decoded.
+    '''
+
+    if (not fingerprint):
+        return None
+
+    try:
+        # Comes with pyacoustid but needs libchromaprint, so it's
+        # imported here to keep the index usable without it
+        import chromaprint
+
+        if (isinstance(fingerprint, str)):
+            fingerprint = fingerprint.encode('ascii')
+
+        raw, _ = chromaprint.decode_fingerprint(fingerprint)
+    except Exception:
+        return None
+
+    return np.asarray(raw, dtype=np.uint32)
+
+def as_digest(file_hash):
+    '''
+    The raw bytes of a hash given as hex or already as bytes.
+    '''
+
+    return bytes.fromhex(file_hash) if isinstance(file_hash, str) else file_hash
+
+def popcount(values):
+    '''
+    Total number of set bits in an array of 32-bit integers.
+    '''
+
+    return int(POPCOUNT[values.view(np.uint8)].sum(dtype=np.int64))
+
+def similarity(a, b, offset):
+    '''
+    Fraction of matching bits between two raw fingerprints where
+    `b` starts `offset` subwords after `a`.
+    '''
+
+    if (offset >= 0):
+        a = a[offset:]
+    else:
+        b = b[-offset:]
+
+    n = min(len(a), len(b))
+    if (n == 0):
+        return 0.0
+
+    return 1.0 - popcount(np.bitwise_xor(a[:n], b[:n])) / (32.0 * n)
+
+def best_offset(a, b):
+    '''
+    Estimate how far apart two fingerprints are by lining up the
+    values they share. Returns `None` if they share none.
+    '''
+
+    _, a_pos, b_pos = np.intersect1d(a, b, return_indices=True)
+    if (len(a_pos) == 0):
+        return None
+
+    offsets = a_pos.astype(np.int64) - b_pos.astype(np.int64)
+    values, counts = np.unique(offsets, return_counts=True)
+
+    return int(values[np.argmax(counts)])
+
+def fingerprint_similarity(a, b):
+    '''
+    Fraction of matching bits between two compressed fingerprints at
+    their best alignment. Without libchromaprint to decode them, only
+    identical fingerprints are known to match. Returns `None` if
+    that can't be told either way.
+    '''
+
+    raw_a = decode_fingerprint(a)
+    raw_b = decode_fingerprint(b)
+
+    if (raw_a is None or raw_b is None):
+        if (a and a == b):
+            return 1.0
+        return None
+
+    shift = FingerprintIndex.KEY_SHIFT
+    offset = best_offset(raw_a >> shift, raw_b >> shift)
+    if (offset is None):
+        return 0.0
+
+    return max(similarity(raw_a, raw_b, o) for o in (offset - 1, offset, offset + 1))
+
+class FingerprintIndex:
+    '''
+    Inverted index from fingerprint subwords to tracks, for finding
+    the same recording in different files without asking AcoustID.
+
+    Only the top bits of each subword are used as a key, which makes
+    lookups tolerant of small encoding differences. Each track is
+    indexed by the keys of its first `index_subwords` subwords.
+    Candidates sharing enough keys with the query are then scored by
+    comparing the full fingerprints bit by bit at their best
+    alignment.
+
+    Postings are kept in one sorted array and looked up with binary
+    search, so a query costs roughly the number of postings it hits
+    rather than the size of the index.
+
+    Tracks are numbered, and known by their 32-byte digest rather
+    than a hex string. Full fingerprints are decoded from `tracks`,
+    normally the client's track store, when a candidate is scored,
+    so the index doesn't keep a second copy of them. Without one it
+    keeps the raw fingerprints itself.
+    '''
+
+    KEY_SHIFT = 12
+
+    def __init__(self,
+        tracks=None,
+        index_subwords=constant.INDEX_SUBWORDS,
+        max_postings=constant.INDEX_MAX_POSTINGS
+    ):
+
+        self.tracks = tracks
+        self.index_subwords = index_subwords
+        self.max_postings = max_postings
+
+        # Track id -> digest and raw fingerprint, `None` once removed
+        self.digests = []
+        self.prints = []
+        self.ids = {}
+
+        # Ids whose postings are still to be dropped, and ids free
+        # to use again once they have been
+        self.removed = set()
+        self.free = []
+
+        # Sorted postings, plus new ones not merged in yet. Those are
+        # packed into flat buffers rather than kept as an array for
+        # each track, which would cost more than the postings.
+        self.keys = np.empty(0, dtype=np.uint32)
+        self.owners = np.empty(0, dtype=np.int32)
+        self.new_keys = array.array('I')
+        self.new_owners = array.array('i')
+
+        # Tracks are added from several threads
+        self.lock = threading.Lock()
+
+    def key_set(self, raw):
+
+        return np.unique(raw[:self.index_subwords] >> self.KEY_SHIFT)
+
+    def add(self, file_hash, raw):
+        '''
+        Index the raw fingerprint of a track.
+        '''
+
+        if (raw is None or len(raw) == 0):
+            return
+
+        digest = as_digest(file_hash)
+        keys = self.key_set(raw)
+
+        # Decoded again from the track store when it's needed
+        if (self.tracks is not None):
+            raw = None
+
+        with self.lock:
+            if (digest in self.ids):
+                return
+
+            if (len(self.free) > 0):
+                track_id = self.free.pop()
+                self.digests[track_id] = digest
+                self.prints[track_id] = raw
+            else:
+                track_id = len(self.digests)
+                self.digests.append(digest)
+                self.prints.append(raw)
+
+            self.ids[digest] = track_id
+
+            self.new_keys.frombytes(keys.astype(np.uint32).tobytes())
+            self.new_owners.extend([track_id] * len(keys))
+
+    def remove(self, file_hash):
+        '''
+        Forget a track. Its postings are dropped at the next merge.
+        '''
+
+        with self.lock:
+            track_id = self.ids.pop(as_digest(file_hash), None)
+            if (track_id is None):
+                return
+
+            self.digests[track_id] = None
+            self.prints[track_id] = None
+            self.removed.add(track_id)
+
+    def merge(self):
+        '''
+        Fold newly added postings into the sorted arrays and drop
+        those of removed tracks. Call with the lock held.
+        '''
+
+        if (len(self.new_keys) == 0 and len(self.removed) == 0):
+            return
+
+        keys = np.concatenate([self.keys, np.frombuffer(self.new_keys, dtype=np.uint32)])
+        owners = np.concatenate([self.owners, np.frombuffer(self.new_owners, dtype=np.int32)])
+
+        if (len(self.removed) > 0):
+            keep = ~np.isin(owners, np.fromiter(self.removed, dtype=np.int32, count=len(self.removed)))
+            keys = keys[keep]
+            owners = owners[keep]
+
+            self.free += self.removed
+            self.removed = set()
+
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.owners = owners[order]
+
+        self.new_keys = array.array('I')
+        self.new_owners = array.array('i')
+
+    def fingerprint(self, digest, raw):
+        '''
+        The raw fingerprint of an indexed track, from the track store
+        if the index doesn't keep it. `None` if it's gone.
+        '''
+
+        if (raw is not None or self.tracks is None):
+            return raw
+
+        track = self.tracks.get(digest.hex())
+        if (track is None):
+            return None
+
+        return decode_fingerprint(track.fingerprint)
+
+    def candidates(self, raw, limit):
+        '''
+        Tracks that share the most keys with a raw fingerprint, as
+        (digest, fingerprint) pairs.
+        '''
+
+        query = self.key_set(raw)
+
+        with self.lock:
+            self.merge()
+
+            # The arrays are replaced, not changed, by later merges
+            keys = self.keys
+            all_owners = self.owners
+
+        lo = np.searchsorted(keys, query, side='left')
+        hi = np.searchsorted(keys, query, side='right')
+        counts = hi - lo
+
+        # Keys shared by too many tracks (silence, mostly) say nothing
+        keep = (counts > 0) & (counts <= self.max_postings)
+        lo = lo[keep]
+        counts = counts[keep]
+
+        if (len(counts) == 0):
+            return []
+
+        # Positions of every posting hit, without a Python loop
+        starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        positions = starts + np.arange(counts.sum())
+
+        owners, votes = np.unique(all_owners[positions], return_counts=True)
+
+        # Require a share of the query's keys to weed out chance hits
+        min_votes = max(2, int(len(query) * constant.INDEX_MIN_VOTES))
+        strong = votes >= min_votes
+        owners = owners[strong]
+        votes = votes[strong]
+
+        best = np.argsort(-votes, kind='stable')[:limit]
+
+        with self.lock:
+            found = [(self.digests[track_id], self.prints[track_id]) for track_id in owners[best].tolist()]
+
+        # Tracks removed since the postings were looked up are skipped
+        found = [(digest, self.fingerprint(digest, other)) for digest, other in found if digest is not None]
+
+        return [(digest, other) for digest, other in found if other is not None]
+
+    def query(self, raw, limit=5, threshold=constant.SIMILARITY_THRESHOLD):
+        '''
+        Find indexed tracks that sound like a raw fingerprint. Returns
+        a list of (hash, similarity) pairs, best match first.
+        '''
+
+        if (raw is None or len(raw) == 0):
+            return []
+
+        matches = []
+        for digest, other in self.candidates(raw, limit * 4):
+
+            # Line up on keys since re-encoding rarely keeps whole subwords
+            offset = best_offset(raw >> self.KEY_SHIFT, other >> self.KEY_SHIFT)
+            if (offset is None):
+                continue
+
+            score = max(similarity(raw, other, o) for o in (offset - 1, offset, offset + 1))
+            if (score >= threshold):
+                matches.append((digest.hex(), score))
+
+        matches.sort(key=lambda match: -match[1])
+
+        return matches[:limit]
+
+    def similar_to(self, file_hash, limit=5, threshold=constant.SIMILARITY_THRESHOLD):
+        '''
+        Find other indexed tracks that sound like the given one.
+        '''
+
+        digest = as_digest(file_hash)
+
+        with self.lock:
+            track_id = self.ids.get(digest)
+            if (track_id is None):
+                return []
+
+            raw = self.prints[track_id]
+
+        raw = self.fingerprint(digest, raw)
+        if (raw is None):
+            return []
+
+        matches = self.query(raw, limit + 1, threshold)
+
+        return [match for match in matches if match[0] != digest.hex()][:limit]
+
+    def __contains__(self, file_hash):
+
+        return as_digest(file_hash) in self.ids
+
+    def __len__(self):
+
+        return len(self.ids)
+
+if (__name__ == '__main__'):
+
+    import time
+
+    rng = np.random.default_rng(0)
+
+    n_tracks = 100000
+    length = 240
+
+    index = FingerprintIndex()
+
+    start = time.perf_counter()
+    originals = []
+    for i in range(n_tracks):
+        raw = rng.integers(0, 2 ** 32, size=length, dtype=np.uint32)
+        originals.append(raw)
+        index.add(f'{i:064x}', raw)
+    with index.lock:
+        index.merge()
+    print(f'Indexed {n_tracks} fingerprints in {time.perf_counter() - start:.2f} s')
+
+    # Re-encoded copies: a few flipped low bits and a small shift
+    queries = []
+    for i in rng.choice(n_tracks, size=200, replace=False):
+        noisy = originals[i] ^ rng.integers(0, 2 ** 3, size=length, dtype=np.uint32)
+        queries.append((i, noisy[3:]))
+
+    found = 0
+    start = time.perf_counter()
+    for i, raw in queries:
+        matches = index.query(raw, limit=1)
+        found += len(matches) > 0 and matches[0][0] == f'{i:064x}'
+    elapsed = time.perf_counter() - start
+
+    print(f'{found}/{len(queries)} near-duplicates found, {elapsed / len(queries) * 1000:.3f} ms per query')
+
+    # Removed tracks stop matching, and their postings go with them
+    postings = len(index.keys)
+    for i, _ in queries[:100]:
+        index.remove(f'{i:064x}')
+
+    stale = 0
+    for i, raw in queries[:100]:
+        matches = index.query(raw, limit=1)
+        stale += len(matches) > 0 and matches[0][0] == f'{i:064x}'
+
+    print(f'{stale}/100 removed tracks still found, {postings - len(index.keys)} postings dropped')
+    assert stale == 0 and len(index) == n_tracks - 100
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import collections
+import hashlib
+import os
+import threading
+
+import constant
+from partfile import PartFile
+
+class SwarmDownload:
+    '''
+    Download a track from several peers at once.
+
+    The file is split into pieces that idle peers take from a shared
+    queue, so faster peers end up serving more of it. Every piece is
+    checked against its SHA-256 hash. A bad piece goes back in the
+    queue for a different peer, and peers that keep sending bad
+    pieces are dropped. Pieces already in a part file from an earlier
+    attempt are skipped. A cancelled `job` stops handing out pieces
+    and leaves the part file to resume from.
+    '''
+
+    def __init__(self, cli, track, peers, job=None):
+
+        self.cli = cli
+        self.track = track
+        self.peers = peers
+        self.job = job
+
+        self.file_name = f'{track.hash}.{track.extension}'
+        self.path = os.path.join(constant.FILE_PREFIX, self.file_name)
+
+        self.lock = threading.Condition()
+        self.pending = collections.deque()
+        self.in_flight = 0
+        self.done = 0
+
+        # Peers that already sent a bad copy of each piece
+        self.rejected = collections.defaultdict(set)
+
+    def run(self):
+
+        self.cli.log(f"Requesting '{self.track}' from {len(self.peers)} peers...")
+
+        info = None
+        for peer in self.peers:
+            info = peer.request_pieces(self.track)
+            if (info is not None):
+                break
+
+        if (info is None):
+            self.cli.log('Download failed: no peer sent the piece list')
+            return False
+
+        self.size = info['size']
+        self.piece_size = info['piece_size']
+        self.hashes = info['pieces']
+
+        part = PartFile(self.path, self.track.hash, self.size)
+
+        for index in range(len(self.hashes)):
+            offset, length = self.piece_range(index)
+            if (part.has(offset, length)):
+                self.done += 1
+            else:
+                self.pending.append(index)
+
+        if (self.done > 0):
+            self.cli.log(f'Resuming download, {self.done} of {len(self.hashes)} pieces already done')
+
+        if (self.job is not None):
+            self.job.set_total(self.size, self.size - sum(self.piece_range(index)[1] for index in self.pending))
+
+        try:
+            threads = []
+            for peer in self.peers:
+                thread = threading.Thread(target=self.worker, args=(peer, part))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+            for thread in threads:
+                thread.join()
+        finally:
+            part.close()
+
+        if (self.job is not None and self.job.cancelled()):
+            self.cli.log('Download cancelled, it can be resumed later')
+            return False
+
+        if (self.done < len(self.hashes)):
+            self.cli.log(f'Download failed: {len(self.hashes) - self.done} pieces missing')
+            return False
+
+        if (not part.finish()):
+            self.cli.log('Track hashes did not match! File may have been corrupted')
+            return False
+
+        self.cli.log('File hashes match')
+
+        # Mark the file as local
+        self.track.local = True
+        self.track.path = self.path
+
+        self.cli.log('Download successful')
+
+        return True
+
+    def piece_range(self, index):
+
+        offset = index * self.piece_size
+        return offset, min(self.piece_size, self.size - offset)
+
+    def next_piece(self, peer):
+        '''
+        Take the next piece `peer` hasn't already failed. Waits while
+        other peers might still put pieces back. Returns `None` when
+        there is nothing left for this peer.
+        '''
+
+        with self.lock:
+            while True:
+                if (self.job is not None and self.job.cancelled()):
+                    return None
+
+                for index in self.pending:
+                    if (peer not in self.rejected[index]):
+                        self.pending.remove(index)
+                        self.in_flight += 1
+                        return index
+
+                if (self.in_flight == 0):
+                    return None
+
+                self.lock.wait()
+
+    def finish_piece(self, index, ok, peer=None):
+
+        with self.lock:
+            self.in_flight -= 1
+
+            if (ok):
+                self.done += 1
+            else:
+                if (peer is not None):
+                    self.rejected[index].add(peer)
+
+                # Nobody left who might have a good copy
+                if (self.rejected[index] < set(self.peers)):
+                    self.pending.appendleft(index)
+
+            self.lock.notify_all()
+
+    def worker(self, peer, part):
+
+        bad_pieces = 0
+
+        while True:
+            index = self.next_piece(peer)
+            if (index is None):
+                return
+
+            offset, length = self.piece_range(index)
+
+            try:
+                data = peer.request_range(self.track, offset, length)
+            except Exception as e:
+                self.cli.log(f'Piece {index} from {peer} failed: {e}')
+                data = None
+
+            # Connection trouble, leave the rest to other peers
+            if (data is None):
+                self.finish_piece(index, False)
+                return
+
+            if (hashlib.sha256(data).hexdigest() != self.hashes[index]):
+                self.cli.log(f'Bad piece {index} from {peer}')
+                self.finish_piece(index, False, peer)
+
+                bad_pieces += 1
+                if (bad_pieces >= constant.MAX_BAD_PIECES):
+                    self.cli.log(f'Dropping {peer} from download')
+                    return
+
+                continue
+
+            part.write(offset, data)
+            self.finish_piece(index, True)
+
+            if (self.job is not None):
+                self.job.advance(length)
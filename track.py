@@ -1,38 +1,77 @@
+import base64
+import binascii
 import hashlib
 import filetype
 import json
 import os.path
+import sys
 
 import acoustid as aid
 
 import constant
 
+# Bytes read at a time when hashing a whole file
+HASH_BUFFER = 1 << 18
+
+def pack_fingerprint(fingerprint):
+    '''
+    Undo the URL-safe base64 chromaprint puts on fingerprints. Returns
+    the raw bytes and whether that worked; anything that isn't valid
+    base64 is kept as it is.
+    '''
+
+    padding = b'=' * (-len(fingerprint) % 4)
+
+    try:
+        return base64.b64decode(fingerprint + padding, altchars=b'-_', validate=True), True
+    except (binascii.Error, ValueError):
+        return fingerprint, False
+
+def unpack_fingerprint(raw):
+
+    return base64.urlsafe_b64encode(raw).rstrip(b'=')
+
+def intern(text):
+    '''
+    Share one copy of strings that repeat across a catalog, like
+    artist names.
+    '''
+
+    return None if text is None else sys.intern(text)
+
 class Track:
+    '''
+    A track we have or a peer has.
+
+    Catalogs can hold millions of these, so they're kept small: no
+    per-instance `__dict__`, one shared copy of each title, artist
+    and extension, the hash as its 32 raw bytes and the fingerprint
+    without its base64. `hash` and `fingerprint` give back the usual
+    hex and base64 forms.
+    '''
+
+    __slots__ = (
+        'title', 'artist', 'duration', 'digest', 'fingerprint_raw', 'fingerprint_packed',
+        'extension', 'path', 'peer', 'local', 'peer_set'
+    )
 
     @staticmethod
-    def from_file(file_name: str):
+    def from_file(path: str):
         '''
         Construct a Track object from a file.
         '''
 
-        path = os.path.join(constant.FILE_PREFIX, file_name)
-        extension = filetype.guess_extension(path)
+        # Fall back on the name for files filetype doesn't recognise
+        extension = filetype.guess_extension(path) or os.path.splitext(path)[1][1:].lower() or None
 
         duration, fingerprint = aid.fingerprint_file(path)
         file_hash = hash_file(path)
 
-        # Use AcoustID
-        json_resp = aid.lookup(constant.API_KEY, fingerprint, duration)
-        matches = aid.parse_lookup_result(json_resp)
+        # Placeholder names until the metadata resolver finds a match
+        title = 'Track ' + file_hash[:constant.HASH_LEN]
+        artist = 'Unknown'
 
-        try:
-            # Ignore score and recording_id
-            _, _, title, artist = next(matches)
-        except StopIteration:
-            title = 'Track ' + file_hash[:constant.HASH_LEN]
-            artist = 'Unknown'
-
-        return Track(title, artist, duration, file_hash, fingerprint, extension, path=file_name, local=True)
+        return Track(title, artist, duration, file_hash, fingerprint, extension, path=path, local=True)
 
     @staticmethod
     def from_json(json_str: str, peer):
@@ -51,7 +90,7 @@ class Track:
         '''
 
         duration = json_dict['duration']
-        fingerprint = json_dict['fingerprint']
+        fingerprint = json_dict['fingerprint'].encode('ascii')
         file_hash = json_dict['hash']
         title = json_dict['title']
         artist = json_dict['artist']
@@ -68,34 +107,63 @@ class Track:
         extension: str,
         path: str = None,
         peer = None,
-        local: bool = False
+        local: bool = False,
+        packed: bool = False
     ):
+        '''
+        `file_hash` may be hex or raw bytes. With `packed` the
+        fingerprint is already without its base64.
+        '''
 
-        self.title = title
-        self.artist = artist
+        self.title = intern(title)
+        self.artist = intern(artist)
         self.duration = duration_s
-        self.hash = file_hash
-        self.fingerprint = fingerprint
-        self.extension = extension
+        self.digest = bytes.fromhex(file_hash) if isinstance(file_hash, str) else file_hash
+        self.extension = intern(extension)
         self.path = path
         self.peer = peer
         self.local = local
 
-    def download(self, cli):
+        # Every peer known to have the track, see `peers`
+        self.peer_set = None
+
+        if (isinstance(fingerprint, str)):
+            fingerprint = fingerprint.encode('ascii')
+
+        if (packed):
+            self.fingerprint_raw, self.fingerprint_packed = fingerprint, True
+        else:
+            self.fingerprint_raw, self.fingerprint_packed = pack_fingerprint(fingerprint)
+
+    @property
+    def peers(self):
         '''
-        Request the track from its peer.
+        Every peer known to have the track. Most tracks only ever
+        come from `peer`, so the set is made the first time it's needed.
         '''
 
-        if (self.local):
-            self.cli.log(f'Track {self.short_hash()} is already local')
-            return
+        if (self.peer_set is None):
+            self.peer_set = set() if self.peer is None else {self.peer}
+
+        return self.peer_set
+
+    @peers.setter
+    def peers(self, peers):
+
+        self.peer_set = peers
+
+    @property
+    def hash(self):
 
-        if (self.peer is None):
-            self.cli.log('Download failed: Track has no peer')
-            return
+        return self.digest.hex()
 
-        success = self.peer.request_track(self)
-        return success
+    @property
+    def fingerprint(self):
+
+        if (self.fingerprint_packed):
+            return unpack_fingerprint(self.fingerprint_raw)
+
+        return self.fingerprint_raw
 
     def to_dict(self):
 
@@ -104,7 +172,7 @@ class Track:
             'artist': self.artist,
             'duration': self.duration,
             'hash': self.hash,
-            'fingerprint': '', # self.fingerprint # Trouble sending this because it's bytes
+            'fingerprint': self.fingerprint.decode('ascii'), # Base64 so it survives JSON
             'ext': self.extension
         }
 
@@ -127,18 +195,55 @@ def hash_file(path: str) -> str:
     Calculate and return the SHA-256 hash of the given file.
     '''
 
-    SIZE = 65536
-    hasher = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as f:
+
+        # Reads into one buffer instead of a new bytes object per chunk
+        if (hasattr(hashlib, 'file_digest')):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+
+        hasher = hashlib.sha256()
+
+        buffer = bytearray(HASH_BUFFER)
+        view = memoryview(buffer)
+
+        n = f.readinto(buffer)
+        while n > 0:
+            hasher.update(view[:n])
+            n = f.readinto(buffer)
+
+    return hasher.hexdigest()
+
+def hash_pieces(path: str, piece_size: int) -> list:
+    '''
+    Calculate the SHA-256 hash of each `piece_size` piece of the
+    given file.
+    '''
+
+    pieces = []
+
+    buffer = bytearray(piece_size)
+    view = memoryview(buffer)
+
+    with open(path, 'rb', buffering=0) as f:
+
+        # A short read doesn't end a piece, only the end of the file does
+        while True:
+            n = 0
+            while n < piece_size:
+                read = f.readinto(view[n:])
+                if (read == 0):
+                    break
+                n += read
+
+            if (n == 0):
+                break
 
-    with open(path, 'rb') as f:
+            pieces.append(hashlib.sha256(view[:n]).hexdigest())
 
-        segment = f.read(SIZE)
-        while len(segment) > 0:
-            hasher.update(segment)
-            segment = f.read(SIZE)
+            if (n < piece_size):
+                break
 
-    res = hasher.hexdigest()
-    return res
+    return pieces
 
 def print_acoustid_matches(match_result, limit=3):
     '''
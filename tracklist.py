@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import struct
+
+from track import Track, unpack_fingerprint
+
+# Marks a binary track list, JSON ones start with '{'
+MAGIC = b'PTL1'
+
+# Catalog id, version, full list flag, number of tracks and removed hashes
+HEADER = struct.Struct('!4s16sQBII')
+
+# Hash, duration, flags, then the lengths of the title, artist,
+# extension and fingerprint that follow
+TRACK = struct.Struct('!32sdBHHHI')
+
+# The fingerprint was base64 and is sent as the bytes it encodes
+PACKED_FINGERPRINT = 1
+
+# The track has no known extension
+NO_EXTENSION = 2
+
+def encode_track_list(catalog_id, version, full, tracks, removed):
+    '''
+    Encode a track list reply. Strings are UTF-8 with a length in
+    front, hashes are sent as their 32 raw bytes and fingerprints
+    without their base64.
+    '''
+
+    parts = [
+        HEADER.pack(MAGIC, bytes.fromhex(catalog_id), version, full, len(tracks), len(removed))
+    ]
+
+    for file_hash in removed:
+        parts.append(bytes.fromhex(file_hash))
+
+    for track in tracks:
+
+        title = track.title.encode()
+        artist = track.artist.encode()
+
+        flags = 0
+
+        if (track.extension is None):
+            extension = b''
+            flags |= NO_EXTENSION
+        else:
+            extension = track.extension.encode()
+
+        # Tracks keep their fingerprints packed already
+        fingerprint = track.fingerprint_raw
+        if (track.fingerprint_packed):
+            flags |= PACKED_FINGERPRINT
+
+        parts.append(TRACK.pack(
+            track.digest,
+            track.duration,
+            flags,
+            len(title),
+            len(artist),
+            len(extension),
+            len(fingerprint)
+        ))
+        parts.append(title)
+        parts.append(artist)
+        parts.append(extension)
+        parts.append(fingerprint)
+
+    return b''.join(parts)
+
+def is_track_list(data):
+
+    return data[:len(MAGIC)] == MAGIC
+
+def decode_track_list(data, peer):
+    '''
+    Decode a binary track list reply into the same dictionary a JSON
+    one parses to, except that 'tracks' holds `Track` objects.
+    Raises `ValueError` if the data is cut short or malformed.
+    '''
+
+    view = memoryview(data)
+
+    try:
+        magic, catalog_id, version, full, n_tracks, n_removed = HEADER.unpack_from(view)
+        if (magic != MAGIC):
+            raise ValueError('not a binary track list')
+
+        offset = HEADER.size
+
+        removed = []
+        for _ in range(n_removed):
+            file_hash = view[offset:offset + 32]
+            if (len(file_hash) != 32):
+                raise ValueError('track list is truncated')
+
+            removed.append(file_hash.hex())
+            offset += 32
+
+        tracks = []
+        for _ in range(n_tracks):
+            file_hash, duration, flags, n_title, n_artist, n_ext, n_fingerprint = TRACK.unpack_from(view, offset)
+            offset += TRACK.size
+
+            end = offset + n_title + n_artist + n_ext + n_fingerprint
+            if (end > len(view)):
+                raise ValueError('track list is truncated')
+
+            title = str(view[offset:offset + n_title], 'utf-8')
+            offset += n_title
+
+            artist = str(view[offset:offset + n_artist], 'utf-8')
+            offset += n_artist
+
+            extension = None
+            if (not flags & NO_EXTENSION):
+                extension = str(view[offset:offset + n_ext], 'utf-8')
+            offset += n_ext
+
+            fingerprint = bytes(view[offset:end])
+            offset = end
+
+            tracks.append(Track(
+                title, artist, duration, file_hash, fingerprint, extension,
+                peer=peer, packed=bool(flags & PACKED_FINGERPRINT)
+            ))
+
+    except struct.error as e:
+        raise ValueError(f'track list is truncated: {e}')
+
+    return {
+        'action': 'put_track_list',
+        'catalog': catalog_id.hex(),
+        'version': version,
+        'full': bool(full),
+        'tracks': tracks,
+        'removed': removed
+    }
+
+if (__name__ == '__main__'):
+
+    import json
+    import os
+    import random
+    import time
+
+    # Fake catalog with fingerprints about the size of a 4 minute song
+    random.seed(0)
+
+    tracks = []
+    for i in range(10000):
+        fingerprint = unpack_fingerprint(os.urandom(random.randint(1800, 2600)))
+        tracks.append(Track(
+            f'Song number {i}',
+            f'Artist {i % 500}',
+            float(random.randint(90, 420)),
+            os.urandom(32).hex(),
+            fingerprint,
+            random.choice(['mp3', 'm4a', 'flac']),
+            local=True
+        ))
+
+    catalog_id = os.urandom(16).hex()
+
+    def time_it(function):
+        start = time.perf_counter()
+        result = function()
+        return result, (time.perf_counter() - start) * 1000
+
+    json_data, json_encode = time_it(lambda: json.dumps({
+        'action': 'put_track_list',
+        'catalog': catalog_id,
+        'version': len(tracks),
+        'full': True,
+        'tracks': [track.to_dict() for track in tracks],
+        'removed': []
+    }).encode())
+
+    _, json_decode = time_it(lambda: [
+        Track.from_dict(track_dict, None) for track_dict in json.loads(json_data)['tracks']
+    ])
+
+    binary_data, binary_encode = time_it(lambda: encode_track_list(catalog_id, len(tracks), True, tracks, []))
+    decoded, binary_decode = time_it(lambda: decode_track_list(binary_data, None))
+
+    assert [track.fingerprint for track in decoded['tracks']] == [track.fingerprint for track in tracks]
+    assert [track.hash for track in decoded['tracks']] == [track.hash for track in tracks]
+
+    print(f'{len(tracks)} tracks')
+    print(f'JSON:   {len(json_data) / 1e6:6.2f} MB, encode {json_encode:7.1f} ms, decode {json_decode:7.1f} ms')
+    print(f'Binary: {len(binary_data) / 1e6:6.2f} MB, encode {binary_encode:7.1f} ms, decode {binary_decode:7.1f} ms')
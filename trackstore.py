@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+
+import collections.abc
+import sqlite3
+import threading
+
+import constant
+from track import Track
+
+def digest_of(file_hash):
+    '''
+    The raw bytes of a hex hash. Raises `KeyError` for anything that
+    isn't hex, so lookups of bad hashes just miss.
+    '''
+
+    try:
+        return bytes.fromhex(file_hash)
+    except (TypeError, ValueError):
+        raise KeyError(file_hash)
+
+class TrackStore(collections.abc.MutableMapping):
+    '''
+    Every track we know of, by hash.
+
+    Works like a dictionary keyed by hex hashes, but keeps the
+    32-byte digest each `Track` already holds as the key instead of
+    a 64-character string per entry.
+
+    Tracks changed in place should be stored again with
+    `store[track.hash] = track`. That costs nothing here and is what
+    keeps `SQLiteTrackStore` up to date.
+    '''
+
+    def __init__(self):
+
+        self.tracks = {}
+
+    def __getitem__(self, file_hash):
+
+        return self.tracks[digest_of(file_hash)]
+
+    def __setitem__(self, file_hash, track):
+
+        self.tracks[track.digest] = track
+
+    def __delitem__(self, file_hash):
+
+        del self.tracks[digest_of(file_hash)]
+
+    def __iter__(self):
+
+        return (digest.hex() for digest in list(self.tracks))
+
+    def __len__(self):
+
+        return len(self.tracks)
+
+    def values(self):
+
+        return self.tracks.values()
+
+class TrackView(collections.abc.Sequence):
+    '''
+    The tracks of a `SQLiteTrackStore` as a list that is only read
+    from the database a slice at a time.
+    '''
+
+    def __init__(self, store):
+
+        self.store = store
+
+    def __len__(self):
+
+        return len(self.store)
+
+    def __getitem__(self, index):
+
+        if (isinstance(index, slice)):
+            start, stop, step = index.indices(len(self))
+            return self.store.slice(start, stop)[::step]
+
+        if (index < 0):
+            index += len(self)
+
+        tracks = self.store.slice(index, index + 1)
+        if (len(tracks) == 0):
+            raise IndexError(index)
+
+        return tracks[0]
+
+class SQLiteTrackStore(TrackStore):
+    '''
+    `TrackStore` for catalogs too big to keep in memory.
+
+    Tracks peers have are rows in SQLite, on disk unless `db_path` is
+    ':memory:', and are made into `Track` objects when they're looked
+    up. Our own tracks stay in memory since they're few and change
+    often. Peers are stored by address and matched back to the
+    `Peer` objects the rows were stored with.
+    '''
+
+    def __init__(self, db_path=constant.TRACK_STORE_FILE):
+
+        # Our own tracks, by digest
+        self.local = {}
+
+        # 'host:port' -> Peer
+        self.peers = {}
+
+        # Cached row count, reset by every write
+        self.count = None
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+
+        # Rebuilt from peers' track lists every run, so a crash
+        # losing recent writes doesn't matter
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('PRAGMA journal_mode = MEMORY')
+
+        with self.lock, self.db:
+            # Left over from the last run, peers send their lists again
+            self.db.execute('DROP TABLE IF EXISTS tracks')
+            self.db.execute('''
+                CREATE TABLE tracks (
+                    digest BLOB PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    artist TEXT NOT NULL,
+                    duration REAL NOT NULL,
+                    fingerprint BLOB NOT NULL,
+                    packed INTEGER NOT NULL,
+                    ext TEXT,
+                    peers TEXT NOT NULL
+                ) WITHOUT ROWID
+            ''')
+
+    def to_track(self, row):
+
+        digest, title, artist, duration, fingerprint, packed, extension, peers = row
+
+        track = Track(title, artist, duration, digest, fingerprint, extension, packed=bool(packed))
+
+        for address in peers.split():
+            peer = self.peers.get(address)
+            if (peer is not None):
+                track.peers.add(peer)
+                if (track.peer is None):
+                    track.peer = peer
+
+        return track
+
+    def __getitem__(self, file_hash):
+
+        digest = digest_of(file_hash)
+
+        track = self.local.get(digest)
+        if (track is not None):
+            return track
+
+        with self.lock:
+            row = self.db.execute('SELECT * FROM tracks WHERE digest = ?', (digest,)).fetchone()
+
+        if (row is None):
+            raise KeyError(file_hash)
+
+        return self.to_track(row)
+
+    def __setitem__(self, file_hash, track):
+
+        if (track.local):
+            with self.lock, self.db:
+                self.db.execute('DELETE FROM tracks WHERE digest = ?', (track.digest,))
+                self.local[track.digest] = track
+                self.count = None
+            return
+
+        # The peer we got it from goes first
+        peers = sorted(track.peers, key=lambda peer: peer is not track.peer)
+
+        with self.lock, self.db:
+            for peer in peers:
+                self.peers[str(peer)] = peer
+
+            self.local.pop(track.digest, None)
+            self.db.execute(
+                'INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    track.digest, track.title, track.artist, track.duration,
+                    track.fingerprint_raw, track.fingerprint_packed, track.extension,
+                    ' '.join(str(peer) for peer in peers)
+                )
+            )
+            self.count = None
+
+    def __delitem__(self, file_hash):
+
+        digest = digest_of(file_hash)
+
+        with self.lock, self.db:
+            if (self.local.pop(digest, None) is None):
+                if (self.db.execute('DELETE FROM tracks WHERE digest = ?', (digest,)).rowcount == 0):
+                    raise KeyError(file_hash)
+
+            self.count = None
+
+    def __contains__(self, file_hash):
+
+        try:
+            digest = digest_of(file_hash)
+        except KeyError:
+            return False
+
+        if (digest in self.local):
+            return True
+
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM tracks WHERE digest = ?', (digest,)).fetchone() is not None
+
+    def __iter__(self):
+
+        with self.lock:
+            digests = list(self.local) + [row[0] for row in self.db.execute('SELECT digest FROM tracks')]
+
+        return (digest.hex() for digest in digests)
+
+    def __len__(self):
+
+        with self.lock:
+            if (self.count is None):
+                self.count = len(self.local) + self.db.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+
+            return self.count
+
+    def slice(self, start, stop):
+        '''
+        Tracks `start` to `stop`, our own first and then by hash.
+        '''
+
+        local = list(self.local.values())
+
+        tracks = local[start:stop]
+
+        start = max(0, start - len(local))
+        stop = max(0, stop - len(local))
+
+        if (stop > start):
+            with self.lock:
+                rows = self.db.execute(
+                    'SELECT * FROM tracks ORDER BY digest LIMIT ? OFFSET ?',
+                    (stop - start, start)
+                ).fetchall()
+
+            tracks += [self.to_track(row) for row in rows]
+
+        return tracks
+
+    def values(self):
+
+        return TrackView(self)
+
+def open_track_store(mode=constant.TRACK_STORE):
+    '''
+    The track store `constant.TRACK_STORE` asks for.
+    '''
+
+    if (mode == 'sqlite'):
+        return SQLiteTrackStore()
+
+    return TrackStore()
+
+if (__name__ == '__main__'):
+
+    import gc
+    import os
+    import random
+    import subprocess
+    import sys
+    import time
+    import tracemalloc
+
+    import numpy as np
+
+    from peer import Peer
+    from search import SearchIndex
+    from similarity import FingerprintIndex
+    from track import unpack_fingerprint
+
+    class LegacyTrack:
+        '''
+        How tracks were stored before: a `__dict__` each, hex hashes
+        and base64 fingerprints.
+        '''
+
+        def __init__(self, title, artist, duration, file_hash, fingerprint, extension, peer):
+            self.title = title
+            self.artist = artist
+            self.duration = duration
+            self.hash = file_hash
+            self.fingerprint = fingerprint
+            self.extension = extension
+            self.path = None
+            self.peer = peer
+            self.local = False
+            self.peers = {peer}
+
+    n_tracks = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    random.seed(0)
+
+    peers = [Peer(None, '10.0.0.%d' % i, 5000) for i in range(20)]
+    artists = [b'Artist number %d' % i for i in range(n_tracks // 20)]
+    words = [b'word%d' % i for i in range(20000)]
+
+    # A two minute fingerprint is about this many subwords, and about
+    # 2 KB once compressed
+    SUBWORDS = 950
+    FINGERPRINT_SIZE = 2000
+
+    def listings(fingerprint_size):
+        for i in range(n_tracks):
+            # Decoded off the wire, so no two strings are shared
+            yield (
+                b' '.join(random.sample(words, random.randint(1, 5))).decode(),
+                random.choice(artists).decode(),
+                float(random.randint(90, 420)),
+                os.urandom(32).hex(),
+                unpack_fingerprint(os.urandom(fingerprint_size)),
+                b'mp3'.decode(),
+                random.choice(peers)
+            )
+
+    def rss():
+        '''
+        Resident memory in bytes. Outside Linux only the peak is known.
+        '''
+
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            import resource
+            scale = 1 if sys.platform == 'darwin' else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    if (len(sys.argv) > 3):
+
+        # One catalog in a fresh process, see below
+        mode, parts = sys.argv[2], sys.argv[3]
+
+        store = SQLiteTrackStore('/tmp/trackstore-bench.db') if mode == 'sqlite' else TrackStore()
+        search = SearchIndex(store)
+
+        # Without a store to decode from, the index keeps raw fingerprints
+        similarity = FingerprintIndex(None if parts == 'raw' else store)
+
+        rng = np.random.default_rng(0)
+
+        gc.collect()
+        before = rss()
+
+        for title, artist, duration, file_hash, fingerprint, extension, peer in listings(FINGERPRINT_SIZE):
+            track = Track(title, artist, duration, file_hash, fingerprint, extension, peer=peer)
+            store[file_hash] = track
+
+            if (parts != 'store'):
+                search.add(track)
+
+            # Random subwords, since decoding needs libchromaprint
+            if (parts not in ['store', 'search']):
+                similarity.add(file_hash, rng.integers(0, 2 ** 32, size=SUBWORDS, dtype=np.uint32))
+
+        search.refresh()
+        with similarity.lock:
+            similarity.merge()
+
+        gc.collect()
+        print((rss() - before) / n_tracks)
+        sys.exit()
+
+    def measure(name, build, fingerprint_size):
+        gc.collect()
+        tracemalloc.start()
+
+        # Listings are made as they're stored, so whatever the store
+        # keeps of them is counted and nothing else is
+        store = build(listings(fingerprint_size))
+
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        print(f'{name:24s} {fingerprint_size:5d} B prints: {used / n_tracks:7.0f} bytes per track')
+        return store
+
+    def legacy(data):
+        return {row[3]: LegacyTrack(*row) for row in data}
+
+    def build(store):
+        def fill(data):
+            for title, artist, duration, file_hash, fingerprint, extension, peer in data:
+                store[file_hash] = Track(title, artist, duration, file_hash, fingerprint, extension, peer=peer)
+            return store
+        return fill
+
+    # tracemalloc sees Python objects only, not what SQLite allocates
+    print(f'{n_tracks} tracks, Python heap measured with tracemalloc')
+
+    for fingerprint_size in [0, FINGERPRINT_SIZE]:
+        measure('dict of old tracks', legacy, fingerprint_size)
+        store = measure('TrackStore', build(TrackStore()), fingerprint_size)
+        sqlite_store = measure('SQLiteTrackStore (disk)', build(SQLiteTrackStore('/tmp/trackstore-bench.db')), fingerprint_size)
+
+    for name, lookup in [('TrackStore', store), ('SQLiteTrackStore', sqlite_store)]:
+        hashes = random.sample(list(lookup), 1000)
+
+        start = time.perf_counter()
+        for file_hash in hashes:
+            lookup[file_hash]
+        print(f'{name:24s} lookup: {(time.perf_counter() - start) / len(hashes) * 1e6:.1f} us')
+
+    del store, sqlite_store
+    os.remove('/tmp/trackstore-bench.db')
+
+    # What the client keeps for each track: the store, the search
+    # index and the fingerprint index. Each is built in its own
+    # process so the resident memory it adds can be told apart.
+    print()
+    print(f'{n_tracks} tracks as the client holds them, resident memory')
+
+    for mode in ['memory', 'sqlite']:
+        for parts, name in [
+            ('store', 'store'),
+            ('search', '+ search index'),
+            ('all', '+ fingerprint index'),
+            ('raw', '  (raw fingerprints kept)')
+        ]:
+            output = subprocess.run(
+                [sys.executable, __file__, str(n_tracks), mode, parts],
+                stdout=subprocess.PIPE, check=True, universal_newlines=True
+            ).stdout
+
+            print(f'{mode:6s} {name:26s} {float(output):7.0f} bytes per track')
+
+        if (os.path.exists('/tmp/trackstore-bench.db')):
+            os.remove('/tmp/trackstore-bench.db')
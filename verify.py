@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import acoustid as aid
+
+import constant
+from similarity import fingerprint_similarity
+
+class Verifier:
+    '''
+    Checks that downloaded tracks sound like what the peer said.
+
+    A matching SHA-256 only proves we got the file the peer
+    advertised, not that the file is the song it claims to be. Each
+    download is fingerprinted again on a pool of worker processes and
+    compared to the fingerprint and duration the peer advertised.
+    Files that don't match are moved to the quarantine folder and the
+    peers that sent them lose reputation.
+
+    `on_verified(track, peers, ok)` is called from a background
+    thread once a track has been checked. `ok` is `None` when the
+    track couldn't be checked, because the peer sent no fingerprint
+    or the fingerprints couldn't be compared. Those files are moved
+    to the unverified folder, which is never scanned, and the track's
+    path follows them.
+    '''
+
+    def __init__(self, cli, on_verified, workers=constant.VERIFY_WORKERS):
+
+        self.cli = cli
+        self.on_verified = on_verified
+        self.workers = workers
+
+        # Started on first use so idle nodes don't keep processes around
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def submit(self, track, peers):
+        '''
+        Queue a downloaded track for verification. Returns straight
+        away.
+        '''
+
+        path = track.path
+
+        with self.lock:
+            if (self.pool is None):
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+            future = self.pool.submit(aid.fingerprint_file, path)
+
+        self.cli.log(f'Verifying {track.short_hash()} in the background...')
+
+        future.add_done_callback(lambda future: self.finish(track, peers, path, future))
+
+    def finish(self, track, peers, path, future):
+
+        try:
+            try:
+                duration, fingerprint = future.result()
+            except Exception as e:
+                self.cli.log(f'Could not fingerprint {track.short_hash()}: {e}')
+                ok = False
+            else:
+                ok = self.check(track, duration, fingerprint)
+
+            if (ok is False):
+                self.quarantine(path)
+
+            elif (ok is None):
+                # Moved before the watcher can pick it up and share it
+                target = self.quarantine(path, constant.UNVERIFIED_FOLDER)
+                if (target is not None):
+                    track.path = target
+
+            self.on_verified(track, peers, ok)
+
+        except Exception:
+            self.cli.log(traceback.format_exc())
+
+    def check(self, track, duration, fingerprint):
+        '''
+        Compare a fresh fingerprint to the one the peer advertised.
+        Returns whether they match, or `None` if that can't be told.
+        '''
+
+        if (abs(duration - track.duration) > constant.VERIFY_DURATION_S):
+            self.cli.log(f'Track {track.short_hash()} is {duration:.0f} s long, the peer said {track.duration:.0f} s')
+            return False
+
+        if (not track.fingerprint):
+            # Otherwise leaving it out would be a way around the check
+            self.cli.log(f'Track {track.short_hash()} was sent without a fingerprint, keeping it unverified')
+            return None
+
+        score = fingerprint_similarity(track.fingerprint, fingerprint)
+
+        if (score is None):
+            self.cli.log(f'Could not compare fingerprints for {track.short_hash()}, keeping it unverified')
+            return None
+
+        if (score < constant.SIMILARITY_THRESHOLD):
+            self.cli.log(f"Track {track.short_hash()} doesn't sound like what the peer advertised ({score:.0%} match)")
+            return False
+
+        self.cli.log(f'Track {track.short_hash()} verified ({score:.0%} match)')
+        return True
+
+    def quarantine(self, path, folder=constant.QUARANTINE_FOLDER):
+        '''
+        Move a file that failed verification out of the content folder.
+        Returns where it went, or `None` if it couldn't be moved.
+        '''
+
+        os.makedirs(folder, exist_ok=True)
+
+        target = os.path.join(folder, os.path.basename(path))
+
+        try:
+            shutil.move(path, target)
+        except OSError as e:
+            self.cli.log(f'Could not move {path} to {folder}: {e}')
+            return None
+
+        self.cli.log(f"Moved '{path}' to '{target}'")
+
+        return target
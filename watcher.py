@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+import traceback
+
+import constant
+import scanner
+
+# Flags from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# Watch descriptor, mask, cookie and name length ahead of each event
+EVENT = struct.Struct('iIII')
+
+class InotifySource:
+    '''
+    Reports changed files under a list of folders using Linux
+    inotify, with a watch on every subfolder. Raises `OSError` if
+    inotify isn't available.
+    '''
+
+    def __init__(self, roots):
+
+        libc_name = ctypes.util.find_library('c')
+        if (libc_name is None):
+            raise OSError('libc not found')
+
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if (not hasattr(self.libc, 'inotify_init1')):
+            raise OSError('inotify is not supported')
+
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if (self.fd < 0):
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        # Watch descriptor -> folder
+        self.folders = {}
+
+        for root in roots:
+            if (self.add_watch(root) is None):
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, f'cannot watch {root}')
+
+            self.watch_tree(root)
+
+    def add_watch(self, folder):
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if (wd < 0):
+            return None
+
+        self.folders[wd] = folder
+        return wd
+
+    def watch_tree(self, folder):
+        '''
+        Watch every subfolder of `folder` that isn't excluded.
+        '''
+
+        stack = [folder]
+        while len(stack) > 0:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError:
+                continue
+
+            for entry in entries:
+                try:
+                    if (entry.is_dir() and not scanner.excluded(entry.path, constant.EXCLUDE_GLOBS)):
+                        self.add_watch(entry.path)
+                        stack.append(entry.path)
+                except OSError:
+                    continue
+
+    def wait(self, timeout):
+        '''
+        Wait up to `timeout` seconds for changes. Returns the set of
+        paths that changed, or `None` if events were lost and every
+        folder has to be checked again.
+        '''
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if (len(readable) == 0):
+            return set()
+
+        paths = set()
+
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return paths
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if (mask & IN_Q_OVERFLOW):
+                return None
+
+            if (mask & IN_IGNORED):
+                self.folders.pop(wd, None)
+                continue
+
+            folder = self.folders.get(wd)
+            if (folder is None or len(name) == 0):
+                continue
+
+            path = os.path.join(folder, os.fsdecode(name))
+
+            if (not mask & IN_ISDIR):
+                paths.add(path)
+
+            elif (mask & (IN_CREATE | IN_MOVED_TO)):
+                if (scanner.excluded(path, constant.EXCLUDE_GLOBS)):
+                    continue
+
+                # A new folder, possibly with files already in it
+                self.add_watch(path)
+                self.watch_tree(path)
+                paths |= set(scanner.walk([path]))
+
+            elif (mask & (IN_DELETE | IN_MOVED_FROM)):
+                # Tracks in a folder that went away aren't named one by one
+                return None
+
+        return paths
+
+class PollingSource:
+    '''
+    Reports changed files under a list of folders by comparing the
+    size and modification time of every file each `interval` seconds.
+    '''
+
+    def __init__(self, roots, interval=constant.WATCH_POLL_S):
+
+        self.roots = roots
+        self.interval = interval
+        self.files = self.snapshot()
+
+    def snapshot(self):
+
+        files = {}
+
+        for path in scanner.walk(self.roots):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Deleted while we looked
+                continue
+
+            files[path] = (stat.st_size, stat.st_mtime_ns)
+
+        return files
+
+    def wait(self, timeout):
+
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+
+        files = self.snapshot()
+
+        changed = set(path for path in files if self.files.get(path) != files[path])
+        changed |= self.files.keys() - files.keys()
+
+        self.files = files
+
+        return changed
+
+class Watcher:
+    '''
+    Watches the content folders and tells the client about files
+    that were added, changed or deleted after the startup scan.
+
+    A file is only reported once nothing has happened to it for
+    `debounce` seconds, so a large copy is fingerprinted once it's
+    done instead of on every write. Uses inotify where it's available
+    and falls back to polling elsewhere.
+    '''
+
+    def __init__(self, client, roots=None, debounce=constant.WATCH_DEBOUNCE_S):
+
+        self.client = client
+        self.cli = client.cli
+        self.roots = constant.CONTENT_PATHS if roots is None else roots
+        self.debounce = debounce
+
+        # Path -> time of the last event for it
+        self.pending = {}
+
+    def start(self):
+
+        folders = ', '.join(f"'{root}'" for root in self.roots)
+
+        try:
+            source = InotifySource(self.roots)
+            self.cli.log(f'Watching {folders} for changes')
+        except OSError as e:
+            source = PollingSource(self.roots)
+            self.cli.log(f'Polling {folders} for changes ({e})')
+
+        thread = threading.Thread(target=self.run, args=(source,))
+        thread.daemon = True
+        thread.start()
+
+    def run(self, source):
+
+        while True:
+            try:
+                timeout = self.debounce if len(self.pending) > 0 else None
+                paths = source.wait(timeout)
+
+                now = time.monotonic()
+
+                # Events were lost, check everything we know about
+                if (paths is None):
+                    paths = set(scanner.walk(self.roots))
+                    paths |= set(track.path for track in self.client.local_tracks.values())
+
+                for path in paths:
+                    self.pending[path] = now
+
+                settled = [path for path, last in self.pending.items() if now - last >= self.debounce]
+                for path in settled:
+                    del self.pending[path]
+
+                if (len(settled) > 0):
+                    self.client.update_local_files(settled)
+
+            except Exception:
+                self.cli.log(traceback.format_exc())